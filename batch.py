@@ -0,0 +1,324 @@
+# Author: John Grime
+#
+# Generate models for many sites listed in a manifest file, running the
+# fetch_topography.py, fetch_tiles.py and geotiff_to_3d.py steps for each site
+# in a pool of long-lived worker processes (so the heavy modules are imported,
+# and HTTP connections opened, once per worker rather than once per site).
+#
+# The manifest is a JSON list of objects, or a CSV file with a header row,
+# with the fields listed in "fields" below, e.g.:
+#
+#   name,lat0,lat1,lon0,lon1,dem_src,zoom,n_samples_x,n_samples_y
+#   canyon,35.9443,36.2990,-112.2772,-112.0149,SRTMGL3,13,500,500
+#
+# In a JSON manifest, "lat" and "lon" may be given as [min, max] pairs instead.
+#
+# All sites share a DEM cache and an SQLite tile cache. Sites whose regions
+# overlap (elevation data from the same source, or tiles from the same source
+# at the same zoom level) are processed one after another, largest region
+# first, so overlapping tiles and DEM regions lying inside an
+# earlier one are read from the caches rather than downloaded again. Groups of
+# sites which don't overlap are processed in parallel. With -prefetch, the
+# tiles for all sites are instead downloaded first in a single deduplicated
+# pass (see prefetch.py).
+#
+# Each site's output goes into its own directory [out_dir]/[name], along with
+# a log of its progress messages (log.txt) and a run report (report.json; see
+# metrics.py). The status of every site is written to [out_dir]/status.json
+# as they complete.
+#
+
+import sys, os, csv, json, time, argparse, contextlib, traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from metrics import RunReport
+from util import WebMercator
+
+# Manifest fields; required if no default given
+fields = {
+	'name': {'type': str, 'desc': 'Site name, also used for its output directory'},
+	'lat0': {'type': float, 'desc': 'Min latitude in degrees'},
+	'lat1': {'type': float, 'desc': 'Max latitude in degrees'},
+	'lon0': {'type': float, 'desc': 'Min longitude in degrees'},
+	'lon1': {'type': float, 'desc': 'Max longitude in degrees'},
+	'dem_src': {'type': str, 'default': 'SRTMGL1', 'desc': 'Source of DEM data (as fetch_topography.py -src)'},
+	'tile_src': {'type': str, 'default': 'usgs', 'desc': 'Source of satellite tiles (as fetch_tiles.py -src)'},
+	'zoom': {'type': int, 'default': None, 'desc': 'Zoom level of satellite tiles; if not given, no texture is made'},
+	'n_samples_x': {'type': int, 'default': None, 'desc': 'Samples on x axis (as geotiff_to_3d.py)'},
+	'n_samples_y': {'type': int, 'default': None, 'desc': 'Samples on y axis (as geotiff_to_3d.py)'},
+	'z_scale': {'type': float, 'default': 1.0, 'desc': 'Scaling applied to z axis (as geotiff_to_3d.py)'},
+	'max_error': {'type': float, 'default': None, 'desc': 'Mesh simplification error (as geotiff_to_3d.py)'},
+	'out_fmt': {'type': str, 'default': None, 'desc': 'Mesh file format (as geotiff_to_3d.py); default from -out_fmt'},
+}
+
+#
+# Read manifest into a list of sites, each a dict of the fields above with
+# lat and lon as (min, max) pairs.
+#
+def read_manifest(path: str) -> [dict]:
+	if path.lower().endswith('.json'):
+		with open(path) as f:
+			rows = json.load(f)
+		for row in rows:
+			for k in ('lat', 'lon'):
+				if k in row: row[k+'0'], row[k+'1'] = row.pop(k)
+	else:
+		with open(path, newline='') as f:
+			rows = [row for row in csv.DictReader(f)]
+
+	sites = []
+	for i, row in enumerate(rows):
+		site = {}
+		for k, v in row.items():
+			if k not in fields:
+				print(f'Manifest entry {i+1}: unknown field "{k}"')
+				sys.exit(-1)
+			if (v == None) or (v == ''): continue # CSV placeholder for default
+			try:
+				site[k] = fields[k]['type'](v)
+			except ValueError:
+				print(f'Manifest entry {i+1}: bad value "{v}" for field "{k}"')
+				sys.exit(-1)
+
+		for k in fields:
+			if k in site: continue
+			if 'default' not in fields[k]:
+				print(f'Manifest entry {i+1}: missing field "{k}"')
+				sys.exit(-1)
+			site[k] = fields[k]['default']
+
+		site['lat'], site['lon'] = sorted((site.pop('lat0'), site.pop('lat1'))), sorted((site.pop('lon0'), site.pop('lon1')))
+		sites.append(site)
+
+	names = [s['name'] for s in sites]
+	if len(set(names)) != len(names):
+		print('Site names in the manifest must be unique')
+		sys.exit(-1)
+
+	return sites
+
+#
+# Group sites which share downloads: same DEM source with overlapping regions,
+# or same tile source and zoom with overlapping tile ranges. Returns a list of
+# groups, each a list of sites with the largest region first.
+#
+def group_sites(sites: [dict]) -> [[dict]]:
+	def tile_range(site):
+		z = site['zoom']
+		x0, y0 = WebMercator.lonlat_to_tile(site['lon'][0], site['lat'][1], z) # top left
+		x1, y1 = WebMercator.lonlat_to_tile(site['lon'][1], site['lat'][0], z) # bottom right
+		return x0, y0, x1, y1
+
+	def overlap(a, b) -> bool:
+		return (a[0] <= b[2]) and (b[0] <= a[2]) and (a[1] <= b[3]) and (b[1] <= a[3])
+
+	boxes = [(s['lon'][0], s['lat'][0], s['lon'][1], s['lat'][1]) for s in sites]
+	tiles = [tile_range(s) if s['zoom'] != None else None for s in sites]
+
+	# Union-find over pairs of overlapping sites
+	parent = list(range(len(sites)))
+	def root(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+
+	for i in range(len(sites)):
+		for j in range(i+1, len(sites)):
+			a, b = sites[i], sites[j]
+			shared = (a['dem_src'] == b['dem_src']) and overlap(boxes[i], boxes[j])
+			if (not shared) and (tiles[i] != None) and (tiles[j] != None):
+				shared = (a['tile_src'], a['zoom']) == (b['tile_src'], b['zoom']) and overlap(tiles[i], tiles[j])
+			if shared: parent[root(i)] = root(j)
+
+	groups = {}
+	for i, site in enumerate(sites):
+		groups.setdefault(root(i), []).append(site)
+
+	area = lambda s: (s['lat'][1]-s['lat'][0]) * (s['lon'][1]-s['lon'][0])
+	return [sorted(g, key = area, reverse = True) for g in groups.values()]
+
+#
+# Run all steps for one site in its output directory; called in a worker
+# process. Progress messages go to the site's log file. Returns status dict.
+#
+def process_site(site: dict, settings: dict) -> dict:
+	import fetch_topography, fetch_tiles, geotiff_to_3d
+
+	name, lat, lon = site['name'], site['lat'], site['lon']
+	site_dir = os.path.join(settings['out_dir'], name)
+	os.makedirs(site_dir, exist_ok = True)
+
+	status = {'name': name, 'status': 'failed', 'stage': None, 'error': None, 'output': None, 'texture': None}
+	report = RunReport(f'batch.py:{name}', argv = [])
+
+	t0, cwd = time.perf_counter(), os.getcwd()
+	with open(os.path.join(site_dir, 'log.txt'), 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+		os.chdir(site_dir)
+		try:
+			status['stage'] = 'topography'
+			dem = fetch_topography.fetch(site['dem_src'], lat, lon, report = report,
+				file = 'topography', dem_cache = settings['dem_cache'], dem_cache_mb = settings['dem_cache_mb'],
+				retries = settings['retries'], backoff = settings['backoff'])
+
+			if site['zoom'] != None:
+				status['stage'] = 'tiles'
+				status['texture'] = fetch_tiles.fetch(site['tile_src'], lat, lon, site['zoom'], report = report,
+					combine = True, no_raw = True, cache_db = settings['tile_db'],
+					workers = settings['tile_workers'], retries = settings['retries'], backoff = settings['backoff'])
+
+			status['stage'] = 'mesh'
+			out_fmt = site['out_fmt'] if site['out_fmt'] != None else settings['out_fmt']
+			status['output'] = geotiff_to_3d.build_mesh(dem, lat, lon, report = report,
+				output = name, texture = status['texture'], out_fmt = out_fmt,
+				n_samples_x = site['n_samples_x'], n_samples_y = site['n_samples_y'],
+				z_scale = site['z_scale'], max_error = site['max_error'])
+
+			status['status'], status['stage'] = 'ok', None
+
+		except SystemExit as e:
+			status['error'] = f'stopped with exit code {e.code}; see log'
+		except Exception as e:
+			status['error'] = f'{type(e).__name__}: {e}'
+			traceback.print_exc()
+		finally:
+			os.chdir(cwd)
+
+	report.status = 'ok' if status['status'] == 'ok' else 'incomplete'
+	report.write(os.path.join(site_dir, 'report.json'))
+
+	status['seconds'] = time.perf_counter() - t0
+	status['tiles_failed'] = report.counters.get('tiles_failed', 0)
+	for k in ('output', 'texture'):
+		if status[k] != None: status[k] = os.path.join(site_dir, status[k])
+	return status
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generate 3D models for the sites listed in a manifest file', epilog='')
+
+	parser.add_argument('manifest',
+		help = 'Manifest of sites (.json or .csv); fields are ' + ', '.join(fields.keys()))
+
+	parser.add_argument('-out_dir', type = str, default = 'batch',
+		help = 'Directory for output; each site is written into a subdirectory with its name')
+
+	parser.add_argument('-workers', type = int, default = os.cpu_count(),
+		help = 'Number of worker processes (groups of overlapping sites are processed in parallel)')
+
+	parser.add_argument('-tile_workers', type = int, default = 4,
+		help = 'Number of tiles each worker downloads concurrently')
+
+	parser.add_argument('-out_fmt', type = str, default = 'obj',
+		help = 'Mesh file format for sites which don\'t specify one (as geotiff_to_3d.py -out_fmt)')
+
+	parser.add_argument('-dem_cache', type = str,
+		help = 'Shared DEM cache directory; default is [out_dir]/dem_cache')
+
+	parser.add_argument('-dem_cache_mb', type = float,
+		help = 'Keep DEM cache under this size (MiB)')
+
+	parser.add_argument('-tile_db', type = str,
+		help = 'Shared SQLite tile cache file; default is [out_dir]/tiles.db')
+
+	parser.add_argument('-prefetch', action = 'store_true',
+		help = 'Download the tiles for all sites in one deduplicated pass (see prefetch.py) before processing the sites')
+
+	parser.add_argument('-retries', type = int, default = 5,
+		help = 'Number of times to retry a failed request')
+
+	parser.add_argument('-backoff', type = float, default = 0.5,
+		help = 'Base delay (seconds) between retries, doubled for each successive retry')
+
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
+
+	args = parser.parse_args()
+
+	sites = read_manifest(args.manifest)
+	groups = group_sites(sites)
+
+	out_dir = os.path.abspath(args.out_dir)
+	os.makedirs(out_dir, exist_ok = True)
+
+	# Absolute paths, as each site is processed in its own directory
+	settings = {
+		'out_dir': out_dir,
+		'out_fmt': args.out_fmt,
+		'dem_cache': os.path.abspath(args.dem_cache if args.dem_cache != None else os.path.join(out_dir, 'dem_cache')),
+		'dem_cache_mb': args.dem_cache_mb,
+		'tile_db': os.path.abspath(args.tile_db if args.tile_db != None else os.path.join(out_dir, 'tiles.db')),
+		'tile_workers': max(1, args.tile_workers),
+		'retries': args.retries,
+		'backoff': args.backoff,
+	}
+
+	workers = max(1, min(args.workers, len(groups)))
+
+	print()
+	print(f'Run at: {time.asctime()}')
+	print(f'Run as: {" ".join(sys.argv)}')
+	print()
+	print(f'{len(sites)} site(s) in {len(groups)} group(s) of overlapping sites, using {workers} worker process(es)')
+	print(f'  Output directory : "{out_dir}"')
+	print(f'  DEM cache        : "{settings["dem_cache"]}"')
+	print(f'  Tile cache       : "{settings["tile_db"]}"')
+	print()
+
+	if args.prefetch:
+		import prefetch
+		from fetch_tiles import TileSource
+
+		requests = [(s['tile_src'], s['lat'], s['lon'], s['zoom']) for s in sites if s['zoom'] != None]
+		caches = {src: prefetch.open_cache(src, cache_db = settings['tile_db']) for src in set([r[0] for r in requests])}
+
+		print('Prefetching tiles:')
+		plan = prefetch.plan_tiles(requests, caches)
+		prefetch.print_plan(plan)
+		failed = prefetch.fetch_planned(plan, caches, settings['tile_workers']*workers,
+			retries = settings['retries'], backoff = settings['backoff'])
+		if len(failed) > 0:
+			print(f'{len(failed)} tile(s) could not be prefetched; sites will retry them')
+		print()
+
+		for cache in caches.values(): cache.close()
+
+		# Don't share open connections with the forked worker processes
+		if TileSource.session != None: TileSource.session.close()
+		TileSource.session, TileSource.session_settings = None, None
+
+	status_path = os.path.join(out_dir, 'status.json')
+	def save_status(results):
+		tmp_path = f'{status_path}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(results, f, indent = 1)
+		os.replace(tmp_path, status_path)
+
+	results, n_failed = [], 0
+	with ProcessPoolExecutor(max_workers = workers) as pool:
+		# The sites of a group are submitted in order, each once the previous
+		# one has completed (so later sites use data cached by earlier ones),
+		# and each site's status is reported as soon as it's available.
+		futures = {pool.submit(process_site, g[0], settings): (g, 0) for g in groups}
+		while len(futures) > 0:
+			done, _ = wait(futures, return_when = FIRST_COMPLETED)
+			for future in done:
+				group, i = futures.pop(future)
+				if i+1 < len(group):
+					futures[pool.submit(process_site, group[i+1], settings)] = (group, i+1)
+
+				status = future.result()
+				results.append(status)
+				if status['status'] == 'ok':
+					warn = f'; {status["tiles_failed"]} tile(s) missing' if status['tiles_failed'] > 0 else ''
+					print(f'  {status["name"]} : ok ({status["seconds"]:.1f} s){warn} => {status["output"]}', flush = True)
+				else:
+					n_failed += 1
+					print(f'  {status["name"]} : FAILED at {status["stage"]} stage ({status["error"]})', flush = True)
+				save_status(results)
+
+	print()
+	print(f'{len(sites)-n_failed} site(s) ok, {n_failed} failed; status written to {status_path}')
+	print('Done.')
+
+	if n_failed > 0: sys.exit(-1)
@@ -0,0 +1,333 @@
+# Author: John Grime
+#
+# Benchmarks for the main stages of the pipeline, run against synthetic data
+# so no network access or real downloads are needed:
+#
+#   interpolator_init  : construct geotiff.Interpolator from a GeoTIFF
+#   sample_point       : geotiff.Interpolator.interpolate(), one call per point
+#   sample_batch       : geotiff.Interpolator.interpolate_many(), all points
+#   obj_write          : mesh.write_obj() for a textured lattice mesh
+#   mosaic_combine     : mosaic.combine() of a tile cache, then crop
+#   mosaic_threads     : as mosaic_combine, decoding tiles in a thread per core
+#   mosaic_stream      : mosaic.stream_cropped() of a tile cache
+#   stream_to_file     : util.stream_to_file() from a local HTTP server
+#
+# Each benchmark is run for several problem sizes (GeoTIFF/mesh lattice side
+# length, tile set side length in tiles, download size in MiB), and repeated;
+# results are written as JSON, e.g. to compare against an earlier run:
+#
+#   {"meta": {...}, "results": [{"name": ..., "size": ..., "seconds": [...],
+#     "best": ..., "items": ..., "items_per_s": ...}, ...]}
+#
+# "items" is the number of things processed (points, vertices, tiles, bytes),
+# and "items_per_s" is calculated from the best time.
+#
+
+import sys, os, io, time, json, shutil, platform, tempfile, threading, argparse, contextlib
+
+import geotiff, mesh, mosaic, util
+from tilecache import DirectoryCache
+
+benchmarks = {
+	'interpolator_init': {'desc': 'Interpolator construction', 'unit': 'pixels'},
+	'sample_point': {'desc': 'Per-point sampling', 'unit': 'points'},
+	'sample_batch': {'desc': 'Batched sampling', 'unit': 'points'},
+	'obj_write': {'desc': 'OBJ vertex/face writing', 'unit': 'vertices'},
+	'mosaic_combine': {'desc': 'Tile mosaic combine and crop', 'unit': 'tiles'},
+	'mosaic_threads': {'desc': 'Tile mosaic combine and crop, threaded decoding', 'unit': 'tiles'},
+	'mosaic_stream': {'desc': 'Streamed tile mosaic crop', 'unit': 'tiles'},
+	'stream_to_file': {'desc': 'HTTP download via stream_to_file', 'unit': 'bytes'},
+}
+
+#
+# Synthetic GeoTIFF of n x n float32 heights (a few overlapping waves) over a
+# 1 degree square.
+#
+def make_geotiff(path: str, n: int):
+	import numpy as np
+	import rasterio
+	from rasterio.transform import from_bounds
+
+	x = np.linspace(0.0, 8.0*np.pi, n, dtype=np.float32)
+	z = 500.0*np.sin(x)[np.newaxis,:] * np.cos(0.7*x)[:,np.newaxis] + 100.0*np.sin(3.1*x)[:,np.newaxis]
+
+	profile = {
+		'driver': 'GTiff',
+		'width': n,
+		'height': n,
+		'count': 1,
+		'dtype': 'float32',
+		'crs': 'EPSG:4326',
+		'transform': from_bounds(-112.0, 36.0, -111.0, 37.0, n, n),
+		'tiled': True,
+		'blockxsize': 256,
+		'blockysize': 256,
+	}
+	with rasterio.open(path, 'w', **profile) as dst:
+		dst.write(z.astype(np.float32), 1)
+
+#
+# Synthetic tile cache of n x n noisy JPEG tiles; returns tile list in the
+# (dx, dy, x, y) form used by mosaic.py, and the cache.
+#
+def make_tiles(cache_dir: str, n: int, tile_size: int = 256, zoom: int = 13):
+	import numpy as np
+	from PIL import Image
+
+	cache = DirectoryCache(cache_dir, 'bench', 'jpeg')
+	rng = np.random.default_rng(n)
+
+	tiles = []
+	for dy in range(n):
+		for dx in range(n):
+			pixels = rng.integers(0, 256, (tile_size, tile_size, 3), dtype=np.uint8)
+			buf = io.BytesIO()
+			Image.fromarray(pixels).save(buf, format='jpeg', quality=90)
+			x, y = 1000+dx, 2000+dy
+			cache.put(zoom, x, y, buf.getvalue())
+			tiles.append( (dx, dy, x, y) )
+
+	return tiles, cache
+
+#
+# Minimal local HTTP server returning n_bytes of data for any GET request;
+# returns (server, url). Call server.shutdown() when finished.
+#
+def start_server(n_bytes: int):
+	import http.server
+
+	payload = os.urandom(min(n_bytes, 1024*1024))
+
+	class Handler(http.server.BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1'
+
+		def do_GET(self):
+			self.send_response(200)
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', str(n_bytes))
+			self.end_headers()
+			remaining = n_bytes
+			while remaining > 0:
+				chunk = payload[:remaining]
+				self.wfile.write(chunk)
+				remaining -= len(chunk)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	threading.Thread(target = server.serve_forever, daemon = True).start()
+	return server, f'http://127.0.0.1:{server.server_address[1]}/data'
+
+#
+# Call fn() repeat times, returning the wall time of each call. Anything the
+# code under test prints is discarded, so it doesn't interfere with the JSON
+# output.
+#
+def timed(fn, repeat: int) -> [float]:
+	times = []
+	for _ in range(repeat):
+		with contextlib.redirect_stdout(io.StringIO()):
+			t0 = time.perf_counter()
+			fn()
+			times.append(time.perf_counter()-t0)
+	return times
+
+def result(name: str, size: int, times: [float], items: int) -> dict:
+	best = min(times)
+	return {
+		'name': name,
+		'desc': benchmarks[name]['desc'],
+		'size': size,
+		'seconds': times,
+		'best': best,
+		'items': items,
+		'unit': benchmarks[name]['unit'],
+		'items_per_s': items/best if best > 0 else None,
+	}
+
+#
+# Individual benchmarks; each returns a list of results for the given size.
+#
+
+def bench_interpolator(work_dir: str, n: int, repeat: int, n_points: int) -> [dict]:
+	import numpy as np
+
+	path = os.path.join(work_dir, f'dem_{n}.tiff')
+	if not os.path.isfile(path): make_geotiff(path, n)
+
+	results = []
+
+	times = timed(lambda: geotiff.Interpolator(path), repeat)
+	results.append(result('interpolator_init', n, times, n*n))
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		interp = geotiff.Interpolator(path)
+
+	rng = np.random.default_rng(0)
+	xs, ys = rng.uniform(0.0, 1.0, n_points), rng.uniform(0.0, 1.0, n_points)
+
+	# Per-point sampling is slow, so use a subset of the points
+	n_single = min(n_points, 2000)
+	def per_point():
+		for x, y in zip(xs[:n_single], ys[:n_single]):
+			interp.interpolate(x, y, normalized_coords = True)
+
+	times = timed(per_point, repeat)
+	results.append(result('sample_point', n, times, n_single))
+
+	times = timed(lambda: interp.interpolate_many(xs, ys, normalized_coords = True), repeat)
+	results.append(result('sample_batch', n, times, n_points))
+
+	return results
+
+def bench_obj(work_dir: str, n: int, repeat: int) -> [dict]:
+	import numpy as np
+
+	xs, ys = np.meshgrid(np.linspace(0.0, 1.0, n), np.linspace(0.0, 1.0, n))
+	zs = np.sin(8.0*xs) * np.cos(5.0*ys)
+
+	verts = np.stack((xs.ravel()*1e4, ys.ravel()*1e4, zs.ravel()*1e3), axis=1)
+	uvs = np.stack((xs.ravel(), ys.ravel()), axis=1)
+	faces = mesh.grid_faces(n, n)
+
+	path = os.path.join(work_dir, f'mesh_{n}.obj')
+	times = timed(lambda: mesh.write_obj(path, verts, faces, uvs, 'mesh.mtl'), repeat)
+	os.remove(path)
+
+	return [result('obj_write', n, times, n*n)]
+
+def bench_mosaic(work_dir: str, n: int, repeat: int, tile_size: int = 256) -> [dict]:
+	from PIL import Image
+
+	cache_dir = os.path.join(work_dir, f'tiles_{n}')
+	with contextlib.redirect_stdout(io.StringIO()):
+		tiles, cache = make_tiles(cache_dir, n, tile_size)
+
+	def open_tile(tile):
+		data = cache.get(13, tile[2], tile[3])
+		return None if data == None else Image.open(io.BytesIO(data))
+
+	# Crop off half a tile on each side, as for a typical region of interest
+	h = tile_size//2
+	crop = (h, h, n*tile_size-h, n*tile_size-h)
+
+	results = []
+
+	path = os.path.join(work_dir, f'combined_{n}.jpeg')
+	def combine(workers = 1):
+		img = mosaic.combine(tiles, n, n, tile_size, open_tile, workers)
+		img.crop(crop).save(path)
+
+	times = timed(combine, repeat)
+	results.append(result('mosaic_combine', n, times, n*n))
+
+	times = timed(lambda: combine(os.cpu_count()), repeat)
+	results.append(result('mosaic_threads', n, times, n*n))
+
+	path = os.path.join(work_dir, f'streamed_{n}.tiff')
+	times = timed(lambda: mosaic.stream_cropped(tiles, tile_size, crop, open_tile, path, progress = False), repeat)
+	results.append(result('mosaic_stream', n, times, n*n))
+
+	shutil.rmtree(cache_dir)
+	return results
+
+def bench_download(work_dir: str, n_mb: int, repeat: int) -> [dict]:
+	n_bytes = n_mb*1024*1024
+	server, url = start_server(n_bytes)
+	session = util.make_session()
+	path = os.path.join(work_dir, 'download.bin')
+
+	def download():
+		with session.get(url, stream = True) as req:
+			util.stream_to_file(req, path)
+
+	try:
+		times = timed(download, repeat)
+	finally:
+		server.shutdown()
+		server.server_close()
+		session.close()
+	os.remove(path)
+
+	return [result('stream_to_file', n_mb, times, n_bytes)]
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic data, writing results as JSON', epilog='')
+
+	parser.add_argument('-only', required = False, nargs = '+', choices = ['interp', 'obj', 'mosaic', 'download'],
+		help = 'Only run these groups of benchmarks (default is all)')
+
+	parser.add_argument('-lattice', required = False, type = int, nargs = '+', default = [256, 1024, 2048],
+		help = 'Side lengths of synthetic GeoTIFFs and mesh lattices')
+
+	parser.add_argument('-tiles', required = False, type = int, nargs = '+', default = [4, 8, 16],
+		help = 'Side lengths (in tiles) of synthetic tile sets')
+
+	parser.add_argument('-download_mb', required = False, type = int, nargs = '+', default = [1, 16, 64],
+		help = 'Sizes (MiB) of local HTTP downloads')
+
+	parser.add_argument('-points', required = False, type = int, default = 1000000,
+		help = 'Number of random points for batched sampling')
+
+	parser.add_argument('-repeat', required = False, type = int, default = 3,
+		help = 'Number of times to run each benchmark')
+
+	parser.add_argument('-out', required = False, type = str,
+		help = 'Output JSON file (default is stdout)')
+
+	parser.add_argument('-work_dir', required = False, type = str,
+		help = 'Directory for synthetic data (default is a temporary directory, removed afterwards)')
+
+	args = parser.parse_args()
+
+	groups = args.only if args.only != None else ['interp', 'obj', 'mosaic', 'download']
+
+	work_dir = args.work_dir if args.work_dir != None else tempfile.mkdtemp(prefix='topo_bench_')
+	os.makedirs(work_dir, exist_ok = True)
+
+	results = []
+	try:
+		for n in args.lattice:
+			if 'interp' in groups:
+				print(f'interpolator: {n} x {n} ...', file=sys.stderr)
+				results += bench_interpolator(work_dir, n, args.repeat, args.points)
+			if 'obj' in groups:
+				print(f'obj: {n} x {n} ...', file=sys.stderr)
+				results += bench_obj(work_dir, n, args.repeat)
+
+		if 'mosaic' in groups:
+			for n in args.tiles:
+				print(f'mosaic: {n} x {n} tiles ...', file=sys.stderr)
+				results += bench_mosaic(work_dir, n, args.repeat)
+
+		if 'download' in groups:
+			for n_mb in args.download_mb:
+				print(f'download: {n_mb} MiB ...', file=sys.stderr)
+				results += bench_download(work_dir, n_mb, args.repeat)
+	finally:
+		if args.work_dir == None:
+			shutil.rmtree(work_dir)
+
+	import numpy as np
+
+	report = {
+		'meta': {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'platform': platform.platform(),
+			'cpu_count': os.cpu_count(),
+			'repeat': args.repeat,
+		},
+		'results': results,
+	}
+
+	text = json.dumps(report, indent = 2)
+	if args.out != None:
+		with open(args.out, 'w') as f:
+			f.write(text + '\n')
+		print(f'Wrote {args.out}', file=sys.stderr)
+	else:
+		print(text)
@@ -1,305 +1,622 @@
-# Author: John Grime.
-
-import sys, math, os, time, argparse, requests
-from util import Tee, WebMercator, stream_to_file
-
-class TileSource:
-
-	info = {
-		'usgs': {
-			'name': 'usgs',
-			'url': 'https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/tile/{zoom}/{y}/{x}',
-			'fmt': 'png',
-			'tile_size': 256,
-		},
-
-		'google': {
-			'name': 'google',
-			'url': 'https://mt0.google.com/vt/lyrs=s&x={x}&y={y}&z={zoom}',
-			'fmt': 'jpg',
-			'tile_size': 256,
-		}
-	}
-
-	def __init__(self, source_name):
-		name = source_name.lower()
-		if name not in TileSource.info:
-			print(f'Unknown image source {source_name}')
-			sys.exit(-1)
-
-		self.info = TileSource.info[name]
-
-	def make_url(self, x, y, zoom):
-		url = self.info['url']
-		p = {'x': x, 'y': y, 'zoom': zoom}
-		return url.format(**p)
-
-	def make_filepath(self, cache_dir, x, y, zoom):
-		fpath = f'{self.info["name"]}_{zoom}_{x}_{y}.{self.info["fmt"]}'
-		return os.path.join(cache_dir, fpath)
-
-	def stream_to_file(self, x, y, zoom, out_path, chunk_bytes=512*1024, update_bytes=256*1024):
-		url = self.make_url(x, y, zoom)
-
-		r = requests.get(url, params={}, stream=True)
-		if r.status_code == 404:
-			print()
-			print(f'{r.url} : not found! Stopping here.')
-			print(r)
-			print()
-			sys.exit(-1)
-
-		bytes_read = stream_to_file(r, out_path, chunk_bytes, update_bytes)
-		return url, bytes_read
-
-#
-# Duplicate stdout/stderr to file, and deal with command line arguments
-#
-
-tee_stdout = Tee('stdout.txt', 'w', 'stdout')
-tee_stderr = Tee('stderr.txt', 'w', 'stderr')
-
-parser = argparse.ArgumentParser( description='', epilog='' )
-
-opts = parser.add_argument_group('Region of interest')
-
-opts.add_argument('-src', required = True, type = str,
-	help = 'Source of satellite tile data',
-	choices = TileSource.info.keys())
-
-opts.add_argument('-lat', required = True, type = float, nargs = 2,
-	help = 'Min and max latitude in degrees (south pole at -90, north poles at +90)')
-
-opts.add_argument('-lon', required = True, type = float, nargs = 2,
-	help = 'Min and max longitude in degrees (-180 to +180, positive is east')
-
-opts.add_argument('-zoom', required = True, type = int,
-	help = 'Zoom level (0 to 23, larger values include more detail)')
-
-opts.add_argument('-even', required = False, type = bool,
-	default = False,
-	help = 'Round tile bounds down and up so tiled region commensurate with next zoom level down')
-
-opts = parser.add_argument_group('Data caching')
-
-opts.add_argument('-cache', required = False, type = str,
-	default = 'cache',
-	help = 'Directory name for cached tile data')
-
-opts = parser.add_argument_group('Tile combination')
-
-opts.add_argument('-combine', required = False,
-	action = 'store_true',
-	help = 'If specified, combine tiled data into single image')
-
-opts.add_argument('-out_fmt', required = False, type=str,
-	default = 'jpeg',
-	help = 'Format for combined output image (e.g., "jpeg" or "png")')
-
-if len(sys.argv)<2:
-	parser.parse_args([sys.argv[0], '-h'])
-
-args = parser.parse_args()
-
-if args.lon[0] > args.lon[1]:
-	print('Please enter longitudes in ASCENDING order.')
-	sys.exit(-1)
-
-if args.lat[0] > args.lat[1]:
-	print('Please enter latitudes in ASCENDING order.')
-	sys.exit(-1)
-
-#
-# Convert lat/lon to pixels (x_pix,y_pix), tiles (x_tile,y_tile),
-# and pixel offsets into tiles (x_sub,y_sub).
-#
-
-tilesrc = TileSource(args.src)
-tile_size = tilesrc.info['tile_size']
-
-_x0, _y0 = WebMercator.lonlat_to_pix(args.lon[0], args.lat[0], args.zoom, tile_size)
-_x1, _y1 = WebMercator.lonlat_to_pix(args.lon[1], args.lat[1], args.zoom, tile_size)
-
-x_pix, y_pix   = [_x0, _x1], [_y0, _y1]
-
-# If needed, swap orders to ensure ascending values. Redundant, but retained.
-if x_pix[0] > x_pix[1]: x_pix.reverse()
-if y_pix[0] > y_pix[1]: y_pix.reverse()
-
-# 'ofs' is pixel offset into tile
-x_tile, y_tile = [int(x/tile_size) for x in x_pix], [int(y/tile_size) for y in y_pix]
-x_ofs, y_ofs   = [int(x%tile_size) for x in x_pix], [int(y%tile_size) for y in y_pix]
-
-#
-# Give the user some feedback
-#
-
-print()
-print(f'Run at: {time.asctime()}')
-print(f'Run as: {" ".join(sys.argv)}')
-print()
-print('Inputs:')
-print()
-print(f'  Tile source          : {args.src}')
-print(f'  Latitude (degrees)   : {args.lat[0]} to {args.lat[1]}')
-print(f'  Longitude (degrees)  : {args.lon[0]} to {args.lon[1]}')
-print(f'  Zoom level           : {args.zoom}')
-print(f'  Tile cache directory : "{args.cache}"')
-print()
-print('Outputs')
-print()
-print(f'  Pixel y range => (tile:offset,tile:offset) : ({y_pix[0]:.2f},{y_pix[1]:.2f}) => ({y_tile[0]}:{y_ofs[0]},{y_tile[1]}:{y_ofs[1]})')
-print(f'  Pixel x range => (tile:offset,tile:offset) : ({x_pix[0]:.2f},{x_pix[1]:.2f}) => ({x_tile[0]}:{x_ofs[0]},{x_tile[1]}:{x_ofs[1]})')
-print()
-
-if args.even == True:
-	if (x_tile[0]%2 != 0):
-		x_tile[0] -= 1 # round minimum DOWN
-		x_ofs[0] = 0
-
-	if (x_tile[1]%2 != 0):
-		x_tile[1] += 1 # round maximum UP
-		x_ofs[1] = 0
-
-	if (y_tile[0]%2 != 0):
-		y_tile[0] -= 1
-		y_ofs[0] = 0
-
-	if (y_tile[1]%2 != 0):
-		y_tile[1] += 1
-		y_ofs[1] = 0
-
-	print()
-	print('Remapped lattice cells:')
-	print(f'  Pixel y range => (tile:offset,tile:offset) : ({y_pix[0]:.2f},{y_pix[1]:.2f}) => ({y_tile[0]}:{y_ofs[0]},{y_tile[1]}:{y_ofs[1]})')
-	print(f'  Pixel x range => (tile:offset,tile:offset) : ({x_pix[0]:.2f},{x_pix[1]:.2f}) => ({x_tile[0]}:{x_ofs[0]},{x_tile[1]}:{x_ofs[1]})')
-	print()
-
-#
-# Download, cache, and combine tiles (latter optional)
-#
-
-if os.path.isdir(args.cache) == False:
-	try:
-		os.mkdir(args.cache)
-	except OSError:
-		print(f'Unable to create cache directory "{args.cache}"; halting here.');
-		sys.exit(-1)
-	else:
-		print(f'Created missing cache directory "{args.cache}"')
-
-# Tile spans on x and y axes
-nx_tile = (x_tile[1]-x_tile[0]) + 1
-ny_tile = (y_tile[1]-y_tile[0]) + 1
-
-# How many pixels are the raw and cropped images?
-nx_pix = int(x_pix[1]-x_pix[0])+1
-ny_pix = int(y_pix[1]-y_pix[0])+1
-
-reduction = 100.0 * (1.0 - (nx_pix*ny_pix)/(nx_tile*tile_size * ny_tile*tile_size))
-
-print(f'Requires {nx_tile} x {ny_tile} tile set ({nx_tile*ny_tile} tiles total)')
-print(f'Uncropped image is {nx_tile*tile_size} x {ny_tile*tile_size} pixels')
-print(f'Cropped image is {nx_pix} x {ny_pix} pixels ({reduction:.2f}% reduction)')
-print()
-print(f'Downloading...')
-
-# Import Python Imaging Library (PIL), Pillow, or equivalent
-if args.combine:
-	from PIL import Image
-	Image.MAX_IMAGE_PIXELS = None # careful; only for trusted sources!
-	combined = Image.new("RGB", (nx_tile*tile_size, ny_tile*tile_size))
-
-# Download tile sets, combining (if needed) into a single image as we go
-n, N, checkpoint_, delta_checkpoint_ = 0, nx_tile*ny_tile, 1, 10
-for dy in range(ny_tile):
-	for dx in range(nx_tile):
-		x, y = x_tile[0]+dx, y_tile[0]+dy
-		n += 1
-		out_path = tilesrc.make_filepath(args.cache, x, y, args.zoom)
-
-		# Update user on progress every delta_checkpoint_ percent
-		if ( (100*n)/N > (checkpoint_*delta_checkpoint_) ):
-			print(f'  {out_path} : {n}/{N} ({(100.0*n)/N:.0f}%)')
-			checkpoint_ += 1
-
-		if os.path.isfile(out_path):
-			# tile is already in the cache
-			pass
-		else:
-			# fetch tile from remote server & save to file cache
-			tilesrc.stream_to_file(x, y, args.zoom, out_path)
-
-		if args.combine:
-			img = Image.open(out_path)
-			combined.paste(img, (dx*tile_size, dy*tile_size))
-
-# Write combined single image texture
-if args.combine:
-	fmt = args.out_fmt
-	print()
-	print(f'Saving combined.raw.{fmt} ...')
-	combined.save(f'combined.raw.{fmt}');
-
-	x0, y0 = x_ofs[0], y_ofs[0]
-	x1, y1 = ((nx_tile-1)*tile_size)+x_ofs[1], ((ny_tile-1)*tile_size)+y_ofs[1]
-	
-	print(f'Cropping ...')
-	combined = combined.crop( (x0,y0, x1,y1) )
-
-	print(f'Saving combined.cropped.{fmt} ...')
-	combined.save(f'combined.cropped.{fmt}');
-
-	#
-	# write simple, flat obj file for testing; two triangles.
-	#
-
-	# Material file
-	texturepath = f'combined.cropped.{fmt}'
-	materialpath = 'flat.mtl'
-	f = open(materialpath, 'w')
-	print('newmtl Default', file=f)
-	print('  Ka 1.0 1.0 1.0', file=f) # ambient color
-	print('  Kd 1.0 1.0 1.0', file=f) # diffuse color
-	print('  Ks 0.0 0.0 0.0', file=f) # specular color
-	print('   d 1.0', file=f)  # "dissolved" == opacity
-	print('  Ni 1.0', file=f)  # optical density
-	print('  illum 2', file=f) # illumination model
-	print(f'  map_Ka {texturepath}', file=f) # ambient texture
-	print(f'  map_Kd {texturepath}', file=f) # diffuse texture
-	print(f'  map_Ks {texturepath}', file=f) # specular texture
-	print(f'  map_Ns {texturepath}', file=f) # specular highlight texture
-	f.close()
-
-	# Obj file
-	#
-	# 1 - 2
-	# | \ | : 1,4,2 : 1,3,4
-	# 3 - 4
-	#
-	v1 = [args.lon[0], args.lat[1], 0]
-	v2 = [args.lon[1], args.lat[1], 0]
-	v3 = [args.lon[0], args.lat[0], 0]
-	v4 = [args.lon[1], args.lat[0], 0]
-
-	f1, f2 = [1,4,2], [1,3,4]
-
-	f = open('flat.obj', 'w')
-	print(f'mtllib {materialpath}', file=f)
-	print(f'usemtl Default', file=f)
-
-	print(f'v {v1[0]:.6f} {v1[1]:.6f} {v1[2]:.6f}', file=f)
-	print(f'v {v2[0]:.6f} {v2[1]:.6f} {v2[2]:.6f}', file=f)
-	print(f'v {v3[0]:.6f} {v3[1]:.6f} {v3[2]:.6f}', file=f)
-	print(f'v {v4[0]:.6f} {v4[1]:.6f} {v4[2]:.6f}', file=f)
-
-	print(f'vt {0.0:.6f} {1.0:.6f}', file=f)
-	print(f'vt {1.0:.6f} {1.0:.6f}', file=f)
-	print(f'vt {0.0:.6f} {0.0:.6f}', file=f)
-	print(f'vt {1.0:.6f} {0.0:.6f}', file=f)
-
-	print(f'f {" ".join([f"{idx}/{idx}" for idx in f1])}', file=f)
-	print(f'f {" ".join([f"{idx}/{idx}" for idx in f2])}', file=f)
-	f.close()
-
-print('Done.')
+# Author: John Grime.
+
+import sys, math, os, io, time, argparse, requests, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+from util import Tee, WebMercator, make_session, make_args
+from tilecache import DirectoryCache, SQLiteCache
+from metrics import RunReport, profile_to
+import mosaic
+
+class TileSource:
+
+	# Limit on simultaneous requests to any one host, shared by all instances
+	max_per_host = 4
+	host_slots, host_slots_lock = {}, threading.Lock()
+
+	# Shared HTTP session; replace via configure_session() to change settings
+	session, session_settings = None, None
+	timeout = (10, 60) # connect, read (seconds)
+
+	info = {
+		'usgs': {
+			'name': 'usgs',
+			'url': 'https://basemap.nationalmap.gov/arcgis/rest/services/USGSImageryOnly/MapServer/tile/{zoom}/{y}/{x}',
+			'fmt': 'png',
+			'tile_size': 256,
+		},
+
+		'google': {
+			'name': 'google',
+			'url': 'https://mt0.google.com/vt/lyrs=s&x={x}&y={y}&z={zoom}',
+			'fmt': 'jpg',
+			'tile_size': 256,
+		}
+	}
+
+	def __init__(self, source_name):
+		name = source_name.lower()
+		if name not in TileSource.info:
+			print(f'Unknown image source {source_name}')
+			sys.exit(-1)
+
+		self.info = TileSource.info[name]
+
+	def make_url(self, x, y, zoom):
+		url = self.info['url']
+		p = {'x': x, 'y': y, 'zoom': zoom}
+		return url.format(**p)
+
+	@staticmethod
+	def configure_session(pool_size: int = 10, retries: int = 5, backoff: float = 0.5):
+		# Keep existing session (and its open connections) if settings unchanged
+		settings = (pool_size, retries, backoff)
+		if (TileSource.session != None) and (TileSource.session_settings == settings): return
+
+		TileSource.session = make_session(pool_size, retries, backoff)
+		TileSource.session_settings = settings
+
+	def host_slot(self, url):
+		host = urlsplit(url).netloc
+		with TileSource.host_slots_lock:
+			if host not in TileSource.host_slots:
+				TileSource.host_slots[host] = threading.BoundedSemaphore(TileSource.max_per_host)
+			return TileSource.host_slots[host]
+
+	# Safe to call from multiple threads. Returns data as None if the tile
+	# could not be fetched (after any retries configured in the session).
+	def fetch(self, x, y, zoom):
+		url = self.make_url(x, y, zoom)
+
+		if TileSource.session == None:
+			TileSource.configure_session()
+
+		with self.host_slot(url):
+			try:
+				r = TileSource.session.get(url, params={}, timeout=TileSource.timeout)
+				if r.status_code != 200:
+					print(f'{r.url} : HTTP status {r.status_code}; skipping tile')
+					return url, None
+				data = r.content
+
+			except requests.RequestException as e:
+				print(f'{url} : {e}; skipping tile')
+				return url, None
+
+		return url, data
+
+#
+# Command line arguments
+#
+
+parser = argparse.ArgumentParser( description='', epilog='' )
+
+opts = parser.add_argument_group('Region of interest')
+
+opts.add_argument('-src', required = True, type = str,
+	help = 'Source of satellite tile data',
+	choices = TileSource.info.keys())
+
+opts.add_argument('-lat', required = True, type = float, nargs = 2,
+	help = 'Min and max latitude in degrees (south pole at -90, north poles at +90)')
+
+opts.add_argument('-lon', required = True, type = float, nargs = 2,
+	help = 'Min and max longitude in degrees (-180 to +180, positive is east')
+
+opts.add_argument('-zoom', required = True, type = int,
+	help = 'Zoom level (0 to 23, larger values include more detail)')
+
+opts.add_argument('-even', required = False, type = bool,
+	default = False,
+	help = 'Round tile bounds down and up so tiled region commensurate with next zoom level down')
+
+opts = parser.add_argument_group('Data caching')
+
+opts.add_argument('-cache', required = False, type = str,
+	default = 'cache',
+	help = 'Directory name for cached tile data')
+
+opts.add_argument('-cache_db', required = False, type = str,
+	help = 'Store cached tile data in this SQLite file rather than the -cache directory (see tilecache.py to migrate an existing directory)')
+
+opts.add_argument('-cache_max_mb', required = False, type = float,
+	help = 'With -cache_db, remove least recently used tiles at the end of the run to keep the cache under this size (MiB)')
+
+opts = parser.add_argument_group('Downloading')
+
+opts.add_argument('-workers', required = False, type = int,
+	default = 1,
+	help = 'Number of tiles to download concurrently')
+
+opts.add_argument('-max_per_host', required = False, type = int,
+	default = TileSource.max_per_host,
+	help = 'Maximum number of simultaneous requests to any one tile server')
+
+opts.add_argument('-retries', required = False, type = int,
+	default = 5,
+	help = 'Number of times to retry a failed tile request (on rate limiting, server or connection errors)')
+
+opts.add_argument('-backoff', required = False, type = float,
+	default = 0.5,
+	help = 'Base delay (seconds) between retries, doubled for each successive retry')
+
+opts = parser.add_argument_group('Tile combination')
+
+opts.add_argument('-combine', required = False,
+	action = 'store_true',
+	help = 'If specified, combine tiled data into single image')
+
+opts.add_argument('-out_fmt', required = False, type=str,
+	default = 'jpeg',
+	help = 'Format for combined output image (e.g., "jpeg" or "png")')
+
+opts.add_argument('-stream', required = False,
+	action = 'store_true',
+	help = 'Write cropped image as a TIFF one row of tiles at a time, rather than combining all tiles in memory (implies -no_raw)')
+
+opts.add_argument('-no_raw', required = False,
+	action = 'store_true',
+	help = 'Do not save the uncropped combined image')
+
+opts.add_argument('-pipeline', required = False,
+	action = 'store_true',
+	help = 'With -combine, combine tiles as they arrive rather than after all downloads finish, decoding tiles in parallel (see -decode_workers)')
+
+opts.add_argument('-decode_workers', required = False, type = int,
+	default = os.cpu_count(),
+	help = 'Number of threads decoding tiles with -pipeline')
+
+opts.add_argument('-pyramid', required = False, type = int,
+	default = 0,
+	help = 'Build this many lower zoom levels of tiles by downsampling cached tiles (downloading any tiles around the region needed to complete them), and store them in the tile cache; with -combine, also write a combined image for each level')
+
+opts = parser.add_argument_group('Instrumentation')
+
+opts.add_argument('-report', required = False, type = str,
+	help = 'Write a JSON run report (stage timings, tiles hit/missed in cache, bytes downloaded and written, peak memory) to this file')
+
+opts.add_argument('-profile', required = False, type = str,
+	help = 'Profile the run with cProfile, saving the statistics to this file')
+
+#
+# Download tiles as specified by args (as parsed from the command line options
+# above), and combine them if requested. Returns the path of the cropped
+# texture image, or None if not combined. Progress and run statistics are
+# recorded in report, if given.
+#
+def run(args, report: RunReport = None) -> str:
+	if report == None: report = RunReport('fetch_tiles.py')
+
+	texturepath = None
+
+	if args.lon[0] > args.lon[1]:
+		print('Please enter longitudes in ASCENDING order.')
+		sys.exit(-1)
+
+	if args.lat[0] > args.lat[1]:
+		print('Please enter latitudes in ASCENDING order.')
+		sys.exit(-1)
+
+	#
+	# Convert lat/lon to pixels (x_pix,y_pix), tiles (x_tile,y_tile),
+	# and pixel offsets into tiles (x_sub,y_sub).
+	#
+
+	tilesrc = TileSource(args.src)
+	tile_size = tilesrc.info['tile_size']
+
+	_x0, _y0 = WebMercator.lonlat_to_pix(args.lon[0], args.lat[0], args.zoom, tile_size)
+	_x1, _y1 = WebMercator.lonlat_to_pix(args.lon[1], args.lat[1], args.zoom, tile_size)
+
+	x_pix, y_pix   = [_x0, _x1], [_y0, _y1]
+
+	# If needed, swap orders to ensure ascending values. Redundant, but retained.
+	if x_pix[0] > x_pix[1]: x_pix.reverse()
+	if y_pix[0] > y_pix[1]: y_pix.reverse()
+
+	# 'ofs' is pixel offset into tile
+	x_tile, y_tile = [int(x/tile_size) for x in x_pix], [int(y/tile_size) for y in y_pix]
+	x_ofs, y_ofs   = [int(x%tile_size) for x in x_pix], [int(y%tile_size) for y in y_pix]
+
+	#
+	# Give the user some feedback
+	#
+
+	print()
+	print('Inputs:')
+	print()
+	print(f'  Tile source          : {args.src}')
+	print(f'  Latitude (degrees)   : {args.lat[0]} to {args.lat[1]}')
+	print(f'  Longitude (degrees)  : {args.lon[0]} to {args.lon[1]}')
+	print(f'  Zoom level           : {args.zoom}')
+	if args.cache_db != None:
+		print(f'  Tile cache database  : "{args.cache_db}"')
+	else:
+		print(f'  Tile cache directory : "{args.cache}"')
+	print()
+	print('Outputs')
+	print()
+	print(f'  Pixel y range => (tile:offset,tile:offset) : ({y_pix[0]:.2f},{y_pix[1]:.2f}) => ({y_tile[0]}:{y_ofs[0]},{y_tile[1]}:{y_ofs[1]})')
+	print(f'  Pixel x range => (tile:offset,tile:offset) : ({x_pix[0]:.2f},{x_pix[1]:.2f}) => ({x_tile[0]}:{x_ofs[0]},{x_tile[1]}:{x_ofs[1]})')
+	print()
+
+	if args.even == True:
+		if (x_tile[0]%2 != 0):
+			x_tile[0] -= 1 # round minimum DOWN
+			x_ofs[0] = 0
+
+		if (x_tile[1]%2 != 0):
+			x_tile[1] += 1 # round maximum UP
+			x_ofs[1] = 0
+		elif (x_ofs[1] != 0):
+			x_tile[1] += 2 # region ends inside an even tile; include its odd neighbour
+			x_ofs[1] = 0
+
+		if (y_tile[0]%2 != 0):
+			y_tile[0] -= 1
+			y_ofs[0] = 0
+
+		if (y_tile[1]%2 != 0):
+			y_tile[1] += 1
+			y_ofs[1] = 0
+		elif (y_ofs[1] != 0):
+			y_tile[1] += 2
+			y_ofs[1] = 0
+
+		print()
+		print('Remapped lattice cells:')
+		print(f'  Pixel y range => (tile:offset,tile:offset) : ({y_pix[0]:.2f},{y_pix[1]:.2f}) => ({y_tile[0]}:{y_ofs[0]},{y_tile[1]}:{y_ofs[1]})')
+		print(f'  Pixel x range => (tile:offset,tile:offset) : ({x_pix[0]:.2f},{x_pix[1]:.2f}) => ({x_tile[0]}:{x_ofs[0]},{x_tile[1]}:{x_ofs[1]})')
+		print()
+
+	#
+	# Download, cache, and combine tiles (latter optional)
+	#
+
+	if args.cache_db != None:
+		max_bytes = None if args.cache_max_mb == None else int(args.cache_max_mb*1024*1024)
+		cache = SQLiteCache(args.cache_db, tilesrc.info['name'], max_bytes)
+	else:
+		cache = DirectoryCache(args.cache, tilesrc.info['name'], tilesrc.info['fmt'])
+
+	# Tile spans on x and y axes
+	nx_tile = (x_tile[1]-x_tile[0]) + 1
+	ny_tile = (y_tile[1]-y_tile[0]) + 1
+
+	# How many pixels are the raw and cropped images?
+	nx_pix = int(x_pix[1]-x_pix[0])+1
+	ny_pix = int(y_pix[1]-y_pix[0])+1
+
+	reduction = 100.0 * (1.0 - (nx_pix*ny_pix)/(nx_tile*tile_size * ny_tile*tile_size))
+
+	print(f'Requires {nx_tile} x {ny_tile} tile set ({nx_tile*ny_tile} tiles total)')
+	print(f'Uncropped image is {nx_tile*tile_size} x {ny_tile*tile_size} pixels')
+	print(f'Cropped image is {nx_pix} x {ny_pix} pixels ({reduction:.2f}% reduction)')
+	print()
+
+	# Tile coords of the tile set, in row order
+	tiles = []
+	for dy in range(ny_tile):
+		for dx in range(nx_tile):
+			tiles.append( (dx, dy, x_tile[0]+dx, y_tile[0]+dy) )
+
+	not_cached = set(cache.missing(args.zoom, [(t[2],t[3]) for t in tiles]))
+
+	cached, missing = [], []
+	for t in tiles:
+		(missing if (t[2],t[3]) in not_cached else cached).append(t)
+
+	print(f'{len(cached)} tiles already cached, {len(missing)} to download')
+	report.set('n_tiles', len(tiles))
+	report.count('tiles_cache_hits', len(cached))
+	report.count('tiles_cache_misses', len(missing))
+	report.stage('download')
+	print()
+	print(f'Downloading...')
+
+	# Update user on progress every delta_checkpoint_ percent, as downloads
+	# complete; called from the download threads with -pipeline.
+	n, N, checkpoint_, delta_checkpoint_ = 0, len(tiles), 1, 10
+	progress_lock = threading.Lock()
+	def progress(tile):
+		nonlocal n, checkpoint_
+		with progress_lock:
+			n += 1
+			if ( (100*n)/N > (checkpoint_*delta_checkpoint_) ):
+				print(f'  {cache.location(args.zoom, tile[2], tile[3])} : {n}/{N} ({(100.0*n)/N:.0f}%)')
+				checkpoint_ += 1
+
+	for t in cached:
+		progress(t)
+
+	# Fetch missing tiles from remote server & save to tile cache. Tiles which
+	# can't be fetched are noted, and the remainder of the tile set processed.
+	if TileSource.max_per_host != max(1, args.max_per_host):
+		TileSource.max_per_host = max(1, args.max_per_host)
+		TileSource.host_slots = {}
+	TileSource.configure_session(max(args.workers, TileSource.max_per_host), args.retries, args.backoff)
+
+	failed = []
+
+	# Returns (tile, True) if the tile was downloaded & cached; the data itself is
+	# not returned, so that pending downloads don't hold on to tile data.
+	def fetch_tile(tile):
+		dx, dy, x, y = tile
+		url, data = tilesrc.fetch(x, y, args.zoom)
+		if data != None:
+			cache.put(args.zoom, x, y, data)
+			report.count('bytes_downloaded', len(data))
+		return tile, data != None
+
+	def fetched(tile, ok: bool):
+		if not ok: failed.append(tile)
+		report.count('tiles_downloaded' if ok else 'tiles_failed')
+		progress(tile)
+
+	# Load tile (dx, dy, x, y) at the specified zoom level from the cache, or None
+	# if the tile isn't cached.
+	def open_tile(tile, zoom: int):
+		from PIL import Image
+		data = cache.get(zoom, tile[2], tile[3])
+		return Image.open(io.BytesIO(data)) if data != None else None
+
+	#
+	# Combine tiles into a single image, cropped to the region of interest; crop
+	# is (x0,y0, x1,y1) relative to the top left of the tile set. Tiles missing
+	# from the cache (e.g. failed downloads) are left blank. If given, wait(tile)
+	# is called before each tile is loaded. Returns path of the cropped image.
+	#
+	def combine_tiles(zoom: int, tiles, nx_tile: int, ny_tile: int, crop, tag: str = '', wait = None):
+		fmt = args.out_fmt
+		workers = max(1, args.decode_workers) if args.pipeline else 1
+
+		def load(tile):
+			if wait != None: wait(tile)
+			return open_tile(tile, zoom)
+
+		if args.stream:
+			# Only one row of tiles is in memory at any time; output is always
+			# a TIFF, with JPEG compression inside if a JPEG was requested.
+			texturepath = f'combined.cropped{tag}.tiff'
+			print()
+			print(f'Streaming {texturepath} ...')
+			mosaic.stream_cropped(tiles, tile_size, crop, load,
+				texturepath, jpeg = fmt.lower() in ('jpeg', 'jpg'), workers = workers)
+
+		else:
+			combined = mosaic.combine(tiles, nx_tile, ny_tile, tile_size, load, workers)
+
+			print()
+			if not args.no_raw:
+				print(f'Saving combined.raw{tag}.{fmt} ...')
+				combined.save(f'combined.raw{tag}.{fmt}');
+				report.count('bytes_written', os.path.getsize(f'combined.raw{tag}.{fmt}'))
+
+			print(f'Cropping ...')
+			combined = combined.crop(crop)
+
+			texturepath = f'combined.cropped{tag}.{fmt}'
+			print(f'Saving {texturepath} ...')
+			combined.save(texturepath);
+
+		report.count('bytes_written', os.path.getsize(texturepath))
+		return texturepath
+
+	x0, y0 = x_ofs[0], y_ofs[0]
+	x1, y1 = ((nx_tile-1)*tile_size)+x_ofs[1], ((ny_tile-1)*tile_size)+y_ofs[1]
+
+	#
+	# Pipelined download and combination: tiles are downloaded in the
+	# background, while tiles are decoded (in parallel) and pasted into the
+	# combined image in order, each as soon as it's available. Decoded tiles
+	# waiting to be pasted are limited to a few per decoding thread.
+	#
+	if args.combine and args.pipeline:
+		report.stage('download_combine')
+
+		pool = ThreadPoolExecutor(max_workers = max(1, args.workers))
+		pending = {}
+		for t in missing:
+			pending[(t[2],t[3])] = pool.submit(fetch_tile, t)
+			pending[(t[2],t[3])].add_done_callback(lambda future: fetched(*future.result()))
+
+		def wait(tile):
+			future = pending.pop((tile[2],tile[3]), None)
+			if future != None: future.result()
+
+		texturepath = combine_tiles(args.zoom, tiles, nx_tile, ny_tile, (x0,y0, x1,y1), wait = wait)
+		pool.shutdown(wait = True)
+
+	elif args.workers > 1:
+		with ThreadPoolExecutor(max_workers = args.workers) as pool:
+			for future in as_completed([pool.submit(fetch_tile, t) for t in missing]):
+				fetched(*future.result())
+	else:
+		for t in missing:
+			fetched(*fetch_tile(t))
+
+	if len(failed) > 0:
+		print()
+		print(f'{len(failed)} tile(s) could not be downloaded; run again to retry them:')
+		for t in failed:
+			print(f'  {cache.location(args.zoom, t[2], t[3])}')
+
+	#
+	# Build lower zoom levels from the tiles we have: each tile at the next zoom
+	# level down is made from a 2x2 group of tiles at this level. Tiles already in
+	# the cache (e.g. downloaded earlier) are left alone. So that every group is
+	# complete, tiles at this level beneath the tiles covering the region at the
+	# lowest level are first downloaded if needed, i.e. the tile set is extended
+	# to multiples of 2^pyramid tiles; groups left incomplete by failed downloads
+	# aren't built.
+	#
+	def encode_tile(img) -> bytes:
+		buf = io.BytesIO()
+		if tilesrc.info['fmt'].lower() in ('jpg', 'jpeg'):
+			img.save(buf, 'JPEG', quality = 90)
+		else:
+			img.save(buf, 'PNG')
+		return buf.getvalue()
+
+	if args.pyramid > 0:
+		print()
+		print(f'Building {args.pyramid} lower zoom level(s) from cached tiles ...')
+		report.stage('pyramid')
+
+		k = 2**min(args.pyramid, args.zoom)
+		x_range = range((x_tile[0]//k)*k, (x_tile[1]//k+1)*k)
+		y_range = range((y_tile[0]//k)*k, (y_tile[1]//k+1)*k)
+		base = [(x,y) for y in y_range for x in x_range]
+
+		extra = cache.missing(args.zoom, base)
+		if len(extra) > 0:
+			print(f'  downloading {len(extra)} tile(s) around the region to complete lower levels ...')
+			with ThreadPoolExecutor(max_workers = max(1, args.workers)) as pool:
+				for tile, ok in pool.map(fetch_tile, [(0, 0, x, y) for x,y in extra]):
+					report.count('tiles_downloaded' if ok else 'tiles_failed')
+
+		not_cached = set(cache.missing(args.zoom, base))
+		have = set(base) - not_cached
+
+		for zoom in range(args.zoom-1, max(-1, args.zoom-1-args.pyramid), -1):
+			parents = sorted(set([(x//2,y//2) for x,y in have]))
+			cached_parents = set(parents) - set(cache.missing(zoom, parents))
+
+			n_built, n_incomplete = 0, 0
+			for px, py in parents:
+				if (px,py) in cached_parents: continue
+
+				group = [[(2*px+i, 2*py+j) for i in range(2)] for j in range(2)]
+				if not all([xy in have for row in group for xy in row]):
+					n_incomplete += 1
+					continue
+
+				quad = [[open_tile((0, 0, x, y), zoom+1) for x,y in row] for row in group]
+				cache.put(zoom, px, py, encode_tile(mosaic.downsample_quad(quad, tile_size)))
+				cached_parents.add((px,py))
+				n_built += 1
+				report.count('pyramid_tiles_built')
+
+			print(f'  zoom {zoom} : {n_built} tile(s) built, {len(parents)-n_built-n_incomplete} already cached, {n_incomplete} incomplete')
+			have = cached_parents
+
+	if args.combine:
+		report.stage('combine')
+		if texturepath == None: # i.e., not already combined with -pipeline
+			texturepath = combine_tiles(args.zoom, tiles, nx_tile, ny_tile, (x0,y0, x1,y1))
+
+		# Lower zoom levels, from the pixel range of the region at each level
+		for zoom in range(args.zoom-1, max(-1, args.zoom-1-args.pyramid), -1):
+			scale = 2**(args.zoom-zoom)
+			px = [int(x/scale) for x in x_pix]
+			py = [int(y/scale) for y in y_pix]
+			tx, ty = [x//tile_size for x in px], [y//tile_size for y in py]
+
+			level_tiles = []
+			for dy in range(ty[1]-ty[0]+1):
+				for dx in range(tx[1]-tx[0]+1):
+					level_tiles.append( (dx, dy, tx[0]+dx, ty[0]+dy) )
+
+			absent = cache.missing(zoom, [(t[2],t[3]) for t in level_tiles])
+			if len(absent) > 0:
+				print()
+				print(f'WARNING: {len(absent)} tile(s) at zoom {zoom} could not be built; combined image will have blank areas')
+
+			crop = (px[0]-tx[0]*tile_size, py[0]-ty[0]*tile_size, px[1]-tx[0]*tile_size, py[1]-ty[0]*tile_size)
+			combine_tiles(zoom, level_tiles, tx[1]-tx[0]+1, ty[1]-ty[0]+1, crop, f'.z{zoom}')
+
+		#
+		# write simple, flat obj file for testing; two triangles.
+		#
+
+		# Material file
+		materialpath = 'flat.mtl'
+		f = open(materialpath, 'w')
+		print('newmtl Default', file=f)
+		print('  Ka 1.0 1.0 1.0', file=f) # ambient color
+		print('  Kd 1.0 1.0 1.0', file=f) # diffuse color
+		print('  Ks 0.0 0.0 0.0', file=f) # specular color
+		print('   d 1.0', file=f)  # "dissolved" == opacity
+		print('  Ni 1.0', file=f)  # optical density
+		print('  illum 2', file=f) # illumination model
+		print(f'  map_Ka {texturepath}', file=f) # ambient texture
+		print(f'  map_Kd {texturepath}', file=f) # diffuse texture
+		print(f'  map_Ks {texturepath}', file=f) # specular texture
+		print(f'  map_Ns {texturepath}', file=f) # specular highlight texture
+		f.close()
+
+		# Obj file
+		#
+		# 1 - 2
+		# | \ | : 1,4,2 : 1,3,4
+		# 3 - 4
+		#
+		v1 = [args.lon[0], args.lat[1], 0]
+		v2 = [args.lon[1], args.lat[1], 0]
+		v3 = [args.lon[0], args.lat[0], 0]
+		v4 = [args.lon[1], args.lat[0], 0]
+
+		f1, f2 = [1,4,2], [1,3,4]
+
+		f = open('flat.obj', 'w')
+		print(f'mtllib {materialpath}', file=f)
+		print(f'usemtl Default', file=f)
+
+		print(f'v {v1[0]:.6f} {v1[1]:.6f} {v1[2]:.6f}', file=f)
+		print(f'v {v2[0]:.6f} {v2[1]:.6f} {v2[2]:.6f}', file=f)
+		print(f'v {v3[0]:.6f} {v3[1]:.6f} {v3[2]:.6f}', file=f)
+		print(f'v {v4[0]:.6f} {v4[1]:.6f} {v4[2]:.6f}', file=f)
+
+		print(f'vt {0.0:.6f} {1.0:.6f}', file=f)
+		print(f'vt {1.0:.6f} {1.0:.6f}', file=f)
+		print(f'vt {0.0:.6f} {0.0:.6f}', file=f)
+		print(f'vt {1.0:.6f} {0.0:.6f}', file=f)
+
+		print(f'f {" ".join([f"{idx}/{idx}" for idx in f1])}', file=f)
+		print(f'f {" ".join([f"{idx}/{idx}" for idx in f2])}', file=f)
+		f.close()
+
+	report.stage('cache_close')
+	cache.close()
+	report.finish()
+
+	print('Done.')
+
+	return texturepath
+
+#
+# Library interface, e.g.:
+#
+#   fetch_tiles.fetch('usgs', (35.9443, 36.2990), (-112.2772, -112.0149), 13, combine = True, cache_db = 'tiles.db')
+#
+# Options are named as the command line options without the leading "-", and
+# have the same defaults. Returns the path of the cropped texture image, or
+# None if not combined. As with the command line script, errors are reported
+# and sys.exit() called, so callers processing many regions should catch
+# SystemExit.
+#
+def fetch(src: str, lat: (float,float), lon: (float,float), zoom: int, report: RunReport = None, **options) -> str:
+	args = make_args(parser, ['-src', src, '-lat', *lat, '-lon', *lon, '-zoom', zoom], options)
+	return run(args, report)
+
+def main():
+	tee_stdout = Tee('stdout.txt', 'w', 'stdout')
+	tee_stderr = Tee('stderr.txt', 'w', 'stderr')
+
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
+
+	args = parser.parse_args()
+
+	report = RunReport('fetch_tiles.py')
+	if args.report != None: report.write_at_exit(args.report)
+	if args.profile != None: profile_to(args.profile)
+
+	print()
+	print(f'Run at: {time.asctime()}')
+	print(f'Run as: {" ".join(sys.argv)}')
+
+	run(args, report)
+
+if __name__ == '__main__':
+	main()
@@ -1,8 +1,10 @@
 # Author: John Grime.
 
-import sys, argparse, requests, time
+import sys, os, argparse, time, shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from util import Tee, stream_to_file
+from util import Tee, stream_to_file, make_args
+from metrics import RunReport, profile_to
 
 import geotiff
 
@@ -12,9 +14,6 @@ outputs = geotiff.Downloader.outputs
 src_arg_txt = ', '.join([f'{k} = {sources[k]["desc"]}' for k in sources])
 out_arg_txt = ', '.join([f'{k} = {outputs[k]["desc"]}' for k in outputs])
 
-tee_stdout = Tee('stdout.txt', 'w', 'stdout')
-tee_stderr = Tee('stderr.txt', 'w', 'stderr')
-
 parser = argparse.ArgumentParser( description='', epilog='' )
 
 opts = parser.add_argument_group('Region of interest')
@@ -39,46 +38,207 @@ opts.add_argument('-file', required = False, type = str,
 	default = 'output',
 	help = 'Output file path prefix')
 
-if len(sys.argv)<2:
-	parser.parse_args([sys.argv[0], '-h'])
+opts = parser.add_argument_group('Data caching')
+
+opts.add_argument('-dem_cache', required = False, type = str,
+	help = 'Directory in which to cache downloaded data; requests for the same region, or a region inside a previously downloaded GeoTIFF, are served from the cache')
+
+opts.add_argument('-dem_cache_mb', required = False, type = float,
+	help = 'Remove least recently used files from -dem_cache to keep it under this size (MiB)')
+
+opts = parser.add_argument_group('Downloading')
+
+opts.add_argument('-retries', required = False, type = int,
+	default = 5,
+	help = 'Number of times to retry a failed request (on rate limiting, server or connection errors)')
+
+opts.add_argument('-backoff', required = False, type = float,
+	default = 0.5,
+	help = 'Base delay (seconds) between retries, doubled for each successive retry')
 
-args = parser.parse_args()
+opts.add_argument('-chunk_deg', required = False, type = float,
+	help = 'Split region into sub-regions no larger than this (degrees) on each side, download them separately and merge them (GTiff only)')
 
-if args.lon[0] > args.lon[1]:
-	print('Please enter longitudes in ASCENDING order.')
-	sys.exit(-1)
+opts.add_argument('-workers', required = False, type = int,
+	default = 4,
+	help = 'Number of sub-regions to download concurrently with -chunk_deg')
 
-if args.lat[0] > args.lat[1]:
-	print('Please enter latitudes in ASCENDING order.')
-	sys.exit(-1)
+opts = parser.add_argument_group('Instrumentation')
+
+opts.add_argument('-report', required = False, type = str,
+	help = 'Write a JSON run report (stage timings, bytes downloaded, cache hits, peak memory) to this file')
+
+opts.add_argument('-profile', required = False, type = str,
+	help = 'Profile the run with cProfile, saving the statistics to this file')
 
 #
-# Fetch elevation data
+# Download elevation data as specified by args (as parsed from the command line
+# options above), returning the path of the output file. Progress and run
+# statistics are recorded in report, if given.
 #
+def run(args, report: RunReport = None) -> str:
+	if report == None: report = RunReport('fetch_topography.py')
 
-r = geotiff.Downloader.get_request(args.src,
-	args.lat[0], args.lon[0],
-	args.lat[1], args.lon[1],
-	args.out_fmt)
+	if args.lon[0] > args.lon[1]:
+		print('Please enter longitudes in ASCENDING order.')
+		sys.exit(-1)
+
+	if args.lat[0] > args.lat[1]:
+		print('Please enter latitudes in ASCENDING order.')
+		sys.exit(-1)
+
+	if (args.chunk_deg != None) and (args.out_fmt != 'GTiff'):
+		print('-chunk_deg requires -out_fmt GTiff.')
+		sys.exit(-1)
+
+	if (args.chunk_deg != None) and (args.chunk_deg <= 0):
+		print('-chunk_deg must be positive.')
+		sys.exit(-1)
+
+	#
+	# Fetch elevation data
+	#
+
+	out_path = args.file + '.' + outputs[args.out_fmt]['suffix']
 
-if r.status_code == 404:
-	print()
-	print(f'{r.url} : not found! Stopping here.')
-	print(r)
 	print()
-	sys.exit(-1)
+	print(f'Fetching {outputs[args.out_fmt]["desc"]} from {sources[args.src]["desc"]} ...')
+
+	request = (args.src, args.lat[0], args.lon[0], args.lat[1], args.lon[1], args.out_fmt)
+
+	dem_cache = None
+	if args.dem_cache != None:
+		report.stage('dem_cache')
+		max_bytes = None if args.dem_cache_mb == None else int(args.dem_cache_mb*1024*1024)
+		dem_cache = geotiff.DEMCache(args.dem_cache, max_bytes)
+
+		entry = dem_cache.fetch(*request, out_path)
+		if entry != None:
+			report.count('dem_cache_hits')
+			print(f'Cached: {entry} => {out_path}')
+			print()
+			report.finish()
+			print('Done.')
+			return out_path
+		report.count('dem_cache_misses')
+
+	report.stage('download')
+
+	if args.chunk_deg == None:
+		geotiff.Downloader.configure_session(retries = args.retries, backoff = args.backoff)
+
+		r = geotiff.Downloader.get_request(args.src,
+			args.lat[0], args.lon[0],
+			args.lat[1], args.lon[1],
+			args.out_fmt)
+
+		if r.status_code != 200:
+			print()
+			print(f'{r.url} : HTTP status {r.status_code}! Stopping here.')
+			print(r)
+			print()
+			sys.exit(-1)
+
+		print(f'{r.url} => {out_path}')
+		print()
+
+		report.count('bytes_downloaded', stream_to_file(r, out_path))
+
+	#
+	# Download region as separate chunks into a directory alongside the output
+	# file, then merge them. Chunk file names encode the source and sub-region,
+	# so chunks already present from an interrupted run are not fetched again.
+	#
+	else:
+		chunks = geotiff.Downloader.split_bbox(args.lat[0], args.lon[0], args.lat[1], args.lon[1], args.chunk_deg)
+
+		chunk_dir = out_path + '.chunks'
+		os.makedirs(chunk_dir, exist_ok = True)
+
+		def chunk_path(chunk):
+			lat0, lon0, lat1, lon1 = chunk
+			return os.path.join(chunk_dir, f'{args.src}_{lat0:.6f}_{lon0:.6f}_{lat1:.6f}_{lon1:.6f}.tiff')
+
+		missing = [c for c in chunks if not os.path.isfile(chunk_path(c))]
+		report.set('n_chunks', len(chunks))
+		report.count('chunks_already_downloaded', len(chunks)-len(missing))
+
+		print(f'{len(chunks)} chunks of at most {args.chunk_deg} degrees; {len(chunks)-len(missing)} already downloaded into {chunk_dir}')
+		print()
+
+		workers = max(1, args.workers)
+		geotiff.Downloader.configure_session(pool_size = workers, retries = args.retries, backoff = args.backoff)
+
+		def fetch_chunk(chunk):
+			ok = geotiff.Downloader.download(args.src, *chunk, args.out_fmt, chunk_path(chunk), update_bytes = 16*1024*1024)
+			if ok: report.count('bytes_downloaded', os.path.getsize(chunk_path(chunk)))
+			return chunk, ok
+
+		failed, n = [], len(chunks)-len(missing)
+		with ThreadPoolExecutor(max_workers = workers) as pool:
+			for future in as_completed([pool.submit(fetch_chunk, c) for c in missing]):
+				chunk, ok = future.result()
+				n += 1
+				if ok == False: failed.append(chunk)
+				report.count('chunks_downloaded' if ok else 'chunks_failed')
+				print(f'  {chunk_path(chunk)} : {n}/{len(chunks)}{"" if ok else " FAILED"}')
+
+		if len(failed) > 0:
+			print()
+			print(f'{len(failed)} chunk(s) could not be downloaded; run again to retry them. Stopping here.')
+			print()
+			sys.exit(-1)
+
+		print()
+		print(f'Merging {len(chunks)} chunks => {out_path} ...')
+		report.stage('merge')
+		geotiff.Downloader.merge([chunk_path(c) for c in chunks], out_path)
+
+		shutil.rmtree(chunk_dir)
+
+	if dem_cache != None:
+		report.stage('dem_cache_store')
+		dem_cache.store(*request, out_path)
+
+	report.set('output_bytes', os.path.getsize(out_path))
+	report.finish()
+
+	print('Done.')
+
+	return out_path
 
+#
+# Library interface, e.g.:
+#
+#   fetch_topography.fetch('SRTMGL3', (35.9443, 36.2990), (-112.2772, -112.0149), file = 'topography', dem_cache = 'dem_cache')
+#
+# Options are named as the command line options without the leading "-", and
+# have the same defaults. Returns the path of the output file. As with the
+# command line script, errors are reported and sys.exit() called, so callers
+# processing many regions should catch SystemExit.
+#
+def fetch(src: str, lat: (float,float), lon: (float,float), report: RunReport = None, **options) -> str:
+	args = make_args(parser, ['-src', src, '-lat', *lat, '-lon', *lon], options)
+	return run(args, report)
+
+def main():
+	tee_stdout = Tee('stdout.txt', 'w', 'stdout')
+	tee_stderr = Tee('stderr.txt', 'w', 'stderr')
+
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
 
-out_path = args.file + '.' + outputs[args.out_fmt]['suffix']
+	args = parser.parse_args()
 
-print()
-print(f'Run at: {time.asctime()}')
-print(f'Run as: {" ".join(sys.argv)}')
-print()
-print(f'Fetching {outputs[args.out_fmt]["desc"]} from {sources[args.src]["desc"]} ...')
-print(f'{r.url} => {out_path}')
-print()
+	report = RunReport('fetch_topography.py')
+	if args.report != None: report.write_at_exit(args.report)
+	if args.profile != None: profile_to(args.profile)
+
+	print()
+	print(f'Run at: {time.asctime()}')
+	print(f'Run as: {" ".join(sys.argv)}')
 
-stream_to_file(r, out_path)
+	run(args, report)
 
-print('Done.')
+if __name__ == '__main__':
+	main()
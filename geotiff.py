@@ -1,11 +1,17 @@
 # Author: John Grime.
 
-import requests
+import sys
+
+from util import make_session
 
 class Downloader:
 
 	base_url = 'https://portal.opentopography.org/API/globaldem'
 
+	# Shared HTTP session; replace via configure_session() to change settings
+	session, session_settings = None, None
+	timeout = (30, 300) # connect, read (seconds)
+
 	sources = {
 		'SRTMGL1': {
 			'desc': 'Shuttle Radar Topography Mission GL1 (Global 30m)',
@@ -40,9 +46,21 @@ class Downloader:
 		},
 	}
 
+	@staticmethod
+	def configure_session(pool_size: int = 4, retries: int = 5, backoff: float = 0.5):
+		# Keep existing session (and its open connections) if settings unchanged
+		settings = (pool_size, retries, backoff)
+		if (Downloader.session != None) and (Downloader.session_settings == settings): return
+
+		Downloader.session = make_session(pool_size, retries, backoff)
+		Downloader.session_settings = settings
+
 	@staticmethod
 	def get_request(src: str, lat0: float, lon0: float, lat1: float, lon1: float, out_fmt: str):
-		return requests.get(Downloader.base_url, stream = True, params = {
+		if Downloader.session == None:
+			Downloader.configure_session()
+
+		return Downloader.session.get(Downloader.base_url, stream = True, timeout = Downloader.timeout, params = {
 			'demtype': src,
 			'west': lon0,
 			'east': lon1,
@@ -51,15 +69,295 @@ class Downloader:
 			'outputFormat': out_fmt,
 			})
 
+	#
+	# Split a bounding box into a grid of equal sub-boxes no larger than
+	# chunk_deg degrees on either side. Returns list of (lat0, lon0, lat1, lon1)
+	# in row order; adjacent sub-boxes share their edges exactly.
+	#
+	@staticmethod
+	def split_bbox(lat0: float, lon0: float, lat1: float, lon1: float, chunk_deg: float) -> list:
+		import math
+
+		n_lat = max(1, math.ceil((lat1-lat0)/chunk_deg - 1e-9))
+		n_lon = max(1, math.ceil((lon1-lon0)/chunk_deg - 1e-9))
+
+		lats = [lat0 + i*(lat1-lat0)/n_lat for i in range(n_lat)] + [lat1]
+		lons = [lon0 + j*(lon1-lon0)/n_lon for j in range(n_lon)] + [lon1]
+
+		return [(lats[i], lons[j], lats[i+1], lons[j+1]) for i in range(n_lat) for j in range(n_lon)]
+
+	#
+	# Download data for the specified region into out_path. Data is written
+	# under a temporary name and renamed on completion, so an interrupted
+	# download never leaves a partial file. Safe to call from multiple threads.
+	# Returns True on success, False otherwise.
+	#
+	@staticmethod
+	def download(src: str, lat0: float, lon0: float, lat1: float, lon1: float, out_fmt: str,
+		out_path: str, update_bytes: int = 256*1024) -> bool:
+		import os, threading, requests
+		from util import stream_to_file
+
+		tmp_path = f'{out_path}.{threading.get_ident()}.part'
+
+		try:
+			r = Downloader.get_request(src, lat0, lon0, lat1, lon1, out_fmt)
+			if r.status_code != 200:
+				print(f'{r.url} : HTTP status {r.status_code}')
+				r.close()
+				return False
+
+			stream_to_file(r, tmp_path, update_bytes = update_bytes)
+			os.replace(tmp_path, out_path)
+
+		except requests.RequestException as e:
+			print(f'{Downloader.base_url} : {e}')
+			if os.path.isfile(tmp_path): os.remove(tmp_path)
+			return False
+
+		return True
+
+	#
+	# Merge several GeoTIFF files into one; where files overlap, data from the
+	# file earliest in the list is used. The output is written block-wise, so
+	# the merged data need not fit in memory, under a temporary name which is
+	# renamed on completion.
+	#
+	@staticmethod
+	def merge(paths: [str], out_path: str):
+		import os
+		import rasterio
+		from rasterio.merge import merge
+
+		tmp_path = f'{out_path}.{os.getpid()}.tmp'
+		dst_kwds = {'driver': 'GTiff', 'compress': 'deflate', 'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+
+		files = [rasterio.open(p) for p in paths]
+		try:
+			merge(files, dst_path = tmp_path, dst_kwds = dst_kwds)
+		finally:
+			for f in files: f.close()
+
+		os.replace(tmp_path, out_path)
+
+
+#
+# On-disk cache of downloaded DEM files, keyed by (demtype, bbox, format). Each
+# file is stored under a name derived from a hash of its key, with an index of
+# entries in index.json. A GeoTIFF request can also be satisfied by cropping a
+# cached GeoTIFF whose region contains the requested region. If max_bytes is
+# specified, least recently used files are removed to keep the cache under
+# that size.
+#
+# The index is rewritten under a temporary name and renamed, so it's always
+# valid. Before rewriting, entries added by other processes sharing the cache
+# since it was read are merged in (under a lock file, where supported), so
+# concurrent runs don't lose each others' entries.
+#
+class DEMCache:
+
+	def __init__(self, cache_dir: str, max_bytes: int = None):
+		import os, json
+
+		self.cache_dir, self.max_bytes = cache_dir, max_bytes
+		self.index_path = os.path.join(cache_dir, 'index.json')
+
+		if os.path.isdir(cache_dir) == False:
+			try:
+				os.makedirs(cache_dir)
+			except OSError:
+				print(f'Unable to create DEM cache directory "{cache_dir}"; halting here.');
+				sys.exit(-1)
+
+		self.index, self.removed = self.load_index(), set()
+
+	def load_index(self) -> dict:
+		import os, json
+
+		if not os.path.isfile(self.index_path): return {}
+		with open(self.index_path) as f:
+			return json.load(f)
+
+	@staticmethod
+	def make_key(src: str, lat0: float, lon0: float, lat1: float, lon1: float, out_fmt: str) -> str:
+		import hashlib
+		s = f'{src}|{lat0:.6f}|{lon0:.6f}|{lat1:.6f}|{lon1:.6f}|{out_fmt}'
+		return hashlib.sha1(s.encode()).hexdigest()
+
+	def save_index(self):
+		import os, json
+
+		with open(self.index_path + '.lock', 'w') as lock:
+			try:
+				import fcntl
+				fcntl.flock(lock, fcntl.LOCK_EX)
+			except ImportError:
+				pass # no locking on e.g. Windows; concurrent updates may be lost
+
+			# Our own entries take precedence over those on disk
+			index = self.load_index()
+			for key in self.removed: index.pop(key, None)
+			index.update(self.index)
+			self.index = index
+
+			tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+			with open(tmp_path, 'w') as f:
+				json.dump(self.index, f, indent = 1)
+			os.replace(tmp_path, self.index_path)
+
+	#
+	# Write data for the request into out_path, if possible. Returns a string
+	# describing the cache entry used, or None if the request can't be served
+	# from the cache.
+	#
+	def fetch(self, src: str, lat0: float, lon0: float, lat1: float, lon1: float, out_fmt: str, out_path: str):
+		import os, time, shutil
+
+		eps = 1e-9
+
+		# Exact match?
+		key = DEMCache.make_key(src, lat0, lon0, lat1, lon1, out_fmt)
+		entry = self.index.get(key)
+		if (entry != None) and os.path.isfile(os.path.join(self.cache_dir, entry['file'])):
+			shutil.copyfile(os.path.join(self.cache_dir, entry['file']), out_path)
+
+		# Smallest cached GeoTIFF containing the requested region?
+		elif out_fmt == 'GTiff':
+			key, best_area = None, None
+			for k, e in self.index.items():
+				if (e['src'] != src) or (e['out_fmt'] != out_fmt): continue
+				b = e['bbox'] # lat0, lon0, lat1, lon1
+				if (b[0] > lat0+eps) or (b[1] > lon0+eps) or (b[2] < lat1-eps) or (b[3] < lon1-eps): continue
+				if not os.path.isfile(os.path.join(self.cache_dir, e['file'])): continue
+				area = (b[2]-b[0])*(b[3]-b[1])
+				if (best_area == None) or (area < best_area): key, best_area = k, area
+
+			if key == None: return None
+			entry = self.index[key]
+			DEMCache.crop(os.path.join(self.cache_dir, entry['file']), lat0, lon0, lat1, lon1, out_path)
+
+		else:
+			return None
+
+		entry['atime'] = time.time()
+		self.save_index()
+		return f'{entry["src"]} {entry["bbox"]} {entry["out_fmt"]} ({entry["file"]})'
+
+	#
+	# Copy the file at path into the cache as the data for the specified
+	# request, then evict old entries if needed.
+	#
+	def store(self, src: str, lat0: float, lon0: float, lat1: float, lon1: float, out_fmt: str, path: str):
+		import os, time, shutil
+
+		key = DEMCache.make_key(src, lat0, lon0, lat1, lon1, out_fmt)
+		fname = key + '.' + Downloader.outputs[out_fmt]['suffix']
+		cache_path = os.path.join(self.cache_dir, fname)
+
+		tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+		shutil.copyfile(path, tmp_path)
+		os.replace(tmp_path, cache_path)
+
+		self.index[key] = {
+			'src': src,
+			'bbox': [lat0, lon0, lat1, lon1],
+			'out_fmt': out_fmt,
+			'file': fname,
+			'size': os.path.getsize(cache_path),
+			'atime': time.time(),
+		}
+
+		self.evict()
+		self.save_index()
+
+	# Remove least recently used entries until the cache is under max_bytes
+	def evict(self):
+		import os
+
+		if self.max_bytes == None: return
+
+		total = sum([e['size'] for e in self.index.values()])
+		for key in sorted(self.index, key = lambda k: self.index[k]['atime']):
+			if total <= self.max_bytes: break
+
+			entry = self.index.pop(key)
+			self.removed.add(key)
+			path = os.path.join(self.cache_dir, entry['file'])
+			if os.path.isfile(path): os.remove(path)
+			total -= entry['size']
+			print(f'Evicted {entry["src"]} {entry["bbox"]} {entry["out_fmt"]} from DEM cache')
+
+	#
+	# Write the part of a GeoTIFF covering the specified region into out_path.
+	# The region is rounded outwards to whole pixels, as for data served by
+	# the remote source.
+	#
+	@staticmethod
+	def crop(path: str, lat0: float, lon0: float, lat1: float, lon1: float, out_path: str):
+		import math
+		import rasterio
+		from rasterio.windows import Window
+
+		eps = 1e-6 # pixels
+
+		with rasterio.open(path) as src:
+			inv = ~src.transform
+			c0, r0 = inv * (lon0, lat1) # top left
+			c1, r1 = inv * (lon1, lat0) # bottom right
+
+			c0, r0 = max(0, math.floor(c0+eps)), max(0, math.floor(r0+eps))
+			c1, r1 = min(src.width, math.ceil(c1-eps)), min(src.height, math.ceil(r1-eps))
+			window = Window(c0, r0, max(1,c1-c0), max(1,r1-r0))
+
+			profile = src.profile.copy()
+			profile.update({
+				'width': window.width,
+				'height': window.height,
+				'transform': src.window_transform(window),
+			})
+			if profile.get('tiled', False):
+				profile.update({'blockxsize': 256, 'blockysize': 256})
+			else:
+				profile.pop('blockxsize', None)
+				profile.pop('blockysize', None)
+
+			with rasterio.open(out_path, 'w', **profile) as dst:
+				dst.write(src.read(window = window))
+
 
 class Interpolator:
 
-	def __init__(self, fpath: str, scale: float = None, how: str = 'cubic'):
+	#
+	# If bbox = (x0,y0, x1,y1) is given (in the same coords as interpolate()),
+	# only the window of the lattice covering that region is read from the file,
+	# plus a halo of extra points on each side for the interpolation stencil.
+	# Memory use then scales with the region rather than the file. Linear and
+	# nearest interpolation inside bbox are unaffected by the windowing; higher
+	# order splines differ negligibly provided the halo is a few points wide.
+	#
+	# If memmap is True, the first band is converted (once) into a raw .npy
+	# file which is then memory-mapped, so only the pages touched by sampling
+	# are read and several processes working on the same file share the OS
+	# page cache. The .npy file is placed in memmap_dir, or alongside the
+	# GeoTIFF if not specified, and is regenerated if older than the GeoTIFF.
+	# Rescaling is not supported with memmap.
+	#
+	def __init__(self, fpath: str, scale: float = None, how: str = 'cubic',
+		bbox: (float,float,float,float) = None, halo: int = 8,
+		memmap: bool = False, memmap_dir: str = None):
 		# Only require these modules if we actually need them; the geotiff downloader
 		# class does not, but the interpolator does.
 		import rasterio
 		import numpy as np
-		from scipy import ndimage
+		from rasterio.windows import Window
+
+		if memmap and scale != None:
+			print('Rescaling not supported with memory-mapped GeoTIFF data; reading into memory')
+			memmap = False
+
+		self.npy_path = None
+		if memmap:
+			self.npy_path = Interpolator.band_to_npy(fpath, memmap_dir)
 
 		with rasterio.open(fpath) as geotiff:
 			# Store some info from the *original* file metadata for future
@@ -70,6 +368,12 @@ class Interpolator:
 			print(f'File contains {geotiff.count} band(s), using first ...')
 			self.bnd = geotiff.bounds
 
+			self.Lx = self.bnd.right - self.bnd.left
+			self.Ly = self.bnd.top - self.bnd.bottom
+
+			# Dimensions of the (possibly rescaled) lattice used for coordinates.
+			# Note: actual scaling performed may not exactly match that
+			# requested due to integer row/width values.
 			if scale != None:
 				if how == 'nearest':
 					algo = rasterio.enums.Resampling.nearest
@@ -78,22 +382,79 @@ class Interpolator:
 				elif how == 'cubic':
 					algo = rasterio.enums.Resampling.cubic
 				else:
-					print('Unknown resampling algorithm "{how}"; using cubic')
-					algo = Resampling.cubic
+					print(f'Unknown resampling algorithm "{how}"; using cubic')
+					algo = rasterio.enums.Resampling.cubic
+
+				self.Nx, self.Ny = int(self.Nx_*scale), int(self.Ny_*scale)
+			else:
+				self.Nx, self.Ny = self.Nx_, self.Ny_
 
-				out_shape = (geotiff.count, int(Ny*scale), int(Nx*scale))
-				data = geotiff.read(out_shape=out_shape, resampling=algo)
-				self.data = data[0] # only use first band
+			# Offset of self.data into the lattice, and its size
+			self.col0_, self.row0_, n_cols, n_rows = 0, 0, self.Nx, self.Ny
+			if bbox != None:
+				self.col0_, self.row0_, n_cols, n_rows = self.lattice_window(bbox, halo)
 
-				# Note: actual scaling performed may not exactly match that
-				# requested due to integer row/width values.
+			# Corresponding window into the file, in original pixels
+			sx, sy = self.Nx_/self.Nx, self.Ny_/self.Ny
+			window = Window(self.col0_*sx, self.row0_*sy, n_cols*sx, n_rows*sy)
 
+			if memmap:
+				data = np.load(self.npy_path, mmap_mode='r')
+				self.data = data[self.row0_:self.row0_+n_rows, self.col0_:self.col0_+n_cols]
+			elif scale != None:
+				self.data = geotiff.read(1, window=window, out_shape=(n_rows, n_cols), resampling=algo)
 			else:
-				self.data = geotiff.read(1) # only use first band
+				self.data = geotiff.read(1, window=window) # only use first band
+
+	#
+	# Convert first band of GeoTIFF into a .npy file, one block at a time so the
+	# whole band is never held in memory. Returns path of the .npy file; if it
+	# already exists and is newer than the GeoTIFF, it is reused. The file is
+	# written under a temporary name and then renamed, so concurrent runs never
+	# see a partial file.
+	#
+	@staticmethod
+	def band_to_npy(fpath: str, out_dir: str = None) -> str:
+		import os
+		import rasterio
+		import numpy as np
+
+		d, f = os.path.split(fpath)
+		npy_path = os.path.join(out_dir if out_dir != None else d, f + '.band1.npy')
+
+		if os.path.isfile(npy_path) and os.path.getmtime(npy_path) >= os.path.getmtime(fpath):
+			return npy_path
+
+		print(f'Converting first band of {fpath} => {npy_path} ...')
+
+		tmp_path = f'{npy_path}.{os.getpid()}.tmp'
+		with rasterio.open(fpath) as geotiff:
+			out = np.lib.format.open_memmap(tmp_path, mode='w+',
+				dtype=geotiff.dtypes[0], shape=(geotiff.height, geotiff.width))
+			for _, window in geotiff.block_windows(1):
+				r0, c0 = window.row_off, window.col_off
+				out[r0:r0+window.height, c0:c0+window.width] = geotiff.read(1, window=window)
+			out.flush()
+			del out
+
+		os.replace(tmp_path, npy_path)
+		return npy_path
 
-		self.Ny, self.Nx = self.data.shape
-		self.Lx = self.bnd.right - self.bnd.left
-		self.Ly = self.bnd.top - self.bnd.bottom
+	#
+	# Lattice window (col0, row0, n_cols, n_rows) covering bbox = (x0,y0, x1,y1)
+	# plus a halo of extra points on each side, clipped to the lattice.
+	#
+	def lattice_window(self, bbox: (float,float,float,float), halo: int = 0) -> (int,int,int,int):
+		import math
+
+		x0, y0, x1, y1 = bbox
+		c0, c1 = [(self.Nx-1) * (x-self.bnd.left)/self.Lx for x in sorted((x0,x1))]
+		r0, r1 = [(self.Ny-1) * (y-self.bnd.bottom)/self.Ly for y in sorted((y0,y1))]
+
+		clip = lambda v, v0, v1: min(max(v0,v),v1)
+		c0, r0 = clip(math.floor(c0)-halo, 0, self.Nx-1), clip(math.floor(r0)-halo, 0, self.Ny-1)
+		c1, r1 = clip(math.ceil(c1)+halo+1, c0+1, self.Nx), clip(math.ceil(r1)+halo+1, r0+1, self.Ny)
+		return c0, r0, c1-c0, r1-r0
 
 	# scipy.interpolate is incredibly slow, so use ndimage.map_coordinates
 	# https://stackoverflow.com/questions/33259896/python-interpolation-2d-array-for-huge-arrays/33261924#33261924
@@ -109,6 +470,45 @@ class Interpolator:
 		else:
 			col = (self.Nx-1) * (x-self.bnd.left)/self.Lx
 			row = (self.Ny-1) * (y-self.bnd.bottom)/self.Ly
+		col, row = col-self.col0_, row-self.row0_ # relative to data window
 		return ndimage.map_coordinates(self.data, [[row],[col]], output=np.float32, order=order)
 
+	# As interpolate(), but samples arrays of x and y coords (broadcast against
+	# each other) with a single map_coordinates call; returns array of the
+	# broadcast shape.
+	def interpolate_many(self, x, y, normalized_coords: bool = False, order: int = 1):
+		import numpy as np
+		from scipy import ndimage
+
+		x, y = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+
+		if (normalized_coords == True):
+			col = (self.Nx-1) * x
+			row = (self.Ny-1) * y
+		else:
+			col = (self.Nx-1) * (x-self.bnd.left)/self.Lx
+			row = (self.Ny-1) * (y-self.bnd.bottom)/self.Ly
+		col, row = col-self.col0_, row-self.row0_ # relative to data window
+
+		coords = np.stack((row.ravel(), col.ravel()))
+		z = ndimage.map_coordinates(self.data, coords, output=np.float32, order=order)
+		return z.reshape(x.shape)
+
+	# Sample the lattice defined by 1D arrays of x and y coords; returns array
+	# of shape (len(ys), len(xs)), i.e. z[i,j] is the sample at (xs[j], ys[i]).
+	# Rows are processed in blocks to bound the size of temporary arrays.
+	def interpolate_grid(self, xs, ys, normalized_coords: bool = False, order: int = 1, block_points: int = 1024*1024):
+		import numpy as np
+
+		xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+		z = np.empty((len(ys), len(xs)), dtype=np.float32)
+
+		block_rows = max(1, block_points//max(1,len(xs)))
+		for i in range(0, len(ys), block_rows):
+			y = ys[i:i+block_rows]
+			z[i:i+len(y)] = self.interpolate_many(
+				xs[np.newaxis,:], y[:,np.newaxis],
+				normalized_coords = normalized_coords, order = order)
+		return z
+
 
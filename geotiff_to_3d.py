@@ -13,10 +13,21 @@
 # topographical data from the same underlying GeoTIFF (or whatever).
 #
 
-import sys, time, argparse
+import sys, os, time, argparse, shutil, multiprocessing
 
-from util import Tee, latlon_degs_per_m
-import geotiff
+import numpy as np
+
+from util import Tee, WebMercatorArray, latlon_degs_per_m, latlon_row_scales, geodesic_modes, make_args
+from metrics import RunReport, profile_to
+import geotiff, mesh
+
+#
+# Ways of mapping lattice positions onto the texture image
+#
+uv_modes = {
+	'linear':   {'desc': 'proportional to latitude and longitude'},
+	'mercator': {'desc': 'Web Mercator projection, as for images from fetch_tiles.py'},
+}
 
 #
 # Set up arguments
@@ -29,6 +40,12 @@ opts = parser.add_argument_group('Input options')
 opts.add_argument('gtiff',
 	help = 'GeotTIFF input file path')
 
+opts.add_argument('-memmap', action = 'store_true',
+	help = 'Convert GeoTIFF data into a .npy file (once) and memory-map it, rather than reading it into memory')
+
+opts.add_argument('-memmap_dir', type = str,
+	help = 'Directory for .npy file used by -memmap; if not specified, same directory as GeoTIFF')
+
 opts = parser.add_argument_group('Output options')
 
 opts.add_argument('-lat', required = True, type = float, nargs = 2,
@@ -46,9 +63,18 @@ opts.add_argument('-n_samples_y', type = int,
 opts.add_argument('-texture', type = str,
 	help = 'Texture file (triggers use of texture coords etc in output file)')
 
+opts.add_argument('-uv_mode', type = str, default = 'linear', choices = [k for k in uv_modes],
+	help = 'Texture coord mapping; ' + ', '.join([f'{k} = {uv_modes[k]["desc"]}' for k in uv_modes]))
+
+opts.add_argument('-texture_zoom', type = int,
+	help = 'Zoom level of the texture from fetch_tiles.py (256 pixel tiles), so texture coords allow for the texture being cropped to whole pixels; requires -uv_mode mercator')
+
 opts.add_argument('-output', type = str, default = 'output',
 	help = 'Output file prefix')
 
+opts.add_argument('-out_fmt', type = str, default = 'obj', choices = [k for k in mesh.formats],
+	help = 'Output file format; ' + ', '.join([f'{k} = {mesh.formats[k]["desc"]}' for k in mesh.formats]))
+
 opts.add_argument('-z_scale', type = float, default = 1.0,
 	help = 'Scaling applied to z axis (inferred from other dims if omitted)')
 
@@ -64,181 +90,518 @@ opts.add_argument('-z0', type = float, default = 0.0,
 opts.add_argument('-reorder', type = str, default = 'xyz',
 	help = 'Reorder string for axes in output')
 
-#
-# Parse arguments and print some user information
-#
+opts.add_argument('-geodesic', type = str, default = 'central', choices = [k for k in geodesic_modes],
+	help = 'Conversion of lattice positions from degrees to metres; ' + ', '.join([f'{k} = {geodesic_modes[k]["desc"]}' for k in geodesic_modes]))
+
+opts.add_argument('-normals', action = 'store_true',
+	help = 'Include smooth vertex normals in the output (and tangents, for textured .glb output); ignored for .stl, which has face normals')
 
-if len(sys.argv)<2:
-	parser.parse_args([sys.argv[0], '-h'])
+opts.add_argument('-max_error', type = float,
+	help = 'Simplify mesh, using fewer triangles where terrain is smooth, with at most approximately this height error (metres, before -z_scale); if not specified, all lattice points are used')
 
-args = parser.parse_args()
-gti = geotiff.Interpolator(args.gtiff)
+opts.add_argument('-jobs', type = int, default = 1,
+	help = 'Number of processes used to sample elevation data and format output, each working on a band of rows (single mesh without -max_error only)')
 
-print()
-print(f'Run at: {time.asctime()}')
-print(f'Run as: {" ".join(sys.argv)}')
+opts.add_argument('-lod_levels', type = int,
+	help = 'Write a quadtree of mesh tiles with this many levels of detail, plus an index file, rather than a single mesh; level l has 2^l x 2^l tiles, and the finest level uses the full sampling lattice')
 
-min_z, max_z = gti.data.min(), gti.data.max()
+opts = parser.add_argument_group('Instrumentation')
 
-print()
-print(f'GeoTIFF: {args.gtiff}')
-print(f'  Bounds: {gti.bnd.left},{gti.bnd.bottom} -> {gti.bnd.right},{gti.bnd.top}')
-print(f'  Dims: {gti.Nx} x {gti.Ny} ; Resolution: {gti.Lx/gti.Nx} x {gti.Ly/gti.Ny}')
-print(f'  Z range is apparently {min_z} to {max_z}')
+opts.add_argument('-report', type = str,
+	help = 'Write a JSON run report (stage timings, vertex/face counts, bytes written, peak memory) to this file')
 
-print()
-if (args.n_samples_x != None):
-	print(f'{args.n_samples_x} samples on global domain x (longitudinal) axis')
-if (args.n_samples_y != None):
-	print(f'{args.n_samples_y} samples on global domain y (latitudinal) axis')
+opts.add_argument('-profile', type = str,
+	help = 'Profile the run with cProfile, saving the statistics to this file')
 
 #
-# No z scaling specified? Scale to smaller of x or y span
+# Work done by each worker process for -jobs; set before the workers are
+# forked, so they inherit it (functions defined inside run() can't be passed
+# to the worker processes directly).
 #
+band_task_ = None
 
-if args.z_scale == None:
-	z_scale = min(gti.Lx,gti.Ly) / float(max_z-min_z)
-	print(f'Calculated z_scale as {z_scale} from smallest existing dataset dimension ...')
-else:
-	z_scale = args.z_scale
-
-print()
+def run_band_task_(k: int):
+	return band_task_(k)
 
 #
-# Write material file, if needed
+# Generate mesh output as specified by args (as parsed from the command line
+# options above). Returns the path of the mesh file, or of the index file for
+# -lod_levels. Progress and run statistics are recorded in report, if given.
 #
+def run(args, report: RunReport = None) -> str:
+	if report == None: report = RunReport('geotiff_to_3d.py')
 
-if args.texture != None:
-	print('Writing material file...')
-	f = open(args.output + '.mtl', 'w')
-	print('newmtl Default', file=f)
-	print('  Ka 1.0 1.0 1.0', file=f) # ambient color
-	print('  Kd 1.0 1.0 1.0', file=f) # diffuse color
-	print('  Ks 0.0 0.0 0.0', file=f) # specular color
-	print('   d 1.0', file=f)  # "dissolved" == opacity
-	print('  Ni 1.0', file=f)  # optical density
-	print('  illum 2', file=f) # illumination model
-	print(f'  map_Ka {args.texture}', file=f) # ambient texture
-	print(f'  map_Kd {args.texture}', file=f) # diffuse texture
-	print(f'  map_Ks {args.texture}', file=f) # specular texture
-	print(f'  map_Ns {args.texture}', file=f) # specular highlight texture
-	f.close()
+	if (args.texture_zoom != None) and (args.uv_mode != 'mercator'):
+		print('-texture_zoom requires -uv_mode mercator')
+		sys.exit(-1)
 
-#
-# Write .obj file, including reference to material file if needed
-#
+	report.stage('read')
 
-print('Writing .obj file...')
-f = open(args.output + '.obj', 'w')
+	# Only read the part of the GeoTIFF we need; the y coordinates passed to the
+	# interpolator are flipped (see below), but remain in the same range.
+	bbox = (args.lon[0], args.lat[0], args.lon[1], args.lat[1])
+	gti = geotiff.Interpolator(args.gtiff, bbox = bbox, memmap = args.memmap, memmap_dir = args.memmap_dir)
 
-if args.texture != None:
-	print(f'mtllib {args.output + ".mtl"}', file=f)
-	print(f'usemtl Default', file=f)
+	min_z, max_z = gti.data.min(), gti.data.max()
 
-#
-# Generate .obj file
-#
+	print()
+	print(f'GeoTIFF: {args.gtiff}')
+	print(f'  Bounds: {gti.bnd.left},{gti.bnd.bottom} -> {gti.bnd.right},{gti.bnd.top}')
+	print(f'  Dims: {gti.Nx} x {gti.Ny} ; Resolution: {gti.Lx/gti.Nx} x {gti.Ly/gti.Ny}')
+	print(f'  Z range is apparently {min_z} to {max_z}')
 
-print('  vertex positions...')
+	print()
+	if (args.n_samples_x != None):
+		print(f'{args.n_samples_x} samples on global domain x (longitudinal) axis')
+	if (args.n_samples_y != None):
+		print(f'{args.n_samples_y} samples on global domain y (latitudinal) axis')
 
-x0, y0, z0 = args.x0, args.y0, args.z0 # to set local origin, if specified
+	#
+	# No z scaling specified? Scale to smaller of x or y span
+	#
 
-# Global domain information (i.e., from entire GeoTiff) in CAPITAL LATTERS
-NX, NY = gti.Nx, gti.Ny
-if args.n_samples_x != None: NX = args.n_samples_x
-if args.n_samples_y != None: NY = args.n_samples_y
+	if args.z_scale == None:
+		z_scale = min(gti.Lx,gti.Ly) / float(max_z-min_z)
+		print(f'Calculated z_scale as {z_scale} from smallest existing dataset dimension ...')
+	else:
+		z_scale = args.z_scale
 
-LON0, LON1 = gti.bnd.left, gti.bnd.right
-LAT0, LAT1 = gti.bnd.bottom, gti.bnd.top
-LX, LY = LON1-LON0, LAT1-LAT0
+	print()
 
-# Local domain information (i.e., from local satellite image) in lower case letters
+	#
+	# Determine the sampling lattice for the local region
+	#
 
-lat0, lat1 = args.lat[0], args.lat[1]
-lon0, lon1 = args.lon[0], args.lon[1]
-lx, ly = lon1-lon0, lat1-lat0
+	x0, y0, z0 = args.x0, args.y0, args.z0 # to set local origin, if specified
 
-# Start and end columns into discretized GLOBAL domain that cover the
-# local region. Int truncation ensures we encompass the start point,
-# +1 to the end column to ensure we encompass end points. 
+	# Global domain information (i.e., from entire GeoTiff) in CAPITAL LATTERS
+	NX, NY = gti.Nx, gti.Ny
+	if args.n_samples_x != None: NX = args.n_samples_x
+	if args.n_samples_y != None: NY = args.n_samples_y
 
-col0 = int( NX * (lon0-LON0)/LX )
-col1 = int( NX * (lon1-LON0)/LX ) + 1
+	LON0, LON1 = gti.bnd.left, gti.bnd.right
+	LAT0, LAT1 = gti.bnd.bottom, gti.bnd.top
+	LX, LY = LON1-LON0, LAT1-LAT0
 
-row0 = int( NY * (lat0-LAT0)/LY )
-row1 = int( NY * (lat1-LAT0)/LY ) + 1
+	# Local domain information (i.e., from local satellite image) in lower case letters
 
-# Estimate conversion from degs to metres using central latitude. This is not
-# formally correct, as the longitudinal (i.e., x) scaling changes with
-# latitude (y)!
-dLat_degs_per_m, dLon_degs_per_m = latlon_degs_per_m((lat0+lat1)/2)
-dLat_m_per_deg = 1.0/dLat_degs_per_m
-dLon_m_per_deg = 1.0/dLon_degs_per_m
+	lat0, lat1 = args.lat[0], args.lat[1]
+	lon0, lon1 = args.lon[0], args.lon[1]
+	lx, ly = lon1-lon0, lat1-lat0
 
-#
-# Determine axis mapping
-#
+	# Global lattice positions for the local rows and columns, clamped onto the
+	# local bounds, for a global domain discretized into NX x NY samples.
+	def lattice(NX: int, NY: int):
+		# Start and end columns into discretized GLOBAL domain that cover the
+		# local region. Int truncation ensures we encompass the start point,
+		# +1 to the end column to ensure we encompass end points. 
 
-axis_order, axis_id = [0,1,2], {'x': 0, 'y': 1, 'z': 2}
+		col0 = int( NX * (lon0-LON0)/LX )
+		col1 = int( NX * (lon1-LON0)/LX ) + 1
 
-if len(args.reorder) != 3:
-		print(f'Bad axis remap string "{args.reorder}"')
-		sys.exit(-1)
+		row0 = int( NY * (lat0-LAT0)/LY )
+		row1 = int( NY * (lat1-LAT0)/LY ) + 1
 
-for i,axis in enumerate(args.reorder):
-	if axis in axis_id: axis_order[i] = axis_id[axis]
-	else:
-		print(f'Unknown axis identifier "{axis}"')
-		sys.exit(-1)
+		rows, cols = np.arange(row0,row1), np.arange(col0,col1)
+		ys = np.clip(LAT0 + rows * LY/NY, lat0, lat1) # clamp global y pos onto local bounds
+		xs = np.clip(LON0 + cols * LX/NX, lon0, lon1) # clamp global x pos onto local bounds
+		return xs, ys
 
-#
-# Generate vertex positions
-#
-# Note; we build the rows of vertices for the geometry from the "bottom" to
-# the "top" of the domain, so our u,v texture coords are the same (i.e., v in
-# u,v is relative to the bottom of the image)
-#
+	# Estimate conversion from degs to metres using central latitude. This is not
+	# formally correct, as the longitudinal (i.e., x) scaling changes with
+	# latitude (y)! Other -geodesic modes instead use a table of scales for the
+	# rows of the lattice; see positions().
+	dLat_degs_per_m, dLon_degs_per_m = latlon_degs_per_m((lat0+lat1)/2)
+	dLat_m_per_deg = 1.0/dLat_degs_per_m
+	dLon_m_per_deg = 1.0/dLon_degs_per_m
+
+	#
+	# Determine axis mapping
+	#
+
+	axis_order, axis_id = [0,1,2], {'x': 0, 'y': 1, 'z': 2}
+
+	if len(args.reorder) != 3:
+			print(f'Bad axis remap string "{args.reorder}"')
+			sys.exit(-1)
 
-x_idx, y_idx, z_idx = axis_order
+	for i,axis in enumerate(args.reorder):
+		if axis in axis_id: axis_order[i] = axis_id[axis]
+		else:
+			print(f'Unknown axis identifier "{axis}"')
+			sys.exit(-1)
+
+	#
+	# Generate vertex positions
+	#
+	# Note; we build the rows of vertices for the geometry from the "bottom" to
+	# the "top" of the domain, so our u,v texture coords are the same (i.e., v in
+	# u,v is relative to the bottom of the image)
+	#
+
+	x_idx, y_idx, z_idx = axis_order
+
+	# For the per-row -geodesic modes, each row's scale is applied to longitudes
+	# relative to the centre of the region, and the offset of the centre from
+	# x0 uses the scale at the central latitude; scaling longitudes measured
+	# from x0 would shear the mesh unless x0 were near the centre.
+	lon_c, lat_c = (lon0+lon1)/2, (lat0+lat1)/2
+	if args.geodesic != 'central':
+		_, m_per_deg_lon_c = latlon_row_scales([lat_c], y0, args.geodesic == 'wgs84')
+		x_c = (lon_c-x0)*m_per_deg_lon_c[0]
+
+	# Output positions (before axis reordering) of the lattice xs, ys with heights
+	# zs; X broadcasts to the shape of Z along the rows, and Y along the columns.
+	def positions(xs, ys, zs):
+		Z = (zs-z0).astype(np.float64)*z_scale
+
+		if args.geodesic == 'central':
+			X = (xs-x0)[np.newaxis,:]*dLon_m_per_deg
+			Y = (ys-y0)[:,np.newaxis]*dLat_m_per_deg
+		else:
+			Y, m_per_deg_lon = latlon_row_scales(ys, y0, args.geodesic == 'wgs84')
+			X = (xs-lon_c)[np.newaxis,:]*m_per_deg_lon[:,np.newaxis] + x_c
+			Y = Y[:,np.newaxis]
+
+		return X, Y, Z
+
+	# Smooth vertex normals and tangents of the lattice as (n_rows, n_cols, 3)
+	# and (n_rows, n_cols, 4) arrays in the output axis order. Tangents point
+	# along +u; w is the handedness of the output axes, which flips the
+	# direction of +v relative to the normal and tangent if the axes are
+	# reordered by an odd permutation.
+	def lattice_normals(xs, ys, zs):
+		normals, tangents = mesh.grid_normals(*positions(xs, ys, zs))
+
+		w = np.linalg.det(np.eye(3)[axis_order])
+		w = -1.0 if w < 0 else 1.0
+
+		normals = normals[...,axis_order]
+		tangents = np.concatenate((tangents[...,axis_order], np.full(tangents.shape[:-1]+(1,), w)), axis=-1)
+		return normals, tangents
+
+	# Texture coords of the lattice columns xs and rows ys. For -uv_mode mercator,
+	# positions are projected into Web Mercator world coords (or pixels, for
+	# -texture_zoom) relative to the edges of the texture; x and y project
+	# independently, so one projection per row and column suffices.
+	def project(lons, lats):
+		if args.texture_zoom == None:
+			return WebMercatorArray.lonlat_to_world(lons, lats)
+		return WebMercatorArray.lonlat_to_pix(lons, lats, args.texture_zoom)
+
+	if args.uv_mode == 'mercator':
+		tex_x, tex_y = project([lon0,lon1], [lat0,lat1])
+		if args.texture_zoom != None:
+			# fetch_tiles.py crops to pixels whose top left corners are inside the region
+			tex_x, tex_y = np.floor(tex_x), np.floor(tex_y)
+
+	def texture_uvs(xs, ys):
+		if args.uv_mode == 'linear':
+			# local position => normalized u,v coords into texture
+			return (xs-lon0)/lx, (ys-lat0)/ly # y-lat0 as v=0 is texture bottom
 
-clamp = lambda x, x0, x1: min(max(x0,x),x1)
+		wx, _ = project(xs, lat0)
+		_, wy = project(lon0, ys)
 
-for row in range(row0,row1):
-	y = clamp(LAT0 + row * LY/NY, lat0, lat1) # clamp global y pos onto local bounds
+		# Mercator y increases southwards, and tex_y[0] is the bottom (south) edge
+		return (wx-tex_x[0])/(tex_x[1]-tex_x[0]), (tex_y[0]-wy)/(tex_y[0]-tex_y[1])
 
-	for col in range(col0,col1):
-		x = clamp(LON0 + col * LX/NX, lon0, lon1) # clamp global x pos onto local bounds
+	# Vertices, faces and texture coords for the lattice of positions xs, ys with
+	# heights zs, where zs[i,j] is the height at (xs[j],ys[i]). With -normals,
+	# also returns (normals, tangents) for the vertices, else None; ns supplies
+	# these from lattice_normals() for a larger lattice containing this one, so
+	# the normals of separate parts of the lattice match at their edges.
+	def make_mesh(xs, ys, zs, ns = None):
+		X, Y, Z = positions(xs, ys, zs)
 
-		z = gti.interpolate(x, lat1-(y-lat0))
+		R = ( np.broadcast_to(X, Z.shape), np.broadcast_to(Y, Z.shape), Z )
+		verts = np.stack([R[x_idx].ravel(), R[y_idx].ravel(), R[z_idx].ravel()], axis=1)
 
-		r = ( (x-x0)*dLon_m_per_deg, (y-y0)*dLat_m_per_deg, float(z-z0)*z_scale )
-		print(f'v {r[x_idx]:.6f} {r[y_idx]:.6f} {r[z_idx]:.6f}', file=f)
+		if args.normals == True:
+			if ns == None: ns = lattice_normals(xs, ys, zs)
+			ns = (ns[0].reshape(-1,3), ns[1].reshape(-1,4))
 
-		if (args.texture != None):
-			# local position => normalized u,v coords into texture
-			u, v = (x-lon0)/lx, (y-lat0)/ly # y-lat0 as v=0 is texture bottom
-			print(f'vt {u:.6f} {v:.6f}', file=f)
+		uvs = None
+		if args.texture != None:
+			U, V = np.meshgrid(*texture_uvs(xs, ys))
+			uvs = np.stack([U.ravel(), V.ravel()], axis=1)
 
+		if args.max_error == None:
+			faces = mesh.grid_faces(len(ys), len(xs))
+		else:
+			# Error-bounded triangulation of the raw heights; drop unused vertices
+			faces = mesh.rtin_faces(zs, args.max_error)
+			used, faces = mesh.compact(faces, len(verts))
+			verts = verts[used]
+			if args.texture != None: uvs = uvs[used]
+			if ns != None: ns = (ns[0][used], ns[1][used])
+			print(f'Simplified mesh: {len(faces)} triangles ({100.0*len(faces)/(2*(len(ys)-1)*(len(xs)-1)):.1f}% of full lattice), {len(verts)} vertices')
+
+		return verts, faces, uvs, ns
+
+	#
+	# Write output file(s)
+	#
+
+	mtllib = None
+	if (args.out_fmt == 'obj') and (args.texture != None):
+		print('Writing material file...')
+		mtllib = args.output + '.mtl'
+		mesh.write_mtl(mtllib, args.texture)
+
+	def write_mesh(out_path: str, verts, faces, uvs, ns = None):
+		normals, tangents = ns if (ns != None) else (None, None)
+		if uvs is None: tangents = None
+
+		if args.out_fmt == 'obj':
+			print(f'Writing .obj file {out_path} ...')
+			mesh.write_obj(out_path, verts, faces, uvs, mtllib, normals)
+
+		else:
+			print(f'Writing {mesh.formats[args.out_fmt]["desc"]} file {out_path} ...')
+
+			if args.out_fmt == 'ply':
+				mesh.write_ply(out_path, verts, faces, uvs, args.texture, normals)
+			elif args.out_fmt == 'stl':
+				mesh.write_stl(out_path, verts, faces)
+			elif args.out_fmt == 'glb':
+				mesh.write_glb(out_path, verts, faces, uvs, args.texture, normals, tangents)
+
+		report.count('n_vertices', len(verts))
+		report.count('n_faces', len(faces))
+		report.count('bytes_written', os.path.getsize(out_path))
+
+	suffix = mesh.formats[args.out_fmt]['suffix']
+
+	jobs = max(1, args.jobs)
+	if (jobs > 1) and ((args.max_error != None) or (args.lod_levels != None)):
+		print('-jobs is not supported with -max_error or -lod_levels; using a single process')
+		jobs = 1
+
+	if (jobs > 1) and ('fork' not in multiprocessing.get_all_start_methods()):
+		print('-jobs requires support for forking processes; using a single process')
+		jobs = 1
+
+	if (args.lod_levels == None) and (jobs == 1):
+		out_path = args.output + '.' + suffix
+
+		report.stage('sample')
+		xs, ys = lattice(NX, NY)
+		zs = gti.interpolate_grid(xs, lat1-(ys-lat0))
+
+		report.stage('mesh')
+		verts, faces, uvs, ns = make_mesh(xs, ys, zs)
+
+		report.stage('write')
+		write_mesh(out_path, verts, faces, uvs, ns)
+
+	#
+	# As above, but the lattice is split into bands of rows which are sampled in
+	# parallel by forked worker processes; these share the elevation data already
+	# read by the interpolator (or its memory map) rather than each reading it.
+	# For .obj output, each worker also formats the vertex and face records of
+	# its band into temporary files, which are then concatenated in order; face
+	# records are formatted with global vertex indices, so the result is the same
+	# as from a single process; for -normals, each band also samples the rows
+	# either side of it, so normals at the band edges are also the same. Other
+	# formats are written as usual once all the
+	# bands have been sampled.
+	#
+	elif args.lod_levels == None:
+		from concurrent.futures import ProcessPoolExecutor
+
+		out_path = args.output + '.' + suffix
+
+		xs, ys = lattice(NX, NY)
+		n_rows, n_cols = len(ys), len(xs)
+
+		n_bands = min(n_rows, 4*jobs) # more bands than processes, for load balancing
+		bounds = [(n_rows*k)//n_bands for k in range(n_bands+1)]
+
+		def sample_band(k: int, halo: int = 0):
+			r0, r1 = max(0, bounds[k]-halo), min(n_rows, bounds[k+1]+halo)
+			return gti.interpolate_grid(xs, lat1-(ys[r0:r1]-lat0))
+
+		# Vertices of rows r0 to r1-1, and faces of the cells between rows r0 and r1
+		def format_band(k: int):
+			r0, r1 = bounds[k], bounds[k+1]
+
+			ns = None
+			if args.normals == True:
+				h0, h1 = max(0, r0-1), min(n_rows, r1+1)
+				zs = sample_band(k, 1)
+				normals, tangents = lattice_normals(xs, ys[h0:h1], zs)
+				zs, ns = zs[r0-h0:r1-h0], (normals[r0-h0:r1-h0], tangents[r0-h0:r1-h0])
+			else:
+				zs = sample_band(k)
+
+			verts, faces, uvs, ns = make_mesh(xs, ys[r0:r1], zs, ns)
+			faces = mesh.grid_faces(min(r1+1,n_rows)-r0, n_cols).astype(np.int64) + r0*n_cols
+
+			normals = ns[0] if (ns != None) else None
+
+			v_path, f_path = f'{out_path}.{k}.v.part', f'{out_path}.{k}.f.part'
+			with open(v_path, 'wb') as f:
+				mesh.write_obj_verts(f, verts, uvs, normals)
+			with open(f_path, 'wb') as f:
+				mesh.write_obj_faces(f, faces, args.texture != None, args.normals)
+			return v_path, f_path
+
+		print(f'Processing {n_rows} rows as {n_bands} bands using {jobs} processes ...')
+		report.stage('sample_format' if args.out_fmt == 'obj' else 'sample')
+
+		global band_task_
+		band_task_ = format_band if args.out_fmt == 'obj' else sample_band
+		with ProcessPoolExecutor(max_workers = jobs, mp_context = multiprocessing.get_context('fork')) as pool:
+			if args.out_fmt == 'obj':
+				parts = list(pool.map(run_band_task_, range(n_bands)))
+			else:
+				zs = np.concatenate(list(pool.map(run_band_task_, range(n_bands))))
+		band_task_ = None
+
+		report.stage('write')
+		if args.out_fmt == 'obj':
+			print(f'Writing .obj file {out_path} ...')
+			with open(out_path, 'wb') as f:
+				mesh.write_obj_header(f, mtllib)
+				for part in [v for v,_ in parts] + [f for _,f in parts]:
+					with open(part, 'rb') as p:
+						shutil.copyfileobj(p, f, 16*1024*1024)
+					os.remove(part)
+
+			report.count('n_vertices', n_rows*n_cols)
+			report.count('n_faces', 2*(n_rows-1)*(n_cols-1))
+			report.count('bytes_written', os.path.getsize(out_path))
+		else:
+			verts, faces, uvs, ns = make_mesh(xs, ys, zs)
+			write_mesh(out_path, verts, faces, uvs, ns)
+
+	#
+	# Quadtree of tiles. Each level samples the region on a global lattice with
+	# half the resolution of the next level, and splits the resulting lattice
+	# into 2^l x 2^l tiles; adjacent tiles share their edge vertices, so tile
+	# edges at the same level match exactly (as do their normals, which are
+	# found for the level as a whole). Tile (i,j) is the i-th tile along x
+	# (west to east) and j-th along y (south to north). Texture coords are
+	# relative to the whole region, so all tiles share one texture.
+	#
+	else:
+		import json
+
+		out_path = args.output + '.json'
+
+		L = args.lod_levels
+		if L < 1:
+			print(f'Bad number of levels of detail {L}')
+			sys.exit(-1)
+
+		# Tiles are simplified independently, so their edges would not match
+		if args.max_error != None:
+			print('-max_error is not supported with -lod_levels')
+			sys.exit(-1)
+
+		index = {
+			'lat': [lat0, lat1],
+			'lon': [lon0, lon1],
+			'format': args.out_fmt,
+			'texture': args.texture,
+			'uv_mode': args.uv_mode,
+			'origin': [x0, y0, z0],
+			'z_scale': z_scale,
+			'reorder': args.reorder,
+			'geodesic': args.geodesic,
+			'normals': args.normals,
+			'levels': [],
+		}
+
+		for l in range(L):
+			xs, ys = lattice(max(1, NX >> (L-1-l)), max(1, NY >> (L-1-l)))
+			n = 1 << l
+
+			if (len(xs)-1 < n) or (len(ys)-1 < n):
+				print(f'Level {l} has too few samples ({len(xs)} x {len(ys)}) for {n} x {n} tiles; use fewer levels or more samples')
+				sys.exit(-1)
+
+			print(f'Level {l}: {len(xs)} x {len(ys)} samples, {n} x {n} tiles')
+			report.stage(f'level_{l}')
+			zs = gti.interpolate_grid(xs, lat1-(ys-lat0))
+			level_ns = lattice_normals(xs, ys, zs) if (args.normals == True) else None
+
+			# Tile boundaries as lattice indices; boundary rows/cols are shared
+			cb = [round(i*(len(xs)-1)/n) for i in range(n+1)]
+			rb = [round(j*(len(ys)-1)/n) for j in range(n+1)]
+
+			tiles = []
+			for j in range(n):
+				for i in range(n):
+					c0, c1, r0, r1 = cb[i], cb[i+1]+1, rb[j], rb[j+1]+1
+					ns = None
+					if level_ns != None:
+						ns = (level_ns[0][r0:r1,c0:c1], level_ns[1][r0:r1,c0:c1])
+					verts, faces, uvs, ns = make_mesh(xs[c0:c1], ys[r0:r1], zs[r0:r1,c0:c1], ns)
+
+					tile_path = f'{args.output}_L{l}_{i}_{j}.{suffix}'
+					write_mesh(tile_path, verts, faces, uvs, ns)
+
+					tiles.append({
+						'x': i,
+						'y': j,
+						'file': tile_path,
+						'lon': [float(xs[c0]), float(xs[c1-1])],
+						'lat': [float(ys[r0]), float(ys[r1-1])],
+						'z': [float(zs[r0:r1,c0:c1].min()), float(zs[r0:r1,c0:c1].max())],
+						'n_vertices': len(verts),
+						'n_faces': len(faces),
+					})
+
+			index['levels'].append({
+				'level': l,
+				'n_samples': [len(xs), len(ys)],
+				'tiles': tiles,
+			})
+
+		print(f'Writing index file {out_path} ...')
+		with open(out_path, 'w') as f:
+			json.dump(index, f, indent = 1)
+
+	report.finish()
+
+	print('Done.')
+
+	return out_path
+
+#
+# Library interface, e.g.:
 #
-# Triangular faces, including texture coords if needed
+#   geotiff_to_3d.build_mesh('topography.tiff', (35.9443, 36.2990), (-112.2772, -112.0149),
+#     n_samples_x = 500, n_samples_y = 500, output = 'out', texture = 'combined.cropped.jpeg')
 #
+# Options are named as the command line options without the leading "-", and
+# have the same defaults. Returns the path of the mesh file, or of the index
+# file for lod_levels. As with the command line script, errors are reported
+# and sys.exit() called, so callers processing many regions should catch
+# SystemExit. Note that jobs > 1 forks worker processes, which is best avoided
+# from a multi-threaded program.
+#
+def build_mesh(gtiff: str, lat: (float,float), lon: (float,float), report: RunReport = None, **options) -> str:
+	args = make_args(parser, [gtiff, '-lat', *lat, '-lon', *lon], options)
+	return run(args, report)
 
-print('  faces...')
-for row in range((row1-row0)-1):
-	for col in range((col1-col0)-1):
-		a = (row*(col1-col0)) + col
-		b = a+1
-		c = ((row+1)*(col1-col0)) + col
-		d = c+1
+def main():
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
 
-		i1, j1, k1 = a+1, b+1, c+1 # triangle 1
-		i2, j2, k2 = d+1, c+1, b+1 # triangle 2
+	args = parser.parse_args()
 
-		if args.texture != None:
-			print(f'f {i1}/{i1} {j1}/{j1} {k1}/{k1}', file=f)
-			print(f'f {i2}/{i2} {j2}/{j2} {k2}/{k2}', file=f)
-		else:
-			print(f'f {i1} {j1} {k1}', file=f)
-			print(f'f {i2} {j2} {k2}', file=f)
+	report = RunReport('geotiff_to_3d.py')
+	if args.report != None: report.write_at_exit(args.report)
+	if args.profile != None: profile_to(args.profile)
+
+	print()
+	print(f'Run at: {time.asctime()}')
+	print(f'Run as: {" ".join(sys.argv)}')
+
+	run(args, report)
 
-print('Done.')
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,624 @@
+# Author: John Grime
+#
+# Mesh output routines. Vertex, texture coordinate, and face data are passed
+# as NumPy arrays and written to file in bulk, rather than one record at a
+# time. Unless noted otherwise:
+#
+#   verts : (N,3) array of vertex positions
+#   uvs   : (N,2) array of texture coords (v=0 is the BOTTOM of the image), or None
+#   faces : (M,3) array of zero-based vertex indices for each triangle
+#   normals : (N,3) array of unit vertex normals, or None
+#
+
+import os, json
+
+import numpy as np
+
+formats = {
+	'obj': {
+		'desc': 'Wavefront OBJ (text)',
+		'suffix': 'obj',
+	},
+
+	'ply': {
+		'desc': 'Stanford PLY (binary little-endian)',
+		'suffix': 'ply',
+	},
+
+	'stl': {
+		'desc': 'STL (binary, no texture)',
+		'suffix': 'stl',
+	},
+
+	'glb': {
+		'desc': 'glTF 2.0 binary (GLB)',
+		'suffix': 'glb',
+	},
+}
+
+# Largest .stl coord (metres) before 32-bit float spacing exceeds ~1 cm
+stl_max_coord_ = 1.0e5
+
+#
+# Two triangles per cell of a regular lattice of n_rows x n_cols vertices,
+# with vertices numbered row by row. Triangle order and winding match those
+# of the original .obj face loop in geotiff_to_3d.py:
+#
+# a - b
+# | / | : a,b,c : d,c,b
+# c - d
+#
+def grid_faces(n_rows: int, n_cols: int):
+	idx = np.arange(n_rows*n_cols, dtype=np.uint32).reshape(n_rows, n_cols)
+	a, c = idx[:-1,:-1].ravel(), idx[1:,:-1].ravel()
+	b, d = a+1, c+1
+
+	faces = np.empty((2*len(a),3), dtype=np.uint32)
+	faces[0::2] = np.stack((a,b,c), axis=1)
+	faces[1::2] = np.stack((d,c,b), axis=1)
+	return faces
+
+#
+# Error-bounded simplification of a regular lattice of heights z (n_rows x
+# n_cols) as a right-triangulated irregular network (RTIN), after Evans et
+# al. and the "Martini" approach: starting from two triangles covering the
+# lattice, triangles are split in half across their hypotenuse until the
+# height at the hypotenuse midpoint is within max_error of the linear
+# interpolation along the hypotenuse, for that triangle and all of its
+# descendants. The result has no cracks or T-junctions. Returns faces as
+# indices into the lattice vertices (numbered row by row, as grid_faces()),
+# with the same winding as grid_faces(); unused vertices can be removed with
+# compact().
+#
+# The lattice is padded to (2^k+1) x (2^k+1) for the subdivision, and
+# triangles straddling the edge of the real lattice are always split, so the
+# output exactly covers the original lattice.
+#
+def rtin_faces(z, max_error: float):
+	z = np.asarray(z, dtype=np.float64)
+	n_rows, n_cols = z.shape
+	if (n_rows < 2) or (n_cols < 2): return np.empty((0,3), dtype=np.uint32)
+
+	r_max, c_max = n_rows-1, n_cols-1 # of real lattice
+	S = 1 << max(1, int(np.ceil(np.log2(max(r_max,c_max))))) # padded lattice has S+1 points per side
+
+	H = np.pad(z, ((0,S-r_max),(0,S-c_max)), mode='edge')
+	E = np.zeros(H.shape, dtype=np.float64) # error at each hypotenuse midpoint
+
+	# Values of A at rows[:,None],cols[None,:] with zero for points outside A
+	def at(A, rows, cols):
+		rok, cok = (rows>=0) & (rows<=S), (cols>=0) & (cols<=S)
+		v = A[np.ix_(np.clip(rows,0,S), np.clip(cols,0,S))]
+		v[~rok,:], v[:,~cok] = 0, 0
+		return v
+
+	# Any triangle with bounding box r0..r1, c0..c1 that is neither inside
+	# nor outside the real lattice must be split.
+	def straddles(r0, r1, c0, c1):
+		inside = (r1[:,None]<=r_max) & (c1[None,:]<=c_max)
+		outside = (r0[:,None]>=r_max) | (c0[None,:]>=c_max)
+		return ~(inside | outside)
+
+	# Finest to coarsest: hypotenuses of length 2h along lattice axes, then
+	# hypotenuses across the diagonals of 2h x 2h squares. A midpoint's error
+	# includes the errors of the children of the triangles sharing it.
+	h = 1
+	while h < S:
+		# Axis-aligned hypotenuses; midpoints on horizontal then vertical edges
+		# of 2h x 2h squares, with the triangles on either side of each edge.
+		for r_ofs, c_ofs in ((0,h), (h,0)):
+			rows, cols = np.arange(r_ofs, S+1, 2*h), np.arange(c_ofs, S+1, 2*h)
+			dr, dc = (0,h) if r_ofs == 0 else (h,0)
+
+			err = np.abs(at(H, rows, cols) - 0.5*(at(H, rows-dr, cols-dc) + at(H, rows+dr, cols+dc)))
+			if r_ofs == 0:
+				err[straddles(rows-h, rows, cols-h, cols+h) | straddles(rows, rows+h, cols-h, cols+h)] = np.inf
+			else:
+				err[straddles(rows-h, rows+h, cols-h, cols) | straddles(rows-h, rows+h, cols, cols+h)] = np.inf
+
+			if h > 1:
+				q = h//2
+				for sr, sc in ((-q,-q), (-q,q), (q,-q), (q,q)):
+					err = np.maximum(err, at(E, rows+sr, cols+sc))
+
+			E[np.ix_(rows, cols)] = err
+
+		# Diagonal hypotenuses; midpoints at centres of 2h x 2h squares. The
+		# diagonal runs from top left to bottom right in squares (p,q) with
+		# p+q even, and from top right to bottom left otherwise.
+		rows = cols = np.arange(h, S+1, 2*h)
+		main = ((np.arange(len(rows))[:,None] + np.arange(len(cols))[None,:]) % 2) == 0
+
+		mid = at(H, rows, cols)
+		err_main = np.abs(mid - 0.5*(at(H, rows-h, cols-h) + at(H, rows+h, cols+h)))
+		err_anti = np.abs(mid - 0.5*(at(H, rows-h, cols+h) + at(H, rows+h, cols-h)))
+		err = np.where(main, err_main, err_anti)
+		err[straddles(rows-h, rows+h, cols-h, cols+h)] = np.inf
+
+		for sr, sc in ((-h,0), (h,0), (0,-h), (0,h)):
+			err = np.maximum(err, at(E, rows+sr, cols+sc))
+
+		E[np.ix_(rows, cols)] = err
+		h *= 2
+
+	# Coarsest to finest: split triangles (a,b,c), with hypotenuse a-b and
+	# midpoint m, into (c,a,m) and (b,c,m) while the error is too large.
+	A = np.array([[0,0], [S,S]], dtype=np.int64)
+	B = np.array([[S,S], [0,0]], dtype=np.int64)
+	C = np.array([[0,S], [S,0]], dtype=np.int64)
+
+	done = []
+	while len(A) > 0:
+		M = (A+B)//2
+		leaf = np.abs(A-C).sum(axis=1) <= 1
+		split = (~leaf) & (E[M[:,0],M[:,1]] > max_error)
+
+		emit = ~split
+		done.append((A[emit], B[emit], C[emit]))
+
+		A, B, C, M = A[split], B[split], C[split], M[split]
+		A, B, C = np.concatenate((C,B)), np.concatenate((A,C)), np.concatenate((M,M))
+
+	A, B, C = [np.concatenate([d[i] for d in done]) for i in range(3)]
+
+	# Remove triangles outside the real lattice
+	P = np.maximum(np.maximum(A,B),C)
+	inside = (P[:,0] <= r_max) & (P[:,1] <= c_max)
+	A, B, C = A[inside], B[inside], C[inside]
+
+	# Consistent winding, as grid_faces(): counterclockwise in (col,row) space
+	cross = (B[:,1]-A[:,1])*(C[:,0]-A[:,0]) - (B[:,0]-A[:,0])*(C[:,1]-A[:,1])
+	flip = cross < 0
+	A[flip], B[flip] = B[flip], A[flip]
+
+	idx = lambda P: P[:,0]*n_cols + P[:,1]
+	return np.stack((idx(A), idx(B), idx(C)), axis=1).astype(np.uint32)
+
+#
+# Remove vertices not referenced by any face; returns (used, faces) where used
+# holds the indices of the remaining vertices in their original order (so
+# e.g. verts[used] and uvs[used] are the remaining data) and faces refers to
+# the remaining vertices.
+#
+def compact(faces, n_verts: int):
+	used = np.zeros(n_verts, dtype=bool)
+	used[faces.ravel()] = True
+
+	remap = np.cumsum(used, dtype=np.int64) - 1
+	return np.flatnonzero(used), remap[faces].astype(np.uint32)
+
+#
+# Unit normals of triangles; degenerate triangles get a zero normal.
+#
+def face_normals(verts, faces):
+	p0, p1, p2 = verts[faces[:,0]], verts[faces[:,1]], verts[faces[:,2]]
+	n = np.cross(p1-p0, p2-p0)
+	l = np.linalg.norm(n, axis=1)
+	l[l==0.0] = 1.0
+	return n / l[:,np.newaxis]
+
+#
+# Smooth vertex normals of a lattice of points, where X, Y and Z are (or
+# broadcast to) (n_rows, n_cols) arrays of point coords with Z the heights.
+# Tangents along the columns and rows are found by central finite differences
+# (one-sided at the edges of the lattice), and the normal is their cross
+# product. Also returns the unit tangents along the direction in which the
+# lattice column increases. Both are (n_rows, n_cols, 3) arrays in (x,y,z)
+# order. Columns (or rows) of points with the same x,y as their neighbours
+# (e.g. where points are clamped onto the edge of a region) take the tangents
+# of the nearest column (or row) which doesn't.
+#
+def grid_normals(X, Y, Z):
+	Z = np.asarray(Z, dtype=np.float64)
+	P = np.stack(np.broadcast_arrays(np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64), Z), axis=-1)
+
+	# Tangents along the given lattice axis; default if the lattice is flat along it
+	def tangents(axis: int, default):
+		default = np.broadcast_to(np.array(default, dtype=np.float64), P.shape)
+		if P.shape[axis] < 2: return default
+
+		T = np.gradient(P, axis=axis)
+		ok = (np.hypot(T[...,0], T[...,1]) != 0.0).all(axis=1-axis)
+		if not ok.any(): return default
+
+		if not ok.all():
+			good = np.flatnonzero(ok)
+			nearest = good[np.clip(np.searchsorted(good, np.arange(len(ok))), 0, len(good)-1)]
+			T = np.take(T, nearest, axis=axis)
+		return T
+
+	tu, tv = tangents(1, (1.0,0.0,0.0)), tangents(0, (0.0,1.0,0.0))
+
+	n = np.cross(tu, tv)
+	n /= np.linalg.norm(n, axis=-1)[...,np.newaxis]
+
+	t = tu / np.linalg.norm(tu, axis=-1)[...,np.newaxis]
+
+	return n, t
+
+#
+# Material file referencing a single texture, for use with .obj output.
+#
+def write_mtl(path: str, texture: str):
+	with open(path, 'w') as f:
+		print('newmtl Default', file=f)
+		print('  Ka 1.0 1.0 1.0', file=f) # ambient color
+		print('  Kd 1.0 1.0 1.0', file=f) # diffuse color
+		print('  Ks 0.0 0.0 0.0', file=f) # specular color
+		print('   d 1.0', file=f)  # "dissolved" == opacity
+		print('  Ni 1.0', file=f)  # optical density
+		print('  illum 2', file=f) # illumination model
+		print(f'  map_Ka {texture}', file=f) # ambient texture
+		print(f'  map_Kd {texture}', file=f) # diffuse texture
+		print(f'  map_Ks {texture}', file=f) # specular texture
+		print(f'  map_Ns {texture}', file=f) # specular highlight texture
+
+#
+# Vectorized ASCII formatting. Text is handled as 4-byte words (uint32) of
+# characters, each word holding a few characters of a number padded with NUL
+# bytes; dropping the NULs from a row of words yields the text. Numbers are
+# converted via lookup tables of 3-digit groups (with contents left-aligned in
+# the word, so the last byte is free unless noted):
+#
+#   lead[i]   : i without leading zeros; lead[1000+i] is -i (may fill word)
+#   pad[i]    : i zero padded to 3 digits
+#   dotpad[i] : '.' followed by i zero padded to 3 digits (fills word)
+#
+def _word_table(strings: [bytes]):
+	rows = np.array([list(s.ljust(4, b'\0')) for s in strings], dtype=np.uint8)
+	return rows.view(np.uint32)[:,0]
+
+_lead = _word_table([b'%d' % i for i in range(1000)] + [b'-%d' % i for i in range(1000)])
+_pad = _word_table([b'%03d' % i for i in range(1000)])
+_dotpad = _word_table([b'.%03d' % i for i in range(1000)])
+
+#
+# Convert numbers to words of text; returns array of shape values.shape +
+# (n_words,), where the last byte of the final word is always free. Integers
+# match '%d', floats match '%.6f' exactly: floats are converted to integers
+# scaled by 10^6, and the rare values lying too close to a rounding tie for
+# that to be safe are converted by Python instead. Returns None for anything
+# else (non-finite or very large values), and the caller should fall back to
+# Python's own formatting.
+#
+def ascii_words(values):
+	v = np.asarray(values)
+
+	if v.dtype.kind == 'f':
+		if not np.all(np.isfinite(v)): return None
+
+		y = np.abs(v)*1e6
+		if y.max(initial=0.0) >= 1e18: return None
+
+		k = np.rint(y)
+		tie = np.abs(np.abs(y-k)-0.5) <= y*(2.0**-50)
+		k = k.astype(np.int64)
+		for idx in zip(*np.nonzero(tie)):
+			k[idx] = int(('%.6f' % abs(v[idx])).replace('.',''))
+
+		neg = np.signbit(v)
+		ipart, fpart = np.divmod(k, 1000000)
+	else:
+		if v.size > 0 and np.abs(v).max() >= 10**15: return None
+		neg = v < 0
+		ipart, fpart = np.abs(v).astype(np.int64), None
+
+	# Integer part as 3-digit groups, most significant first. Groups above the
+	# leading group are empty, the leading group carries any sign, and zero is
+	# written as '0'.
+	n_groups = max(1, (len(str(ipart.max(initial=0)))+2)//3)
+	signed = neg*1000
+
+	parts, rest = [], ipart
+	for i in range(n_groups):
+		scale = 1000**(n_groups-1-i)
+		group, rest = np.divmod(rest, scale)
+		if i == n_groups-1:
+			words = np.where(ipart < 1000, _lead[group + signed], _pad[group])
+		else:
+			words = np.where(ipart < scale, 0, np.where(ipart < scale*1000, _lead[group + signed], _pad[group]))
+		parts.append(words.astype(np.uint32))
+
+	if fpart is not None:
+		hi, lo = np.divmod(fpart, 1000)
+		parts.append(_dotpad[hi])
+		parts.append(_pad[lo])
+	elif np.any(neg):
+		parts.append(np.zeros(v.shape, dtype=np.uint32)) # '-999' fills a word
+
+	return np.stack(parts, axis=-1)
+
+#
+# Lay out records of text words as rows of a uint32 array and remove the NUL
+# padding to give the text. The template is a list of literal strings and
+# None placeholders, one placeholder for each entry in fields; fields are
+# (n, n_words) arrays as produced by ascii_words(). Single-character literals
+# following a field are stored in the free last byte of that field's words.
+#
+def format_records(template: [str], fields) -> bytes:
+	def literal(t, pad_left = False):
+		b = t.encode('ascii')
+		n = 4*((len(b)+3)//4)
+		b = b.rjust(n, b'\0') if pad_left else b.ljust(n, b'\0')
+		return np.frombuffer(b, dtype=np.uint32)
+
+	n, fields = len(fields[0]), iter(fields)
+
+	parts, seps = [], []
+	for t in template:
+		if t == None:
+			parts.append(next(fields))
+			seps.append(0)
+		elif len(t) == 1 and len(parts) > 0 and parts[-1].ndim == 2 and seps[-1] == 0:
+			seps[-1] = literal(t, pad_left = True)[0]
+		else:
+			parts.append(literal(t))
+			seps.append(0)
+
+	buf = np.empty((n, sum(p.shape[-1] for p in parts)), dtype=np.uint32)
+	col = 0
+	for p, sep in zip(parts, seps):
+		col += p.shape[-1]
+		buf[:,col-p.shape[-1]:col] = p
+		if sep != 0: buf[:,col-1] |= sep
+
+	b = buf.view(np.uint8)
+	return b[b != 0].tobytes()
+
+#
+# Wavefront .obj text output, formatted and written a block of records at a
+# time. The output is exactly the same text as printing each record with
+# f'{x:.6f}' etc. If uvs are given, each "v" record is followed by its "vt"
+# record, and likewise by a "vn" record if normals are given; faces reference
+# texture coords and normals with the same index as the vertex. Face records
+# are assembled from a table of the formatted vertex indices, so each index is
+# only converted to text once.
+#
+# The vertex and face sections can also be written separately, e.g. to
+# format parts of a large mesh in parallel and concatenate the results; see
+# write_obj_verts() and write_obj_faces().
+#
+def write_obj(path: str, verts, faces, uvs = None, mtllib: str = None, normals = None,
+	block_records: int = 64*1024, progress: bool = True):
+
+	with open(path, 'wb') as f:
+		write_obj_header(f, mtllib)
+
+		if progress: print('  vertex positions...')
+		write_obj_verts(f, verts, uvs, normals, block_records)
+
+		if progress: print('  faces...')
+		write_obj_faces(f, faces, uvs is not None, normals is not None, block_records)
+
+def write_obj_header(f, mtllib: str = None):
+	if mtllib != None:
+		f.write(f'mtllib {mtllib}\n'.encode())
+		f.write(f'usemtl Default\n'.encode())
+
+# Placeholders in the template are filled from the columns of data; if given,
+# cols lists the column used for each placeholder, and table holds the text
+# words for each possible value of data.
+def _write_records(f, template, data, block_records: int, table = None, cols = None):
+	if cols == None: cols = list(range(data.shape[1]))
+	fmt = ''.join([('%.6f' if data.dtype.kind == 'f' else '%d') if t == None else t for t in template])
+	for i in range(0, len(data), block_records):
+		blk = data[i:i+block_records]
+		words = ascii_words(blk) if table is None else table[blk]
+		if words is None:
+			f.write(((fmt*len(blk)) % tuple(blk[:,cols].ravel().tolist())).encode('ascii'))
+		else:
+			f.write(format_records(template, [words[:,j] for j in cols]))
+
+def write_obj_verts(f, verts, uvs = None, normals = None, block_records: int = 64*1024):
+	columns, template = [verts], ['v ',None,' ',None,' ',None,'\n']
+	if uvs is not None:
+		columns.append(uvs)
+		template += ['vt ',None,' ',None,'\n']
+	if normals is not None:
+		columns.append(normals)
+		template += ['vn ',None,' ',None,' ',None,'\n']
+
+	# Merge adjacent literals, e.g. '\n' and 'vt '
+	merged = []
+	for t in template:
+		if (t != None) and (len(merged) > 0) and (merged[-1] != None): merged[-1] += t
+		else: merged.append(t)
+
+	data = np.concatenate(columns, axis=1).astype(np.float64)
+	_write_records(f, merged, data, block_records)
+
+# Faces hold zero-based indices into the vertices of the whole file, so a
+# subset of the faces can be written on its own; only the range of indices
+# actually used is formatted.
+def write_obj_faces(f, faces, textured: bool = False, normals: bool = False, block_records: int = 64*1024):
+	idx = np.asarray(faces, dtype=np.int64)
+	if len(idx) == 0: return
+
+	lo, hi = idx.min(), idx.max()
+	table = ascii_words(np.arange(lo+1, hi+2)) # .obj indices start at 1
+	idx = idx - lo
+
+	if (textured == False) and (normals == False):
+		_write_records(f, ['f ',None,' ',None,' ',None,'\n'], idx, block_records, table)
+	elif normals == False:
+		_write_records(f, ['f ',None,'/',None,' ',None,'/',None,' ',None,'/',None,'\n'], idx, block_records, table, [0,0,1,1,2,2])
+	elif textured == False:
+		_write_records(f, ['f ',None,'//',None,' ',None,'//',None,' ',None,'//',None,'\n'], idx, block_records, table, [0,0,1,1,2,2])
+	else:
+		_write_records(f, ['f ',None,'/',None,'/',None,' ',None,'/',None,'/',None,' ',None,'/',None,'/',None,'\n'],
+			idx, block_records, table, [0,0,0,1,1,1,2,2,2])
+
+#
+# Binary little-endian PLY. MeshLab picks up the texture via the TextureFile
+# comment, and uses s,t as the per-vertex texture coords. Positions are stored
+# as doubles, as coords in metres can be ~1e7 (e.g. with -x0, -y0 of zero) and
+# would be rounded to the nearest metre or so as 32-bit floats.
+#
+def write_ply(path: str, verts, faces, uvs = None, texture: str = None, normals = None):
+	header = ['ply', 'format binary_little_endian 1.0']
+	if texture != None:
+		header.append(f'comment TextureFile {texture}')
+
+	header.append(f'element vertex {len(verts)}')
+	header += [f'property double {c}' for c in ('x','y','z')]
+	if uvs is not None:
+		header += [f'property float {c}' for c in ('s','t')]
+	if normals is not None:
+		header += [f'property float {c}' for c in ('nx','ny','nz')]
+
+	header.append(f'element face {len(faces)}')
+	header.append('property list uchar int vertex_indices')
+	header.append('end_header')
+
+	vdtype = [('x','<f8'), ('y','<f8'), ('z','<f8')]
+	if uvs is not None:
+		vdtype += [('s','<f4'), ('t','<f4')]
+	if normals is not None:
+		vdtype += [('nx','<f4'), ('ny','<f4'), ('nz','<f4')]
+
+	v = np.empty(len(verts), dtype=vdtype)
+	v['x'], v['y'], v['z'] = verts[:,0], verts[:,1], verts[:,2]
+	if uvs is not None:
+		v['s'], v['t'] = uvs[:,0], uvs[:,1]
+	if normals is not None:
+		v['nx'], v['ny'], v['nz'] = normals[:,0], normals[:,1], normals[:,2]
+
+	f = np.empty(len(faces), dtype=[('n','u1'), ('idx','<i4',(3,))])
+	f['n'], f['idx'] = 3, faces
+
+	with open(path, 'wb') as fd:
+		fd.write(('\n'.join(header)+'\n').encode('ascii'))
+		v.tofile(fd)
+		f.tofile(fd)
+
+#
+# Binary STL; one 50 byte record per triangle. STL has no notion of shared
+# vertices or texture coords, so triangles are written in blocks to bound the
+# size of the expanded per-triangle arrays. STL positions can only be 32-bit
+# floats, so large coords (e.g. with -x0, -y0 of zero) lose precision; warn if
+# they would be rounded to more than about a centimetre.
+#
+def write_stl(path: str, verts, faces, block_faces: int = 1024*1024):
+	rec_dtype = [('n','<f4',(3,)), ('v','<f4',(3,3)), ('attr','<u2')]
+
+	max_abs = np.abs(verts).max() if len(verts) > 0 else 0.0
+	if max_abs > stl_max_coord_:
+		print(f'WARNING: coords up to {max_abs:.3g} lose precision as 32-bit floats in .stl output; set -x0 and -y0 near the model')
+
+	with open(path, 'wb') as fd:
+		fd.write(b'Binary STL written by geotiff_to_3d.py'.ljust(80, b' '))
+		fd.write(np.uint32(len(faces)).tobytes())
+
+		for i in range(0, len(faces), block_faces):
+			blk = faces[i:i+block_faces]
+			rec = np.zeros(len(blk), dtype=rec_dtype)
+			rec['n'] = face_normals(verts, blk)
+			rec['v'] = verts[blk]
+			rec.tofile(fd)
+
+#
+# glTF 2.0 binary container: 12 byte header, JSON chunk, BIN chunk. The BIN
+# chunk holds positions, texture coords, normals, tangents, indices and
+# (optionally) the texture image itself, each 4-byte aligned; a texture which
+# isn't a JPEG or PNG file, or can't be found, is referenced by name instead
+# (as for .obj and .ply output). Note glTF places
+# v=0 at the TOP of the image, so v coords are flipped. If given, tangents are
+# an (N,4) array of unit tangents along +u, with w = +/-1 giving the direction
+# of +v (before flipping) as cross(normal, tangent)*w. Positions are stored
+# as 32-bit floats relative to the centre of the mesh's bounding box, with the
+# centre itself (in full precision) as the node's translation, so large coords
+# (e.g. with -x0, -y0 of zero) don't lose precision.
+#
+def write_glb(path: str, verts, faces, uvs = None, texture: str = None, normals = None, tangents = None):
+	pad4 = lambda n: (4 - n%4) % 4
+
+	blobs, views, accessors = [], [], []
+
+	def add_view(data, target = None):
+		offset = sum(len(b)+pad4(len(b)) for b in blobs)
+		blobs.append(data)
+		view = {'buffer': 0, 'byteOffset': offset, 'byteLength': len(data)}
+		if target != None: view['target'] = target
+		views.append(view)
+		return len(views)-1
+
+	lo, hi = (verts.min(axis=0), verts.max(axis=0)) if len(verts) > 0 else (np.zeros(3), np.zeros(3))
+	centre = (np.asarray(lo, dtype=np.float64) + hi)/2
+	positions = np.ascontiguousarray(verts - centre, dtype='<f4')
+	view = add_view(memoryview(positions).cast('B'), 34962) # ARRAY_BUFFER
+	accessors.append({'bufferView': view, 'componentType': 5126, 'count': len(positions), 'type': 'VEC3',
+		'min': positions.min(axis=0).tolist(), 'max': positions.max(axis=0).tolist()})
+	attributes = {'POSITION': len(accessors)-1}
+
+	if uvs is not None:
+		texcoords = np.empty((len(uvs),2), dtype='<f4')
+		texcoords[:,0], texcoords[:,1] = uvs[:,0], 1.0-uvs[:,1]
+		view = add_view(memoryview(texcoords).cast('B'), 34962)
+		accessors.append({'bufferView': view, 'componentType': 5126, 'count': len(texcoords), 'type': 'VEC2'})
+		attributes['TEXCOORD_0'] = len(accessors)-1
+
+	if normals is not None:
+		data = np.ascontiguousarray(normals, dtype='<f4')
+		view = add_view(memoryview(data).cast('B'), 34962)
+		accessors.append({'bufferView': view, 'componentType': 5126, 'count': len(data), 'type': 'VEC3'})
+		attributes['NORMAL'] = len(accessors)-1
+
+	if tangents is not None:
+		# glTF bitangent is cross(normal, tangent)*w pointing along +v as seen
+		# in the file, so flip w along with the v coords.
+		data = np.array(tangents, dtype='<f4', order='C')
+		data[:,3] = -data[:,3]
+		view = add_view(memoryview(data).cast('B'), 34962)
+		accessors.append({'bufferView': view, 'componentType': 5126, 'count': len(data), 'type': 'VEC4'})
+		attributes['TANGENT'] = len(accessors)-1
+
+	indices = np.ascontiguousarray(faces, dtype='<u4')
+	view = add_view(memoryview(indices).cast('B'), 34963) # ELEMENT_ARRAY_BUFFER
+	accessors.append({'bufferView': view, 'componentType': 5125, 'count': indices.size, 'type': 'SCALAR'})
+
+	primitive = {'attributes': attributes, 'indices': len(accessors)-1, 'mode': 4}
+
+	gltf = {
+		'asset': {'version': '2.0', 'generator': 'geotiff_to_3d.py'},
+		'scene': 0,
+		'scenes': [{'nodes': [0]}],
+		'nodes': [{'mesh': 0, 'translation': centre.tolist()}],
+		'meshes': [{'primitives': [primitive]}],
+		'accessors': accessors,
+		'bufferViews': views,
+	}
+
+	if texture != None:
+		mime_types = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png'}
+		mime = mime_types.get(os.path.splitext(texture)[1].lower())
+		if not os.path.isfile(texture):
+			print(f'WARNING: texture "{texture}" not found; referencing rather than embedding it')
+			image = {'uri': texture}
+		elif mime != None:
+			with open(texture, 'rb') as fd:
+				image = {'bufferView': add_view(fd.read()), 'mimeType': mime}
+		else:
+			print(f'Texture "{texture}" is not JPEG or PNG; referencing rather than embedding it')
+			image = {'uri': texture}
+
+		gltf['images'] = [image]
+		gltf['samplers'] = [{}]
+		gltf['textures'] = [{'source': 0, 'sampler': 0}]
+		gltf['materials'] = [{'pbrMetallicRoughness': {'baseColorTexture': {'index': 0},
+			'metallicFactor': 0.0, 'roughnessFactor': 1.0}}]
+		primitive['material'] = 0
+
+	bin_len = sum(len(b)+pad4(len(b)) for b in blobs)
+	gltf['buffers'] = [{'byteLength': bin_len}]
+
+	js = json.dumps(gltf, separators=(',',':')).encode('utf-8')
+	js += b' ' * pad4(len(js))
+
+	with open(path, 'wb') as fd:
+		fd.write(np.array([0x46546C67, 2, 12 + 8+len(js) + 8+bin_len], dtype='<u4').tobytes()) # 'glTF'
+		fd.write(np.array([len(js), 0x4E4F534A], dtype='<u4').tobytes()) # 'JSON'
+		fd.write(js)
+		fd.write(np.array([bin_len, 0x004E4942], dtype='<u4').tobytes()) # 'BIN\0'
+		for b in blobs:
+			fd.write(b)
+			fd.write(b'\0' * pad4(len(b)))
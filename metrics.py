@@ -0,0 +1,150 @@
+# Author: John Grime
+#
+# Instrumentation for the scripts: wall time and peak memory of each stage of
+# a run, plus named counters (bytes downloaded, tiles fetched, vertices
+# written etc), saved as a JSON run report. Stages are sequential; starting a
+# stage ends the previous one. For example:
+#
+#   report = RunReport('fetch_tiles.py')
+#   report.write_at_exit('report.json')
+#
+#   report.stage('download')
+#   ...
+#   report.count('bytes_downloaded', len(data)) # safe from any thread
+#   ...
+#   report.stage('combine')
+#   ...
+#   report.finish()
+#
+# The report is written when the script exits, including via sys.exit() on an
+# error; "status" is then "incomplete" rather than "ok", and the last stage
+# reported is the one that failed. Each stage lists the counters incremented
+# during that stage; for counters named "bytes_*", the rate over the stage is
+# also given as "bytes_*_per_s".
+#
+# Peak RSS is the high water mark of the process (and separately of any child
+# processes which have finished, e.g. workers for geotiff_to_3d.py -jobs), as
+# reported by the OS; it is therefore the peak up to the end of each stage,
+# rather than within it.
+#
+
+import sys, os, time, json, atexit, threading
+
+#
+# Peak resident set size in bytes of this process, or of its finished child
+# processes; None where the resource module is unavailable (e.g. Windows).
+#
+def peak_rss_bytes(children: bool = False):
+	try:
+		import resource
+	except ImportError:
+		return None
+
+	who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+	kb = resource.getrusage(who).ru_maxrss
+	return kb if sys.platform == 'darwin' else kb*1024 # bytes on macOS, KiB elsewhere
+
+class RunReport:
+
+	def __init__(self, script: str, argv: [str] = None):
+		self.lock = threading.Lock()
+		self.t0 = time.perf_counter()
+
+		self.script = script
+		self.argv = list(sys.argv if argv == None else argv)
+		self.started = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+		self.status = 'incomplete'
+
+		self.stages, self.counters, self.values = [], {}, {}
+		self.current = None # (name, start time, counters at start)
+
+	def stage(self, name: str):
+		now = time.perf_counter()
+		with self.lock:
+			self.end_stage_(now)
+			self.current = (name, now, dict(self.counters))
+
+	# Must be called with lock held
+	def end_stage_(self, now: float):
+		if self.current == None: return
+
+		name, t0, counters0 = self.current
+		seconds = now - t0
+
+		deltas = {}
+		for k, v in self.counters.items():
+			dv = v - counters0.get(k, 0)
+			if dv == 0: continue
+			deltas[k] = dv
+			if k.startswith('bytes_') and seconds > 0:
+				deltas[k + '_per_s'] = dv/seconds
+
+		self.stages.append({
+			'name': name,
+			'seconds': seconds,
+			'peak_rss_bytes': peak_rss_bytes(),
+			'counters': deltas,
+		})
+		self.current = None
+
+	# Add n to the named counter; safe to call from multiple threads.
+	def count(self, name: str, n = 1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	# Record a named value (anything JSON serializable) in the report.
+	def set(self, name: str, value):
+		with self.lock:
+			self.values[name] = value
+
+	def finish(self):
+		with self.lock:
+			self.end_stage_(time.perf_counter())
+			self.status = 'ok'
+
+	def as_dict(self) -> dict:
+		now = time.perf_counter()
+		with self.lock:
+			self.end_stage_(now)
+			return {
+				'script': self.script,
+				'argv': self.argv,
+				'started': self.started,
+				'status': self.status,
+				'seconds': now - self.t0,
+				'peak_rss_bytes': peak_rss_bytes(),
+				'peak_rss_children_bytes': peak_rss_bytes(children = True),
+				'stages': self.stages,
+				'counters': dict(self.counters),
+				'values': dict(self.values),
+			}
+
+	# Written under a temporary name and then renamed.
+	def write(self, path: str):
+		tmp_path = f'{path}.{os.getpid()}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self.as_dict(), f, indent = 1)
+		os.replace(tmp_path, path)
+
+	# Only the process which registered this writes the report, so forked
+	# worker processes exiting don't overwrite it.
+	def write_at_exit(self, path: str):
+		pid = os.getpid()
+		atexit.register(lambda: self.write(path) if os.getpid() == pid else None)
+
+#
+# Profile the rest of the run with cProfile, saving the statistics to path when
+# the script exits; view with e.g. "python3 -m pstats path" or snakeviz.
+#
+def profile_to(path: str):
+	import cProfile
+
+	pid, profiler = os.getpid(), cProfile.Profile()
+
+	def dump():
+		if os.getpid() != pid: return
+		profiler.disable()
+		profiler.dump_stats(path)
+
+	atexit.register(dump)
+	profiler.enable()
@@ -0,0 +1,158 @@
+# Author: John Grime
+#
+# Routines to combine a set of map tiles into a single image.
+#
+# Tile sets are described as a list of (dx, dy, x, y) tuples in row order,
+# where (dx,dy) is the tile's position in the set and (x,y) its Web Mercator
+# tile coords. Tiles are loaded via a caller-supplied open_tile(tile) function,
+# which returns a PIL image or None if the tile is unavailable (in which case
+# it's left blank).
+#
+# Crop boxes are (x0,y0, x1,y1) in pixels relative to the top left of the full
+# (uncropped) tile set, with x1 and y1 exclusive.
+#
+# If workers > 1, tiles are opened and decoded by a pool of threads while
+# earlier tiles are being pasted; see load_tiles(). open_tile must then be
+# safe to call from multiple threads.
+#
+
+import itertools, collections
+
+#
+# Yield (tile, image) for each tile in order, where image is from open_tile().
+# With workers > 1, tiles are opened in a pool of threads, at most queue_size
+# tiles ahead of the caller (bounding the memory used by decoded tiles that
+# are waiting to be pasted). PIL decodes images lazily, so decoding is forced
+# in the worker threads; PIL releases the GIL while decoding, so several tiles
+# are decoded at once on multi-core machines.
+#
+def load_tiles(tiles, open_tile, workers: int = 1, queue_size: int = None):
+	from concurrent.futures import ThreadPoolExecutor
+
+	def load(tile):
+		img = open_tile(tile)
+		if img != None: img.load()
+		return tile, img
+
+	if workers <= 1:
+		for tile in tiles:
+			yield tile, open_tile(tile)
+		return
+
+	if queue_size == None: queue_size = 4*workers
+
+	with ThreadPoolExecutor(max_workers = workers) as pool:
+		queue = collections.deque()
+		for tile in tiles:
+			queue.append(pool.submit(load, tile))
+			if len(queue) >= queue_size:
+				yield queue.popleft().result()
+		while len(queue) > 0:
+			yield queue.popleft().result()
+
+#
+# Paste every tile into a single image of the full tile set. Memory use is
+# proportional to the size of the entire uncropped tile set!
+#
+def combine(tiles, nx_tile: int, ny_tile: int, tile_size: int, open_tile, workers: int = 1):
+	from PIL import Image
+	Image.MAX_IMAGE_PIXELS = None # careful; only for trusted sources!
+
+	combined = Image.new("RGB", (nx_tile*tile_size, ny_tile*tile_size))
+
+	for tile, img in load_tiles(tiles, open_tile, workers):
+		dx, dy = tile[0], tile[1]
+		if img == None: continue # unavailable; left blank
+		combined.paste(img, (dx*tile_size, dy*tile_size))
+
+	return combined
+
+#
+# Generate the cropped image one band of rows at a time; each band spans a
+# single row of tiles, of which only the parts inside the crop box are pasted.
+# Yields (row, band) where band is a PIL image and row its offset into the
+# cropped image. Peak memory is one row of tiles (plus any tiles loaded ahead
+# by load_tiles()), regardless of region size.
+#
+def cropped_bands(tiles, tile_size: int, crop: (int,int,int,int), open_tile, workers: int = 1):
+	from PIL import Image
+
+	x0, y0, x1, y1 = crop
+
+	# Only tiles overlapping the crop box are loaded
+	def inside(tile):
+		dx, dy = tile[0], tile[1]
+		return ((dx+1)*tile_size > x0) and (dx*tile_size < x1) and ((dy+1)*tile_size > y0) and (dy*tile_size < y1)
+
+	loaded = load_tiles([t for t in tiles if inside(t)], open_tile, workers)
+
+	for dy, row_tiles in itertools.groupby(loaded, key = lambda ti: ti[0][1]):
+		top, bottom = max(y0, dy*tile_size), min(y1, (dy+1)*tile_size)
+		band = Image.new("RGB", (x1-x0, bottom-top))
+
+		for tile, img in row_tiles:
+			dx = tile[0]
+			if img == None: continue # unavailable; left blank
+
+			# Negative offsets are clipped by paste(), dropping pixels outside band
+			band.paste(img, (dx*tile_size-x0, dy*tile_size-top))
+
+		yield top-y0, band
+
+#
+# Write cropped image as a striped TIFF via rasterio, one band of rows at a
+# time, without ever holding the full image in memory. JPEG compression is
+# used inside the TIFF if requested (as for a .jpeg texture), else DEFLATE.
+#
+def stream_cropped(tiles, tile_size: int, crop: (int,int,int,int), open_tile,
+	out_path: str, jpeg: bool = True, progress: bool = True, workers: int = 1):
+	import warnings
+	import numpy as np
+	import rasterio
+	from rasterio.windows import Window
+	from rasterio.errors import NotGeoreferencedWarning
+
+	x0, y0, x1, y1 = crop
+	width, height = x1-x0, y1-y0
+
+	profile = {
+		'driver': 'GTiff',
+		'width': width,
+		'height': height,
+		'count': 3,
+		'dtype': 'uint8',
+		'tiled': False,
+		'blockysize': 16,
+		'interleave': 'pixel',
+		'BIGTIFF': 'IF_SAFER',
+	}
+	if jpeg:
+		profile.update({'compress': 'jpeg', 'photometric': 'ycbcr', 'jpeg_quality': 90})
+	else:
+		profile.update({'compress': 'deflate', 'photometric': 'rgb'})
+
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', NotGeoreferencedWarning)
+
+		with rasterio.open(out_path, 'w', **profile) as dst:
+			for row, band in cropped_bands(tiles, tile_size, crop, open_tile, workers):
+				data = np.asarray(band).transpose(2,0,1) # (rows,cols,rgb) => (rgb,rows,cols)
+				dst.write(data, window=Window(0, row, width, band.height))
+				if progress:
+					print(f'  rows {row} to {row+band.height} of {height}')
+
+#
+# Combine a 2x2 group of tiles into a single tile of the same size at the next
+# lower zoom level, by averaging each 2x2 block of pixels. quad[j][i] is the
+# tile at column i, row j of the group (i.e. Web Mercator tile 2x+i, 2y+j for
+# parent tile x,y).
+#
+def downsample_quad(quad, tile_size: int):
+	from PIL import Image
+
+	img = Image.new("RGB", (2*tile_size, 2*tile_size))
+	for j in range(2):
+		for i in range(2):
+			img.paste(quad[j][i], (i*tile_size, j*tile_size))
+
+	return img.reduce(2)
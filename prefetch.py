@@ -0,0 +1,377 @@
+# Author: John Grime
+#
+# Download the map tiles for many regions of interest, at one or more zoom
+# levels, in a single pass before running fetch_tiles.py (or batch.py) for
+# each of them; fetch_tiles.py then finds every tile it needs in the cache.
+#
+# The tile sets of all the requests are combined, so tiles shared by
+# overlapping regions are planned once; tiles already cached are removed with
+# a single query of the cache (see tilecache.py) rather than a check per tile
+# per region. The remaining tiles are downloaded in the order of a Z-order or
+# Hilbert curve over each zoom level, so that consecutive requests are for
+# nearby tiles (which tile servers tend to store and cache together), and the
+# total download size is estimated from the sizes of tiles already in the
+# cache before anything is downloaded.
+#
+# Requests are given as -region options, or as a batch.py manifest (using the
+# tile source and zoom level of each site), e.g.:
+#
+#   python3 prefetch.py -src usgs -zoom 12 13 -cache_db tiles.db \
+#     -region 35.9443 36.2990 -112.2772 -112.0149 \
+#     -region 36.0 36.1 -112.2 -112.1
+#
+
+import sys, os, time, json, argparse, threading
+
+from util import WebMercator
+from tilecache import DirectoryCache, SQLiteCache
+from metrics import RunReport, profile_to
+
+# Orders in which planned tiles are downloaded
+orders = {
+	'row': {'desc': 'zoom level, then row by row'},
+	'zorder': {'desc': 'zoom level, then Z-order (Morton) curve'},
+	'hilbert': {'desc': 'zoom level, then Hilbert curve'},
+}
+
+# Typical tile sizes (KiB) by image format, for estimating download sizes
+# when the cache has no tiles from the same source.
+typical_kb = {
+	'png': 100.0,
+	'jpg': 25.0,
+}
+
+#
+# Inclusive range of tiles (x0,y0, x1,y1) covering a region at a given zoom
+# level, calculated exactly as fetch_tiles.py does (including -even).
+#
+def tile_range(lat: (float,float), lon: (float,float), zoom: int, tile_size: int = 256, even: bool = False):
+	_x0, _y0 = WebMercator.lonlat_to_pix(lon[0], lat[0], zoom, tile_size)
+	_x1, _y1 = WebMercator.lonlat_to_pix(lon[1], lat[1], zoom, tile_size)
+
+	x_pix, y_pix = sorted([_x0, _x1]), sorted([_y0, _y1])
+	x_tile, y_tile = [int(x/tile_size) for x in x_pix], [int(y/tile_size) for y in y_pix]
+	x_ofs, y_ofs = [int(x%tile_size) for x in x_pix], [int(y%tile_size) for y in y_pix]
+
+	if even == True:
+		for tile, ofs in ((x_tile, x_ofs), (y_tile, y_ofs)):
+			if tile[0]%2 != 0: tile[0] -= 1 # round minimum DOWN
+			if tile[1]%2 != 0: tile[1] += 1 # round maximum UP
+			elif ofs[1] != 0: tile[1] += 2 # region ends inside an even tile; include its odd neighbour
+
+	return x_tile[0], y_tile[0], x_tile[1], y_tile[1]
+
+#
+# Position of each tile (x,y) along a space-filling curve over the 2^zoom x
+# 2^zoom tiles of a zoom level; x and y are integer arrays.
+#
+def curve_index(x, y, zoom: int, order: str = 'hilbert'):
+	import numpy as np
+
+	x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+
+	if order == 'row':
+		return (y << zoom) | x
+
+	d = np.zeros(x.shape, dtype=np.int64)
+
+	# Interleave the bits of x and y
+	if order == 'zorder':
+		for b in range(zoom):
+			d |= ((x >> b) & 1) << (2*b)
+			d |= ((y >> b) & 1) << (2*b+1)
+		return d
+
+	# Hilbert curve, from the most significant bit down; each quadrant is
+	# rotated/reflected so the curve is continuous.
+	x, y, n = x.copy(), y.copy(), 1 << zoom
+	s = n >> 1
+	while s > 0:
+		rx, ry = (x & s) > 0, (y & s) > 0
+		d += s*s*((3*rx.astype(np.int64)) ^ ry.astype(np.int64))
+
+		flip = (~ry) & rx
+		x[flip], y[flip] = n-1-x[flip], n-1-y[flip]
+		swap = ~ry
+		x[swap], y[swap] = y[swap], x[swap]
+		s >>= 1
+	return d
+
+#
+# Combine the tile sets of the requests, each (src, lat, lon, zoom), into one
+# deduplicated set of tiles per source, as (zoom, x, y) in the specified order.
+# Returns a dict of source name => list of tiles, and the total number of
+# tiles requested (counting tiles shared by requests once per request).
+#
+def union_tiles(requests, order: str = 'hilbert', even: bool = False):
+	import numpy as np
+	from fetch_tiles import TileSource
+
+	keys, n_requested = {}, 0
+	for src, lat, lon, zoom in requests:
+		tile_size = TileSource(src).info['tile_size']
+		x0, y0, x1, y1 = tile_range(lat, lon, zoom, tile_size, even)
+
+		X, Y = np.meshgrid(np.arange(x0, x1+1, dtype=np.int64), np.arange(y0, y1+1, dtype=np.int64))
+		Z = np.full(X.size, zoom, dtype=np.int64)
+		keys.setdefault(src, []).append(np.stack([Z, X.ravel(), Y.ravel()], axis=1))
+		n_requested += X.size
+
+	tiles = {}
+	for src, blocks in keys.items():
+		zxy = np.unique(np.concatenate(blocks), axis=0) # sorted by zoom, then x, then y
+
+		# Sort by zoom level, then position along the curve
+		d = np.zeros(len(zxy), dtype=np.int64)
+		for zoom in np.unique(zxy[:,0]):
+			at = (zxy[:,0] == zoom)
+			d[at] = curve_index(zxy[at,1], zxy[at,2], int(zoom), order)
+		zxy = zxy[np.lexsort((d, zxy[:,0]))]
+
+		tiles[src] = [(int(z),int(x),int(y)) for z,x,y in zxy]
+
+	return tiles, n_requested
+
+#
+# Open the tile cache for a source, as fetch_tiles.py -cache / -cache_db
+#
+def open_cache(src: str, cache_dir: str = 'cache', cache_db: str = None):
+	from fetch_tiles import TileSource
+	info = TileSource(src).info
+	if cache_db != None:
+		return SQLiteCache(cache_db, info['name'])
+	return DirectoryCache(cache_dir, info['name'], info['fmt'])
+
+#
+# Plan downloads for the requests: the union of their tiles, less those
+# already in the caches (a dict of source name => cache). Returns a dict with
+# the tiles to fetch per source (in download order), tile counts, and the
+# estimated download size in bytes; tile_kb overrides the estimated size of a
+# tile, which is otherwise the mean size of the source's tiles in the cache at
+# the same zoom level (or any level, or typical_kb for its format).
+#
+def plan_tiles(requests, caches: dict, order: str = 'hilbert', even: bool = False, tile_kb: float = None) -> dict:
+	from fetch_tiles import TileSource
+
+	tiles, n_requested = union_tiles(requests, order, even)
+
+	plan = {'fetch': {}, 'n_requested': n_requested, 'n_unique': 0, 'n_cached': 0, 'n_fetch': 0, 'est_bytes': 0}
+	for src, zxys in tiles.items():
+		missing = caches[src].missing_many(zxys)
+
+		plan['fetch'][src] = missing
+		plan['n_unique'] += len(zxys)
+		plan['n_cached'] += len(zxys)-len(missing)
+		plan['n_fetch'] += len(missing)
+
+		all_total, all_count = caches[src].sizes() if tile_kb == None else (0,0)
+		fallback = typical_kb.get(TileSource(src).info['fmt'], 50.0)*1024
+		if all_count > 0: fallback = all_total/all_count
+
+		for zoom in sorted(set([z for z,x,y in missing])):
+			n = len([1 for z,x,y in missing if z == zoom])
+			if tile_kb != None:
+				size = tile_kb*1024
+			else:
+				total, count = caches[src].sizes(zoom)
+				size = total/count if count > 0 else fallback
+			plan['est_bytes'] += int(n*size)
+
+	return plan
+
+#
+# Download the planned tiles into the caches, using a pool of threads; tiles
+# are requested in plan order. Returns the list of (src, zoom, x, y) tiles
+# which could not be fetched.
+#
+def fetch_planned(plan: dict, caches: dict, workers: int = 4, max_per_host: int = None,
+	retries: int = 5, backoff: float = 0.5, report: RunReport = None):
+	from concurrent.futures import ThreadPoolExecutor
+	from fetch_tiles import TileSource
+
+	if report == None: report = RunReport('prefetch.py')
+
+	if (max_per_host != None) and (TileSource.max_per_host != max(1, max_per_host)):
+		TileSource.max_per_host = max(1, max_per_host)
+		TileSource.host_slots = {}
+	TileSource.configure_session(max(workers, TileSource.max_per_host), retries, backoff)
+
+	todo = [(src, z, x, y) for src in plan['fetch'] for z,x,y in plan['fetch'][src]]
+	sources = {src: TileSource(src) for src in plan['fetch']}
+
+	# Update user on progress every delta_checkpoint_ percent
+	n, N, checkpoint_, delta_checkpoint_ = 0, len(todo), 1, 10
+	progress_lock = threading.Lock()
+
+	def fetch_tile(tile):
+		nonlocal n, checkpoint_
+		src, z, x, y = tile
+		url, data = sources[src].fetch(x, y, z)
+		if data != None:
+			caches[src].put(z, x, y, data)
+			report.count('bytes_downloaded', len(data))
+		report.count('tiles_downloaded' if data != None else 'tiles_failed')
+
+		with progress_lock:
+			n += 1
+			if ( (100*n)/N > (checkpoint_*delta_checkpoint_) ):
+				print(f'  {caches[src].location(z, x, y)} : {n}/{N} ({(100.0*n)/N:.0f}%)')
+				checkpoint_ += 1
+		return tile, data != None
+
+	# Only the tiles which failed are kept; the data is already in the cache.
+	failed = []
+	with ThreadPoolExecutor(max_workers = max(1, workers)) as pool:
+		for tile, ok in pool.map(fetch_tile, todo):
+			if not ok: failed.append(tile)
+
+	return failed
+
+def print_plan(plan: dict):
+	print(f'{plan["n_requested"]} tile(s) requested, {plan["n_unique"]} unique')
+	print(f'{plan["n_cached"]} already cached, {plan["n_fetch"]} to download (approx. {plan["est_bytes"]/(1024*1024):.1f} MiB)')
+	for src in plan['fetch']:
+		zooms = sorted(set([z for z,x,y in plan['fetch'][src]]))
+		for zoom in zooms:
+			n = len([1 for z,x,y in plan['fetch'][src] if z == zoom])
+			print(f'  {src} zoom {zoom} : {n} tile(s)')
+
+
+if __name__ == '__main__':
+	from fetch_tiles import TileSource
+
+	parser = argparse.ArgumentParser(description='Download the map tiles for many regions and zoom levels in one deduplicated pass', epilog='')
+
+	opts = parser.add_argument_group('Regions of interest')
+
+	opts.add_argument('-region', type = float, nargs = 4, action = 'append', default = [],
+		metavar = ('LAT0', 'LAT1', 'LON0', 'LON1'),
+		help = 'Region as min and max latitude, then min and max longitude, in degrees; may be given more than once')
+
+	opts.add_argument('-manifest', type = str,
+		help = 'Also include the sites in this batch.py manifest (.json or .csv), with their tile sources and zoom levels')
+
+	opts.add_argument('-src', type = str, default = 'usgs', choices = TileSource.info.keys(),
+		help = 'Source of satellite tile data for -region')
+
+	opts.add_argument('-zoom', type = int, nargs = '+', default = [],
+		help = 'Zoom level(s) for -region, and any additional zoom levels for manifest sites')
+
+	opts.add_argument('-even', action = 'store_true',
+		help = 'Plan the tiles needed by fetch_tiles.py with -even')
+
+	opts = parser.add_argument_group('Data caching')
+
+	opts.add_argument('-cache', type = str, default = 'cache',
+		help = 'Directory name for cached tile data')
+
+	opts.add_argument('-cache_db', type = str,
+		help = 'Store cached tile data in this SQLite file rather than the -cache directory')
+
+	opts = parser.add_argument_group('Downloading')
+
+	opts.add_argument('-order', type = str, default = 'hilbert', choices = [k for k in orders],
+		help = 'Download order; ' + ', '.join([f'{k} = {orders[k]["desc"]}' for k in orders]))
+
+	opts.add_argument('-tile_kb', type = float,
+		help = 'Size of a tile (KiB) for the download estimate; default from tiles already in the cache')
+
+	opts.add_argument('-dry_run', action = 'store_true',
+		help = 'Only report the plan; do not download anything')
+
+	opts.add_argument('-plan_out', type = str,
+		help = 'Write the plan (tiles to download, and estimated size) to this JSON file')
+
+	opts.add_argument('-workers', type = int, default = 4,
+		help = 'Number of tiles to download concurrently')
+
+	opts.add_argument('-max_per_host', type = int, default = TileSource.max_per_host,
+		help = 'Maximum number of simultaneous requests to any one tile server')
+
+	opts.add_argument('-retries', type = int, default = 5,
+		help = 'Number of times to retry a failed tile request')
+
+	opts.add_argument('-backoff', type = float, default = 0.5,
+		help = 'Base delay (seconds) between retries, doubled for each successive retry')
+
+	opts = parser.add_argument_group('Instrumentation')
+
+	opts.add_argument('-report', type = str,
+		help = 'Write a JSON run report (stage timings, tile counts, bytes downloaded) to this file')
+
+	opts.add_argument('-profile', type = str,
+		help = 'Profile the run with cProfile, saving the statistics to this file')
+
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
+
+	args = parser.parse_args()
+
+	report = RunReport('prefetch.py')
+	if args.report != None: report.write_at_exit(args.report)
+	if args.profile != None: profile_to(args.profile)
+
+	print()
+	print(f'Run at: {time.asctime()}')
+	print(f'Run as: {" ".join(sys.argv)}')
+	print()
+
+	requests = []
+	for lat0, lat1, lon0, lon1 in args.region:
+		if len(args.zoom) == 0:
+			print('-region requires -zoom')
+			sys.exit(-1)
+		for zoom in args.zoom:
+			requests.append( (args.src, sorted((lat0,lat1)), sorted((lon0,lon1)), zoom) )
+
+	if args.manifest != None:
+		import batch
+		for site in batch.read_manifest(args.manifest):
+			zooms = set(args.zoom) | (set([site['zoom']]) if site['zoom'] != None else set())
+			for zoom in sorted(zooms):
+				requests.append( (site['tile_src'], site['lat'], site['lon'], zoom) )
+
+	if len(requests) == 0:
+		print('Nothing to do; specify -region or -manifest')
+		sys.exit(-1)
+
+	for src, lat, lon, zoom in requests:
+		if (zoom < 0) or (zoom > 23):
+			print(f'Bad zoom level {zoom}')
+			sys.exit(-1)
+
+	report.stage('plan')
+	caches = {src: open_cache(src, args.cache, args.cache_db) for src in set([r[0] for r in requests])}
+	plan = plan_tiles(requests, caches, args.order, args.even, args.tile_kb)
+
+	print(f'{len(requests)} request(s):')
+	print_plan(plan)
+	print()
+
+	report.set('n_requests', len(requests))
+	for k in ('n_requested', 'n_unique', 'n_cached', 'n_fetch', 'est_bytes'):
+		report.set(k, plan[k])
+
+	if args.plan_out != None:
+		tmp_path = f'{args.plan_out}.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(plan, f, indent = 1)
+		os.replace(tmp_path, args.plan_out)
+		print(f'Plan written to {args.plan_out}')
+
+	if (args.dry_run == False) and (plan['n_fetch'] > 0):
+		report.stage('download')
+		print(f'Downloading...')
+		failed = fetch_planned(plan, caches, args.workers, args.max_per_host, args.retries, args.backoff, report)
+
+		if len(failed) > 0:
+			print()
+			print(f'{len(failed)} tile(s) could not be downloaded; run again to retry them:')
+			for src, z, x, y in failed:
+				print(f'  {caches[src].location(z, x, y)}')
+
+	for cache in caches.values():
+		cache.close()
+
+	report.finish()
+	print('Done.')
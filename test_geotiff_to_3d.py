@@ -0,0 +1,57 @@
+# Author: John Grime
+#
+# Tests for geotiff_to_3d.py, on a synthetic GeoTIFF (see benchmark.py); run
+# with "python3 -m pytest".
+#
+
+import os
+import numpy as np
+import pytest
+
+import geotiff_to_3d
+from benchmark import make_geotiff
+
+@pytest.fixture(scope = 'module')
+def gtiff(tmp_path_factory):
+	path = str(tmp_path_factory.mktemp('gtiff') / 'synthetic.tiff') # covers lat 36..37, lon -112..-111
+	make_geotiff(path, 256)
+	return path
+
+# Vertex positions of an .obj file as an (N,3) array
+def read_verts(path: str):
+	with open(path) as f:
+		return np.array([l.split()[1:] for l in f if l.startswith('v ')], dtype=np.float64)
+
+def build(gtiff, out_dir, **options):
+	cwd = os.getcwd()
+	os.chdir(out_dir)
+	try:
+		path = geotiff_to_3d.build_mesh(gtiff, (36.1, 36.5), (-111.8, -111.4),
+			n_samples_x = 200, n_samples_y = 200, output = 'mesh', **options)
+		return read_verts(os.path.join(out_dir, path))
+	finally:
+		os.chdir(cwd)
+
+#
+# With the default x0 (i.e. longitudes measured from Greenwich), the per-row
+# scales must not shear the mesh: the middle column of vertices is vertical.
+#
+@pytest.mark.parametrize('geodesic', ['row', 'wgs84'])
+def test_geodesic_rows_not_sheared(gtiff, tmp_path, geodesic):
+	verts = build(gtiff, str(tmp_path), geodesic = geodesic)
+
+	# Rows of vertices share y; columns ordered west to east within each row
+	X = verts[:,0].reshape(len(np.unique(verts[:,1])), -1)
+	mid = X[:, X.shape[1]//2]
+
+	assert abs(X).max() > 9e6 # still positioned relative to x0 = 0
+	assert np.ptp(mid) < 5.0 # metres, over about 44 km of latitude
+
+	# Rows are narrower to the north
+	width = X[:,-1] - X[:,0]
+	assert width[-1] < width[0]
+
+def test_geodesic_central_unchanged(gtiff, tmp_path):
+	verts = build(gtiff, str(tmp_path))
+	X = verts[:,0].reshape(len(np.unique(verts[:,1])), -1)
+	assert np.ptp(X, axis = 0).max() == 0.0 # every column vertical, as before
@@ -0,0 +1,140 @@
+# Author: John Grime
+#
+# Tests for util.py: WebMercatorArray must agree element by element with the
+# scalar WebMercator routines, and make_args() must check options as argparse
+# would. Run with "python3 -m pytest".
+#
+
+import argparse
+import math
+import numpy as np
+import pytest
+
+from util import WebMercator, WebMercatorArray, make_args
+
+max_lat = 85.0511287798066 # limit of the Web Mercator projection
+
+zooms = [0, 1, 7, 13, 20]
+
+# Random points, plus points near the poles and the antimeridian
+def sample_lonlat(n: int = 500, seed: int = 1):
+	rng = np.random.default_rng(seed)
+	lon = rng.uniform(-180.0, 180.0, n)
+	lat = rng.uniform(-max_lat, max_lat, n)
+
+	edge_lon = [-180.0, -179.9999999, 179.9999999, 179.999, -179.999, 0.0, 1e-9, -1e-9]
+	edge_lat = [max_lat-1e-9, -(max_lat-1e-9), 85.0, -85.0, 0.0, 1e-9, 60.0, -60.0]
+	lon = np.concatenate([lon, edge_lon, edge_lon[::-1]])
+	lat = np.concatenate([lat, edge_lat, edge_lat])
+	return lon, lat
+
+def scalar(fn, a, b, *args):
+	results = [fn(float(u), float(v), *args) for u,v in zip(a, b)]
+	return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+
+def assert_close(array_result, scalar_result, rtol = 1e-12, atol = 1e-9):
+	for r, s in zip(array_result, scalar_result):
+		assert r.shape == s.shape
+		np.testing.assert_allclose(r, s, rtol = rtol, atol = atol)
+
+def test_lonlat_to_world():
+	lon, lat = sample_lonlat()
+	assert_close(WebMercatorArray.lonlat_to_world(lon, lat), scalar(WebMercator.lonlat_to_world, lon, lat))
+
+def test_world_to_lonlat():
+	lon, lat = sample_lonlat()
+	wx, wy = scalar(WebMercator.lonlat_to_world, lon, lat)
+	assert_close(WebMercatorArray.world_to_lonlat(wx, wy), scalar(WebMercator.world_to_lonlat, wx, wy))
+
+@pytest.mark.parametrize('zoom', zooms)
+def test_lonlat_to_pix(zoom):
+	lon, lat = sample_lonlat()
+	assert_close(WebMercatorArray.lonlat_to_pix(lon, lat, zoom), scalar(WebMercator.lonlat_to_pix, lon, lat, zoom), atol = 1e-6)
+
+@pytest.mark.parametrize('zoom', zooms)
+def test_pix_to_lonlat(zoom):
+	lon, lat = sample_lonlat()
+	px, py = scalar(WebMercator.lonlat_to_pix, lon, lat, zoom)
+	assert_close(WebMercatorArray.pix_to_lonlat(px, py, zoom), scalar(WebMercator.pix_to_lonlat, px, py, zoom))
+
+@pytest.mark.parametrize('zoom', zooms)
+def test_world_pix(zoom):
+	lon, lat = sample_lonlat()
+	wx, wy = scalar(WebMercator.lonlat_to_world, lon, lat)
+	assert_close(WebMercatorArray.world_to_pix(wx, wy, zoom), scalar(WebMercator.world_to_pix, wx, wy, zoom), atol = 0.0)
+
+	px, py = scalar(WebMercator.world_to_pix, wx, wy, zoom)
+	assert_close(WebMercatorArray.pix_to_world(px, py, zoom), scalar(WebMercator.pix_to_world, px, py, zoom), atol = 0.0)
+
+@pytest.mark.parametrize('zoom', zooms)
+def test_lonlat_to_tile(zoom):
+	lon, lat = sample_lonlat()
+	tx, ty = WebMercatorArray.lonlat_to_tile(lon, lat, zoom)
+	sx, sy = scalar(WebMercator.lonlat_to_tile, lon, lat, zoom)
+
+	assert tx.dtype == np.int64
+	np.testing.assert_array_equal(tx, sx)
+	np.testing.assert_array_equal(ty, sy)
+
+@pytest.mark.parametrize('zoom', zooms)
+def test_tile_to_lonlat(zoom):
+	n = 2**zoom
+	rng = np.random.default_rng(zoom)
+	tx = np.concatenate([rng.integers(0, n, 200), [0, n-1, 0, n-1]])
+	ty = np.concatenate([rng.integers(0, n, 200), [0, 0, n-1, n-1]])
+	assert_close(WebMercatorArray.tile_to_lonlat(tx, ty, zoom), scalar(WebMercator.tile_to_lonlat, tx, ty, zoom))
+
+#
+# tile_to_lonlat() gives the TOP LEFT corner of the tile in degrees, via the
+# inverse Mercator projection (not a linear scaling of the tile coords).
+#
+def test_tile_to_lonlat_semantics():
+	assert WebMercator.tile_to_lonlat(0, 0, 0) == pytest.approx((-180.0, max_lat))
+	assert WebMercator.tile_to_lonlat(1, 1, 1) == pytest.approx((0.0, 0.0), abs = 1e-12)
+	assert WebMercator.tile_to_lonlat(0, 2, 1) == pytest.approx((-180.0, -max_lat))
+
+	# Latitude of the tile edge at y = n/4 is the Mercator inverse, not 85.05/2
+	lon, lat = WebMercator.tile_to_lonlat(0, 1, 2)
+	assert lat == pytest.approx(math.degrees(math.atan(math.sinh(math.pi/2))))
+
+	# Each point lies inside the tile whose corner is returned
+	lon, lat = sample_lonlat()
+	for zoom in zooms:
+		tx, ty = WebMercatorArray.lonlat_to_tile(lon, lat, zoom)
+		inside = (tx < 2**zoom) & (ty < 2**zoom)
+		corner_lon, corner_lat = WebMercatorArray.tile_to_lonlat(tx, ty, zoom)
+		assert np.all(corner_lon[inside] <= lon[inside] + 1e-9)
+		assert np.all(corner_lat[inside] >= lat[inside] - 1e-9)
+
+def test_broadcasting():
+	wx, wy = WebMercatorArray.lonlat_to_world(np.linspace(-10.0, 10.0, 5), 45.0)
+	assert wx.shape == wy.shape == (5,)
+	assert np.all(wy == wy[0])
+
+def options_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-lat', nargs = 2, type = float)
+	parser.add_argument('-n_samples', type = int, default = 100)
+	parser.add_argument('-out_fmt', choices = ['obj', 'ply'], default = 'obj')
+	parser.add_argument('-texture', default = None)
+	parser.add_argument('-combine', action = 'store_true')
+	return parser
+
+def test_make_args_converts():
+	args = make_args(options_parser(), ['-lat', 1, 2], {'n_samples': '200', 'lat': ('3', 4), 'combine': True, 'texture': None})
+	assert args.n_samples == 200
+	assert args.lat == [3.0, 4.0]
+	assert args.combine == True
+	assert args.texture == None
+
+@pytest.mark.parametrize('options', [
+	{'out_fmt': 'xyz'},
+	{'n_samples': 'many'},
+	{'lat': 1.0},
+	{'lat': [1.0, 2.0, 3.0]},
+	{'combine': 'yes'},
+	{'unknown': 1},
+])
+def test_make_args_rejects(options):
+	with pytest.raises(SystemExit):
+		make_args(options_parser(), [], options)
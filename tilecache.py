@@ -0,0 +1,296 @@
+# Author: John Grime
+#
+# Storage for downloaded map tiles, keyed by (zoom, x, y) for a single tile
+# source. Two interchangeable backends are provided:
+#
+#   DirectoryCache : one file per tile, "{source}_{zoom}_{x}_{y}.{fmt}", in a
+#                    directory (the original fetch_tiles.py layout).
+#
+#   SQLiteCache    : all tiles in a single SQLite file, which may be shared by
+#                    several tile sources. Supports fast existence queries for
+#                    whole tile sets and least-recently-used eviction to keep
+#                    the file under a size limit.
+#
+# Both backends provide:
+#
+#   missing(zoom, xys) : subset of (x,y) list not in the cache, in same order
+#   missing_many(zxys) : as missing(), for a list of (zoom,x,y) at any zoom
+#                        levels, checked in a single pass over the cache
+#   sizes(zoom)        : total size in bytes and number of the source's tiles
+#                        at the specified zoom level (or all levels if None)
+#   get(zoom, x, y)    : tile data as bytes, or None if not cached
+#   put(zoom, x, y, data)
+#   location(zoom, x, y) : string describing where a tile is stored
+#   close()
+#
+# Run this file directly to migrate a tile directory into an SQLite cache.
+#
+
+import sys, os, re, time, sqlite3, threading, argparse
+
+class DirectoryCache:
+
+	def __init__(self, cache_dir: str, source: str, fmt: str):
+		self.cache_dir, self.source, self.fmt = cache_dir, source, fmt
+
+		if os.path.isdir(cache_dir) == False:
+			try:
+				os.mkdir(cache_dir)
+			except OSError:
+				print(f'Unable to create cache directory "{cache_dir}"; halting here.');
+				sys.exit(-1)
+			else:
+				print(f'Created missing cache directory "{cache_dir}"')
+
+	def location(self, zoom: int, x: int, y: int) -> str:
+		fpath = f'{self.source}_{zoom}_{x}_{y}.{self.fmt}'
+		return os.path.join(self.cache_dir, fpath)
+
+	def missing(self, zoom: int, xys):
+		return [(x,y) for x,y in xys if not os.path.isfile(self.location(zoom, x, y))]
+
+	# (zoom, x, y, path) for each of the source's tiles in the cache directory
+	def scan(self):
+		pattern = re.compile(rf'^{re.escape(self.source)}_(\d+)_(\d+)_(\d+)\.{re.escape(self.fmt)}$')
+		for entry in os.scandir(self.cache_dir):
+			m = pattern.match(entry.name)
+			if m != None: yield int(m.group(1)), int(m.group(2)), int(m.group(3)), entry.path
+
+	# One directory listing, rather than a check per tile
+	def missing_many(self, zxys):
+		present = set([(z,x,y) for z,x,y,_ in self.scan()])
+		return [(z,x,y) for z,x,y in zxys if (z,x,y) not in present]
+
+	def sizes(self, zoom: int = None) -> (int,int):
+		total, count = 0, 0
+		for z,x,y,path in self.scan():
+			if (zoom != None) and (z != zoom): continue
+			total, count = total+os.path.getsize(path), count+1
+		return total, count
+
+	def get(self, zoom: int, x: int, y: int):
+		path = self.location(zoom, x, y)
+		if not os.path.isfile(path): return None
+		with open(path, 'rb') as f:
+			return f.read()
+
+	# Written under a temporary name and then renamed, so an interrupted write
+	# never leaves a partial tile in the cache. Safe to call from any thread.
+	def put(self, zoom: int, x: int, y: int, data: bytes):
+		path = self.location(zoom, x, y)
+		tmp_path = f'{path}.{threading.get_ident()}.part'
+		with open(tmp_path, 'wb') as f:
+			f.write(data)
+		os.replace(tmp_path, path)
+
+	def close(self):
+		pass
+
+
+class SQLiteCache:
+
+	schema = '''
+		CREATE TABLE IF NOT EXISTS tiles (
+			source TEXT NOT NULL,
+			z INTEGER NOT NULL,
+			x INTEGER NOT NULL,
+			y INTEGER NOT NULL,
+			data BLOB NOT NULL,
+			size INTEGER NOT NULL,
+			atime REAL NOT NULL,
+			PRIMARY KEY (source, z, x, y)
+		);
+		CREATE INDEX IF NOT EXISTS tiles_atime ON tiles (atime);
+	'''
+
+	#
+	# If max_bytes is specified, the least recently used tiles are removed on
+	# evict() or close() until the total tile data is under that size. No
+	# eviction happens otherwise, so tiles stored during a run remain
+	# available until it completes.
+	#
+	def __init__(self, db_path: str, source: str, max_bytes: int = None):
+		self.db_path, self.source, self.max_bytes = db_path, source, max_bytes
+
+		# One connection shared by all threads, serialized via the lock
+		self.lock = threading.Lock()
+		try:
+			self.db = sqlite3.connect(db_path, check_same_thread = False, isolation_level = None)
+			self.db.execute('PRAGMA journal_mode = WAL')
+			self.db.execute('PRAGMA synchronous = NORMAL')
+			self.db.executescript(SQLiteCache.schema)
+		except sqlite3.Error as e:
+			print(f'Unable to open tile cache database "{db_path}" ({e}); halting here.')
+			sys.exit(-1)
+
+	def location(self, zoom: int, x: int, y: int) -> str:
+		return f'{self.db_path}:{self.source}/{zoom}/{x}/{y}'
+
+	# Single range query over the bounding box of the requested tiles, rather
+	# than one query per tile.
+	def missing(self, zoom: int, xys):
+		xys = list(xys)
+		if len(xys) == 0: return []
+
+		xs, ys = [x for x,y in xys], [y for x,y in xys]
+		with self.lock:
+			rows = self.db.execute(
+				'SELECT x, y FROM tiles WHERE source = ? AND z = ? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?',
+				(self.source, zoom, min(xs), max(xs), min(ys), max(ys))).fetchall()
+
+		present = set(rows)
+		return [(x,y) for x,y in xys if (x,y) not in present]
+
+	# The requested tiles are loaded into a temporary table and joined against
+	# the tiles table in a single query.
+	def missing_many(self, zxys):
+		zxys = [(int(z),int(x),int(y)) for z,x,y in zxys]
+		if len(zxys) == 0: return []
+
+		with self.lock:
+			self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (z INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL)')
+			self.db.execute('BEGIN')
+			self.db.execute('DELETE FROM wanted')
+			self.db.executemany('INSERT INTO wanted VALUES (?,?,?)', zxys)
+			self.db.execute('COMMIT')
+			rows = self.db.execute(
+				'SELECT w.z, w.x, w.y FROM wanted w JOIN tiles t ON t.source = ? AND t.z = w.z AND t.x = w.x AND t.y = w.y',
+				(self.source,)).fetchall()
+			self.db.execute('DELETE FROM wanted')
+
+		present = set(rows)
+		return [t for t in zxys if t not in present]
+
+	def sizes(self, zoom: int = None) -> (int,int):
+		with self.lock:
+			if zoom == None:
+				total, count = self.db.execute('SELECT TOTAL(size), COUNT(*) FROM tiles WHERE source = ?', (self.source,)).fetchone()
+			else:
+				total, count = self.db.execute('SELECT TOTAL(size), COUNT(*) FROM tiles WHERE source = ? AND z = ?', (self.source, zoom)).fetchone()
+		return int(total), count
+
+	def get(self, zoom: int, x: int, y: int):
+		key = (self.source, zoom, x, y)
+		with self.lock:
+			row = self.db.execute('SELECT data FROM tiles WHERE source = ? AND z = ? AND x = ? AND y = ?', key).fetchone()
+			if row == None: return None
+			self.db.execute('UPDATE tiles SET atime = ? WHERE source = ? AND z = ? AND x = ? AND y = ?', (time.time(),) + key)
+		return row[0]
+
+	def put(self, zoom: int, x: int, y: int, data: bytes):
+		with self.lock:
+			self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?,?)',
+				(self.source, zoom, x, y, sqlite3.Binary(data), len(data), time.time()))
+
+	# Store many tiles in a single transaction; items are (zoom, x, y, data)
+	def put_many(self, items):
+		now = time.time()
+		with self.lock:
+			self.db.execute('BEGIN')
+			self.db.executemany('INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?,?)',
+				[(self.source, z, x, y, sqlite3.Binary(data), len(data), now) for z, x, y, data in items])
+			self.db.execute('COMMIT')
+
+	# Total size of tile data (all sources) in bytes, and number of tiles
+	def usage(self) -> (int,int):
+		with self.lock:
+			total, count = self.db.execute('SELECT TOTAL(size), COUNT(*) FROM tiles').fetchone()
+		return int(total), count
+
+	# Remove least recently used tiles (of any source) until the total size of
+	# tile data is under max_bytes. Returns number of tiles removed.
+	def evict(self, max_bytes: int = None) -> int:
+		max_bytes = self.max_bytes if max_bytes == None else max_bytes
+		if max_bytes == None: return 0
+
+		total, count = self.usage()
+		if total <= max_bytes: return 0
+
+		with self.lock:
+			excess, doomed = total-max_bytes, []
+			for rowid, size in self.db.execute('SELECT rowid, size FROM tiles ORDER BY atime'):
+				if excess <= 0: break
+				doomed.append((rowid,))
+				excess -= size
+
+			self.db.execute('BEGIN')
+			self.db.executemany('DELETE FROM tiles WHERE rowid = ?', doomed)
+			self.db.execute('COMMIT')
+
+		print(f'Evicted {len(doomed)} least recently used tile(s) from "{self.db_path}"')
+		return len(doomed)
+
+	def close(self):
+		self.evict()
+		with self.lock:
+			self.db.close()
+
+#
+# Copy a tile directory into an SQLite cache. The source name, zoom and tile
+# coords are taken from the file names; tiles already in the database are
+# replaced. Returns number of tiles copied.
+#
+def migrate(cache_dir: str, db_path: str, source: str = None, batch_size: int = 1000, remove: bool = False) -> int:
+	pattern = re.compile(r'^([^_]+)_(\d+)_(\d+)_(\d+)\.\w+$')
+
+	caches, batches, paths, n = {}, {}, {}, 0
+
+	def flush(name):
+		caches[name].put_many(batches[name])
+		if remove:
+			for path in paths[name]: os.remove(path)
+		batches[name], paths[name] = [], []
+
+	for entry in os.scandir(cache_dir):
+		m = pattern.match(entry.name)
+		if (m == None) or (not entry.is_file()): continue
+
+		name, zoom, x, y = m.group(1), int(m.group(2)), int(m.group(3)), int(m.group(4))
+		if (source != None) and (name != source): continue
+
+		if name not in caches:
+			caches[name], batches[name], paths[name] = SQLiteCache(db_path, name), [], []
+
+		with open(entry.path, 'rb') as f:
+			batches[name].append( (zoom, x, y, f.read()) )
+		paths[name].append(entry.path)
+		n += 1
+
+		if len(batches[name]) >= batch_size:
+			flush(name)
+			print(f'  {n} tiles ...')
+
+	for name in caches:
+		flush(name)
+		caches[name].close()
+
+	return n
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Migrate a tile cache directory into an SQLite tile cache', epilog='')
+
+	parser.add_argument('-cache', required = True, type = str,
+		help = 'Directory name for existing cached tile data')
+
+	parser.add_argument('-cache_db', required = True, type = str,
+		help = 'SQLite tile cache file (created if needed)')
+
+	parser.add_argument('-src', required = False, type = str,
+		help = 'Only migrate tiles from this source (e.g. "usgs"); default is all sources')
+
+	parser.add_argument('-remove', required = False, action = 'store_true',
+		help = 'Delete tile files once copied into the database')
+
+	if len(sys.argv)<2:
+		parser.parse_args([sys.argv[0], '-h'])
+
+	args = parser.parse_args()
+
+	if os.path.isdir(args.cache) == False:
+		print(f'Cache directory "{args.cache}" not found')
+		sys.exit(-1)
+
+	print(f'Migrating "{args.cache}" => "{args.cache_db}" ...')
+	n = migrate(args.cache, args.cache_db, args.src, remove = args.remove)
+	print(f'Migrated {n} tile(s).')
@@ -85,7 +85,7 @@ class WebMercator:
 
 	@staticmethod
 	def pix_to_lonlat(px: float, py: float, zoom: int, tile_size: int = 256) -> (float, float):
-		wx,wy = self.pix_to_world(px, py, zoom, tile_size)
+		wx,wy = WebMercator.pix_to_world(px, py, zoom, tile_size)
 		return WebMercator.world_to_lonlat(wx, wy)
 
 	@staticmethod
@@ -101,15 +101,82 @@ class WebMercator:
 	@staticmethod
 	def lonlat_to_tile(lon: float, lat: float, zoom: int) -> (int, int):
 		N_cell = 2**zoom # number of lattice cells at this zoom level
-		world_x, world_y = util.WebMercator.lonlat_to_world(lon, lat)
+		world_x, world_y = WebMercator.lonlat_to_world(lon, lat)
 		return int(world_x*N_cell), int(world_y*N_cell)
 
 	@staticmethod
 	def tile_to_lonlat(tx: int, ty: int, zoom: int) -> (float, float):
 		N_cell = 2**zoom # number of lattice cells at this zoom level
-		lon = float(tx)/N_cell * 2.0*math.pi - math.pi
-		lat = math.pi/2 - float(ty)/N_cell * math.pi
-		return lon, lat # lon,lat of TOP LEFT of lattice cell
+		return WebMercator.world_to_lonlat(float(tx)/N_cell, float(ty)/N_cell) # TOP LEFT of lattice cell
+
+#
+# As WebMercator, but accepting NumPy arrays (or anything convertible to them)
+# for the coordinates, which are broadcast against each other; results are
+# arrays of the broadcast shape. Computed element-wise in bulk, without Python
+# loops, for e.g. projecting every vertex of a mesh.
+#
+class WebMercatorArray:
+
+	to_rad = math.pi/180.0
+	to_deg = 180.0/math.pi
+
+	@staticmethod
+	def lonlat_to_world(lon, lat):
+		import numpy as np
+		pi, twopi = math.pi, 2.0*math.pi
+		lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+		lat, lon = lat*WebMercatorArray.to_rad, lon*WebMercatorArray.to_rad
+		x = lon + pi
+		y = pi - np.log(np.tan(pi/4 + lat/2))
+		return x/twopi, y/twopi
+
+	@staticmethod
+	def world_to_lonlat(wx, wy):
+		import numpy as np
+		pi, twopi = math.pi, 2.0*math.pi
+		wx, wy = np.broadcast_arrays(np.asarray(wx, dtype=np.float64), np.asarray(wy, dtype=np.float64))
+		lon = wx*twopi - pi
+		lat = 2.0*np.arctan(np.exp(-(wy*twopi-pi))) - pi/2
+		return lon*WebMercatorArray.to_deg, lat*WebMercatorArray.to_deg
+
+	@staticmethod
+	def lonlat_to_pix(lon, lat, zoom: int, tile_size: int = 256):
+		wx, wy = WebMercatorArray.lonlat_to_world(lon,lat)
+		return WebMercatorArray.world_to_pix(wx, wy, zoom, tile_size)
+
+	@staticmethod
+	def pix_to_lonlat(px, py, zoom: int, tile_size: int = 256):
+		wx,wy = WebMercatorArray.pix_to_world(px, py, zoom, tile_size)
+		return WebMercatorArray.world_to_lonlat(wx, wy)
+
+	@staticmethod
+	def world_to_pix(wx, wy, zoom: int, tile_size: int = 256):
+		import numpy as np
+		C = float(tile_size) * (2**zoom)
+		wx, wy = np.broadcast_arrays(np.asarray(wx, dtype=np.float64), np.asarray(wy, dtype=np.float64))
+		return wx*C, wy*C
+
+	@staticmethod
+	def pix_to_world(px, py, zoom: int, tile_size: int = 256):
+		import numpy as np
+		C = float(tile_size) * (2**zoom)
+		px, py = np.broadcast_arrays(np.asarray(px, dtype=np.float64), np.asarray(py, dtype=np.float64))
+		return px/C, py/C
+
+	# Tile coords as int64 arrays; truncation as for WebMercator.lonlat_to_tile()
+	@staticmethod
+	def lonlat_to_tile(lon, lat, zoom: int):
+		import numpy as np
+		N_cell = 2**zoom # number of lattice cells at this zoom level
+		world_x, world_y = WebMercatorArray.lonlat_to_world(lon, lat)
+		return np.trunc(world_x*N_cell).astype(np.int64), np.trunc(world_y*N_cell).astype(np.int64)
+
+	@staticmethod
+	def tile_to_lonlat(tx, ty, zoom: int):
+		import numpy as np
+		N_cell = 2**zoom # number of lattice cells at this zoom level
+		tx, ty = np.asarray(tx, dtype=np.float64), np.asarray(ty, dtype=np.float64)
+		return WebMercatorArray.world_to_lonlat(tx/N_cell, ty/N_cell) # TOP LEFT of lattice cell
 
 #
 # Convert latitude and longitude spans in degrees into spans in metres.
@@ -154,6 +221,144 @@ def latlon_degs_per_m(lat_degs, earth_radius_m = 6.371e6):
 
 	return dLat_degs_per_m, dLon_degs_per_m
 
+#
+# Ways of converting lattice positions in degrees into metres; see
+# latlon_row_scales().
+#
+geodesic_modes = {
+	'central': {'desc': 'sphere, longitudinal scale at central latitude of region'},
+	'row':     {'desc': 'sphere, longitudinal scale at latitude of each row'},
+	'wgs84':   {'desc': 'WGS84 ellipsoid, scales at latitude of each row'},
+}
+
+wgs84_a = 6378137.0 # semi-major axis, m
+wgs84_f = 1.0/298.257223563 # flattening
+
+#
+# Row-scale table for the latitudes lats of a lattice of rows: the distance in
+# metres north of lat_ref along a meridian, and the metres per degree of
+# longitude, for each row. Positions along each row are then e.g.
+#
+#   X = (lons-lon_c)[np.newaxis,:] * m_per_deg_lon[:,np.newaxis]
+#
+# so only one cosine is needed per row rather than per vertex. Longitudes
+# should be relative to the centre of the region (lon_c), as the difference
+# in scale between rows shears positions in proportion to their distance from
+# the reference longitude. If ellipsoid
+# is True, the WGS84 ellipsoid is used (meridian distance from the usual
+# series expansion, accurate to well under a millimetre), else a sphere.
+#
+def latlon_row_scales(lats, lat_ref = 0.0, ellipsoid: bool = False, earth_radius_m = 6.371e6):
+	import numpy as np
+
+	lats = np.asarray(lats, dtype=np.float64)
+	deg_to_rad = math.pi/180.0
+
+	if ellipsoid == False:
+		r = earth_radius_m
+		y_m = (lats-lat_ref) * (deg_to_rad*r)
+		m_per_deg_lon = (deg_to_rad*r) * np.cos(lats*deg_to_rad)
+		return y_m, m_per_deg_lon
+
+	a, e2 = wgs84_a, wgs84_f*(2.0-wgs84_f)
+	e4, e6 = e2*e2, e2*e2*e2
+
+	def meridian_m(lats):
+		phi = lats*deg_to_rad
+		return a * (
+			(1.0 - e2/4.0 - 3.0*e4/64.0 - 5.0*e6/256.0) * phi
+			- (3.0*e2/8.0 + 3.0*e4/32.0 + 45.0*e6/1024.0) * np.sin(2.0*phi)
+			+ (15.0*e4/256.0 + 45.0*e6/1024.0) * np.sin(4.0*phi)
+			- (35.0*e6/3072.0) * np.sin(6.0*phi) )
+
+	y_m = meridian_m(lats) - meridian_m(np.float64(lat_ref))
+
+	# radius of the circle of latitude is N(phi).cos(phi), N the prime vertical radius
+	phi = lats*deg_to_rad
+	sin_phi = np.sin(phi)
+	m_per_deg_lon = deg_to_rad * a*np.cos(phi) / np.sqrt(1.0 - e2*sin_phi*sin_phi)
+
+	return y_m, m_per_deg_lon
+
+#
+# HTTP session keeping a pool of persistent (keep-alive) connections to each
+# host, which retries failed requests with exponential backoff (i.e., delays of
+# backoff, 2*backoff, 4*backoff ... seconds between attempts). Connection
+# errors, rate limiting (HTTP 429) and server errors (HTTP 5xx) are retried;
+# if all retries fail, the final response is returned as normal.
+#
+def make_session(pool_size: int = 10, retries: int = 5, backoff: float = 0.5):
+	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.util.retry import Retry
+
+	retry = Retry(total = retries, backoff_factor = backoff,
+		status_forcelist = (429, 500, 502, 503, 504),
+		respect_retry_after_header = True, raise_on_status = False)
+	adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = retry)
+
+	session = requests.Session()
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+#
+# Command line arguments for a script's argparse parser, as if it had been run
+# with argv, then with any options (keyword arguments named as the command line
+# options, without the leading "-") overriding them. Lets the scripts be used
+# from Python with the same defaults as on the command line, e.g.:
+#
+#   args = make_args(parser, ['-lat', 35.9, 36.3], {'zoom': 13, 'combine': True})
+#
+# Options are converted and checked as argparse would (e.g. type = int, or
+# choices), so a bad value is reported here rather than failing later; a value
+# of None leaves the option unset, as if it weren't given.
+#
+def make_args(parser, argv: list, options: dict):
+	args = parser.parse_args([str(a) for a in argv])
+	actions = {a.dest: a for a in parser._actions}
+
+	for k, v in options.items():
+		if (not hasattr(args, k)) or (k not in actions):
+			print(f'Unknown option "{k}"')
+			sys.exit(-1)
+
+		if v != None:
+			try:
+				v = option_value_(actions[k], v)
+			except (TypeError, ValueError) as e:
+				print(f'Bad value {v!r} for option "{k}": {e}')
+				sys.exit(-1)
+		setattr(args, k, v)
+
+	return args
+
+# Value for an argparse action, converted and checked as by parse_args()
+def option_value_(action, v):
+	# Flags, e.g. action = 'store_true'
+	if action.nargs == 0:
+		if not isinstance(v, bool): raise TypeError('expected True or False')
+		return v
+
+	def convert(x):
+		if action.type != None: x = action.type(x)
+		if (action.choices != None) and (x not in action.choices):
+			raise ValueError(f'choose from {", ".join([str(c) for c in action.choices])}')
+		return x
+
+	if action.nargs in (None, '?'):
+		return convert(v)
+
+	# Lists of values, e.g. nargs = 2 or nargs = '+'
+	if isinstance(v, (str, bytes)) or not hasattr(v, '__iter__'):
+		raise TypeError('expected a list of values')
+	v = [convert(x) for x in v]
+	if isinstance(action.nargs, int) and (len(v) != action.nargs):
+		raise ValueError(f'expected {action.nargs} values')
+	if (action.nargs == '+') and (len(v) == 0):
+		raise ValueError('expected at least one value')
+	return v
+
 #
 # Stream data from request to specified file.
 #